@@ -10,6 +10,7 @@ import textwrap
 import progfiguration
 from progfiguration import progfigbuild, sitewrapper
 from progfiguration.cli.util import (
+    CommaSeparatedStrList,
     configure_logging,
     idb_excepthook,
     progfiguration_error_handler,
@@ -93,6 +94,35 @@ def _make_parser():
         description="Build a zipapp .pyz file containing the Python module. Must be run from an editable install.",
     )
     sub_build_sub_pyz.add_argument("pyzfile", type=pathlib.Path, help="Save the resulting pyz file to this path")
+    sub_build_sub_pyz.add_argument(
+        "--bytecode-python",
+        help="Compile bytecode into the pyz file with this Python interpreter, like 'python3.11'. Only nodes running the same Python version will use it.",
+    )
+    sub_build_sub_pyz.add_argument(
+        "--extract-dir",
+        help="Make the pyz file extract itself to a subdirectory of this directory and run from there, like '/var/cache/progfiguration/extracted'.",
+    )
+    sub_build_sub_pyz.add_argument(
+        "--reproducible",
+        action="store_true",
+        help="Build a reproducible pyz file, dated from SOURCE_DATE_EPOCH, that is byte-identical for identical inputs.",
+    )
+    sub_build_sub_pyz.add_argument(
+        "--minimal-core",
+        action="store_true",
+        help="Include only the parts of progfiguration core that the site imports in the pyz file.",
+    )
+    sub_build_sub_pyz.add_argument(
+        "--core-includes",
+        default=[],
+        type=CommaSeparatedStrList,
+        help="With --minimal-core, also include these core modules or packages, separated by commas, like 'progfiguration.ssh'.",
+    )
+    sub_build_sub_pyz.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Keep a manifest next to the output file, and on the next build reuse entries for files that haven't changed instead of writing the whole pyz file again.",
+    )
     sub_build_sub_pip = sub_build_subparsers.add_parser(
         "pip",
         description="Build a pip package containing the Python module. Must be run from an editable install.",
@@ -109,6 +139,13 @@ def _make_parser():
         default=False,
         help="Keep the injected files in the package after building. This is useful for debugging.",
     )
+    sub_build_sub_pip.add_argument(
+        "--format",
+        dest="package_format",
+        default="sdist",
+        choices=list(progfigbuild.PIP_PACKAGE_FORMATS),
+        help="Build a source distribution, a pure-Python wheel that nodes can install without a build step, or both. Defaults to '%(default)s'.",
+    )
 
     # validate subcommand
     sub_validate = subparsers.add_parser(
@@ -192,13 +229,24 @@ def _main_implementation(*arguments):
 
     if parsed.action == "build":
         if parsed.buildaction == "pyz":
-            progfigbuild.build_progfigsite_zipapp(progfigsite_fspath, parsed.progfigsite_modname, parsed.pyzfile)
+            progfigbuild.build_progfigsite_zipapp(
+                progfigsite_fspath,
+                parsed.progfigsite_modname,
+                parsed.pyzfile,
+                bytecode_python=parsed.bytecode_python,
+                extract_dir=parsed.extract_dir,
+                incremental=parsed.incremental,
+                reproducible=parsed.reproducible,
+                minimal_core=parsed.minimal_core,
+                core_includes=parsed.core_includes,
+            )
         elif parsed.buildaction == "pip":
-            progfigbuild.build_progfigsite_pip(
+            progfigbuild.build_progfigsite_pip_packages(
                 progfigsite_fspath,
                 parsed.progfigsite_modname,
                 parsed.outdir,
                 keep_injected_files=parsed.keep_injected_files,
+                package_format=parsed.package_format,
             )
         else:
             parser.error(f"Unknown buildaction {parsed.buildaction}")
@@ -1,6 +1,8 @@
 """The command line interface for progfiguration"""
 
 import argparse
+import concurrent.futures
+import contextlib
 import datetime
 import importlib
 import importlib.metadata
@@ -12,10 +14,10 @@ import subprocess
 import sys
 import tempfile
 import time
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
 
 import progfiguration
-from progfiguration import logger, progfigbuild, remotebrute, sitewrapper
+from progfiguration import logger, memtrace, profiling, progfigbuild, remotebrute, sitewrapper, tracing
 from progfiguration.cli.util import (
     CommaSeparatedDict,
     CommaSeparatedStrList,
@@ -25,8 +27,10 @@ from progfiguration.cli.util import (
     progfiguration_log_levels,
     syslog_excepthook,
 )
+from progfiguration.inventory import rolefingerprint, roledag
 from progfiguration.inventory.invstores import SecretStore
 from progfiguration.inventory.invstores import HostStore
+from progfiguration.inventory.nodes import InventoryNode
 from progfiguration.progfigsite_validator import validate
 
 
@@ -81,8 +85,26 @@ def _action_apply(
     nodename: str,
     roles: Optional[List[str]] = None,
     force: bool = False,
+    profile_dir: Optional[pathlib.Path] = None,
+    parallel: int = 1,
+    state_file: Optional[pathlib.Path] = None,
+    no_skip: bool = False,
 ):
-    """Apply configuration for the node 'nodename' to localhost"""
+    """Apply configuration for the node 'nodename' to localhost
+
+    Roles are applied after the roles they depend on;
+    see `progfiguration.inventory.roledag`.
+    If parallel is greater than 1, apply up to that many independent roles at once.
+
+    If profile_dir is passed, profile instantiating and applying each role,
+    save a .pstats file for each role there, and print a summary table at the end.
+    Profiling measures the whole process, so it requires parallel to be 1.
+
+    If state_file is passed, skip roles whose fingerprint matches the one recorded there
+    when they were last applied successfully, and record the fingerprints of roles that succeed;
+    see `progfiguration.inventory.rolefingerprint`.
+    If no_skip is also True, apply every role, but still record their fingerprints.
+    """
 
     if roles is None:
         roles = []
@@ -94,19 +116,75 @@ def _action_apply(
             f"Was going to apply progfiguration to node {nodename} but TESTING_DO_NOT_APPLY is True for that node."
         )
 
-    for role in hoststore.node_role_list(nodename, secretstore):
-        if not roles or role.name in roles:
-            try:
-                logging.debug(f"Running role {role.name}...")
+    if profile_dir and parallel > 1:
+        raise ValueError("Cannot profile roles while applying them in parallel")
+    profiler = profiling.RoleProfiler(profile_dir) if profile_dir else None
+
+    def profile(rolename: str):
+        return profiler.profile(rolename) if profiler else contextlib.nullcontext()
+
+    statefile = rolefingerprint.RoleStateFile(state_file, nodename) if state_file else None
+    version = rolefingerprint.core_version() if state_file else ""
+
+    def apply_role(rolename: str):
+        role = role_dict[rolename]
+        fingerprint = ""
+        if statefile:
+            fingerprint = rolefingerprint.role_fingerprint(role, hoststore.role_module(rolename), version)
+            if not no_skip and statefile.unchanged(rolename, fingerprint):
+                logging.info(f"Skipping unchanged role {role.name}.")
+                return
+        try:
+            logging.debug(f"Running role {role.name}...")
+            # Memory phases measure the whole process, so they only make sense one role at a time
+            memphase = memtrace.phase(f"apply {role.name}") if parallel <= 1 else contextlib.nullcontext()
+            with profile(role.name), tracing.span(f"apply {role.name}", "role", node=nodename), memphase:
                 role.apply()
-                logging.info(f"Finished running role {role.name}.")
-            except Exception as exc:
-                logging.error(f"Error running role {role.name}: {exc}")
-                raise
-        else:
-            logging.info(f"Skipping role {role.name}.")
+            logging.info(f"Finished running role {role.name}.")
+        except Exception as exc:
+            logging.error(f"Error running role {role.name}: {exc}")
+            if statefile:
+                statefile.forget(rolename)
+            raise
+        if statefile:
+            statefile.record(rolename, fingerprint)
 
-    logging.info(f"Finished running all roles")
+    try:
+        # Only instantiate the roles we're going to apply, so we don't decrypt secrets for the others.
+        # Roles they reference are instantiated when their arguments are resolved.
+        with memtrace.phase(f"instantiate roles for {nodename}"):
+            role_list = hoststore.node_role_list(nodename, secretstore, roles or None, instantiating=profile)
+        role_dict = {role.name: role for role in role_list}
+        rolenames = list(role_dict)
+        all_rolenames = hoststore.node_rolename_list(nodename)
+        for rolename in roles:
+            if rolename not in all_rolenames:
+                logging.warning(f"Node {nodename} does not have role {rolename}.")
+        for rolename in all_rolenames:
+            if rolename not in role_dict:
+                logging.info(f"Skipping role {rolename}.")
+
+        dependencies = roledag.node_role_dependencies(hoststore, nodename, rolenames)
+
+        memphase = memtrace.phase(f"apply roles for {nodename}") if parallel > 1 else contextlib.nullcontext()
+        with memphase:
+            roledag.apply_roles(rolenames, dependencies, apply_role, parallel=parallel)
+
+        logging.info(f"Finished running all roles")
+    finally:
+        # Keep the fingerprints of the roles that succeeded even if a later role failed
+        if statefile:
+            try:
+                statefile.save()
+            except Exception as exc:
+                # Don't replace the error from a failed role with this one;
+                # without the state file, the next run just applies every role again.
+                logging.error(f"Could not save role state file {state_file}: {exc}")
+        # Save and show the profiles even if a role failed, since the failure might be what we're looking for
+        if profiler:
+            paths = profiler.save()
+            print(profiler.table())
+            print(f"Saved {len(paths)} profiles to {profile_dir}")
 
 
 def _action_list(hoststore: HostStore, collection: str):
@@ -189,6 +267,83 @@ def _action_decrypt(
             print("---")
 
 
+@contextlib.contextmanager
+def _deploy_zipapp(build_cache: bool, bytecode_python: Optional[str] = None, **build_options):
+    """Build a zipapp of the progfigsite to deploy, and yield its path
+
+    If build_cache is True, reuse an identical zipapp from the build cache if there is one.
+    Otherwise, build it in a temporary directory that is removed afterwards.
+
+    If bytecode_python is set, compile bytecode into the zipapp with that interpreter,
+    unless it isn't available on this machine.
+
+    Other keyword arguments, like extract_dir, reproducible, target, and minimal_core,
+    are passed to `progfiguration.progfigbuild.build_progfigsite_zipapp()`.
+    """
+    sitepath = sitewrapper.get_progfigsite_path()
+    sitename, sitemod = sitewrapper.get_progfigsite()
+    if bytecode_python:
+        try:
+            progfigbuild.bytecode_python_tag(bytecode_python)
+        except (FileNotFoundError, subprocess.CalledProcessError) as exc:
+            logger.warning(f"Cannot compile bytecode with {bytecode_python}, building without bytecode: {exc}")
+            bytecode_python = None
+    if build_cache:
+        pyzfile, cache_hit = progfigbuild.build_progfigsite_zipapp_cached(
+            sitepath, sitename, bytecode_python=bytecode_python, **build_options
+        )
+        if cache_hit:
+            print(f"Build cache hit, reusing package {pyzfile}")
+        else:
+            print(f"Build cache miss, built package {pyzfile}")
+        yield pyzfile
+    else:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            pyzfile = pathlib.Path(os.path.join(tmpdir, "progfiguration.pyz"))
+            progfigbuild.build_progfigsite_zipapp(
+                sitepath, sitename, pyzfile, bytecode_python=bytecode_python, **build_options
+            )
+            yield pyzfile
+
+
+@contextlib.contextmanager
+def _deploy_zipapps(
+    nodes: Dict[str, InventoryNode],
+    build_cache: bool,
+    bytecode: bool,
+    slim_hoststore: Optional[HostStore] = None,
+    **build_options,
+):
+    """Build zipapps of the progfigsite to deploy to nodes, and yield a dict of `{nodename: zipapp path}`
+
+    If bytecode is True, build one zipapp for each distinct `InventoryNode.python`,
+    with bytecode compiled by the interpreter of the same name on this machine.
+
+    If slim_hoststore is set, build one slim zipapp for each function,
+    containing only what the nodes with that function need,
+    and reuse it for every node with that function.
+
+    Otherwise, build one zipapp for all nodes.
+
+    The other arguments are passed to `_deploy_zipapp()`.
+    """
+    with contextlib.ExitStack() as stack:
+        pyz_by_build: Dict[Tuple[Optional[str], Optional[str]], pathlib.Path] = {}
+        node_pyz: Dict[str, pathlib.Path] = {}
+        for nname, node in nodes.items():
+            python = node.python if bytecode else None
+            function = slim_hoststore.node_function[nname] if slim_hoststore else None
+            if (python, function) not in pyz_by_build:
+                target = None
+                if slim_hoststore and function:
+                    target = progfigbuild.ZipappTarget.for_function(slim_hoststore, function)
+                pyz_by_build[(python, function)] = stack.enter_context(
+                    _deploy_zipapp(build_cache, python, target=target, **build_options)
+                )
+            node_pyz[nname] = pyz_by_build[(python, function)]
+        yield node_pyz
+
+
 def _action_deploy_apply(
     hoststore: HostStore,
     nodenames: List[str],
@@ -197,7 +352,48 @@ def _action_deploy_apply(
     remote_debug: bool,
     force_apply: bool,
     keep_remote_file: bool,
+    parallel: int = 1,
+    ssh_multiplex: bool = True,
+    upload: remotebrute.UploadMethod = "scp",
+    remote_cache_dir: Optional[str] = None,
+    remote_cache_keep: int = 5,
+    build_cache: bool = True,
+    bytecode: bool = False,
+    remote_extract_dir: Optional[str] = None,
+    reproducible: bool = False,
+    slim: bool = False,
+    minimal_core: bool = False,
+    parallel_roles: int = 1,
 ):
+    """Deploy a pyz package to remote nodes and apply it
+
+    If parallel is greater than 1,
+    deploy to up to that many nodes at once in a thread pool,
+    and prefix each line of output with the name of the node it came from.
+
+    If ssh_multiplex is True,
+    open one ssh master connection per node and reuse it for the copy, the command, and the cleanup.
+
+    The upload, remote_cache_dir, and remote_cache_keep arguments are passed to `progfiguration.remotebrute.cpexec`;
+    see its documentation for details.
+
+    If build_cache is True, reuse an identical package from a previous deploy if there is one.
+
+    If bytecode is True, compile bytecode into the package for each node's Python interpreter;
+    see `_deploy_zipapps()`.
+
+    If remote_extract_dir is set, the package extracts itself there on each node and runs from the extracted copy.
+
+    If reproducible is True, build a reproducible package dated from SOURCE_DATE_EPOCH,
+    so that identical sites deployed from different controllers produce identical packages.
+
+    If slim is True, build one slim package per function,
+    containing only the nodes, groups, and roles that nodes with that function need.
+
+    If minimal_core is True, include only the parts of progfiguration core that the site uses.
+
+    If parallel_roles is greater than 1, each node applies up to that many of its roles at once.
+    """
 
     if roles is None:
         roles = []
@@ -210,47 +406,90 @@ def _action_deploy_apply(
 
     errors: list[dict[str, str]] = []
 
-    sitepath = sitewrapper.get_progfigsite_path()
-    sitename, sitemod = sitewrapper.get_progfigsite()
+    def deploy_node(
+        nname: str,
+        node: InventoryNode,
+        pyzfile: pathlib.Path,
+        multiplexer: Optional[remotebrute.SshMultiplexer],
+    ):
+        """Deploy to a single node, recording any error in the errors list"""
+        output_prefix = f"[{nname}] " if parallel > 1 else ""
+
+        args = []
+        if remote_debug:
+            args.append("--debug")
+        args += ["apply", nname]
+        if force_apply:
+            args.append("--force-apply")
+        if roles:
+            args += ["--roles", ",".join(roles)]
+        if parallel_roles > 1:
+            args += ["--parallel-roles", str(parallel_roles)]
+
+        # To run progfiguration remotely over ssh, we need:
+        # * To run Python unbuffered with -u
+        # * To ask sshd to create a tty with -tt
+        # * To redirect stdin to /dev/null,
+        #   which fixes some weird issues with bad newlines in the output for reasons I don't understand.
+        # The result isn't perfect, as some lines are not printed exactly as they were in the output, but it's ok.
+        # When uploading over stdin, we can't have a tty or redirect stdin,
+        # but the remote command sees an empty stdin anyway.
+        if upload == "stdin":
+            ssh_tty = False
+            ssh_stdin = None
+        else:
+            ssh_tty = True
+            ssh_stdin = subprocess.DEVNULL
+        try:
+            remotebrute.cpexec(
+                f"{node.user}@{node.address}",
+                pyzfile.as_posix(),
+                args,
+                interpreter=[node.python, "-u"],
+                ssh_tty=ssh_tty,
+                ssh_stdin=ssh_stdin,
+                keep_remote_file=keep_remote_file,
+                output_prefix=output_prefix,
+                multiplexer=multiplexer,
+                upload=upload,
+                cache_dir=remote_cache_dir,
+                cache_keep=remote_cache_keep,
+            )
+        # except subprocess.CalledProcessError as exc:
+        except Exception as exc:
+            print(f"{output_prefix}Error running progfiguration on node {nname}:")
+            logger.debug(exc)
+            # list.append() is atomic, so this is safe to call from worker threads
+            errors.append({"node": nname, "error": str(exc)})
+
+    multiplexer_ctx = remotebrute.SshMultiplexer() if ssh_multiplex else contextlib.nullcontext()
+    zipapps_ctx = _deploy_zipapps(
+        nodes,
+        build_cache,
+        bytecode,
+        slim_hoststore=hoststore if slim else None,
+        extract_dir=remote_extract_dir,
+        reproducible=reproducible,
+        minimal_core=minimal_core,
+    )
 
-    with tempfile.TemporaryDirectory() as tmpdir:
-        pyzfile = pathlib.Path(os.path.join(tmpdir, "progfiguration.pyz"))
-        progfigbuild.build_progfigsite_zipapp(sitepath, sitename, pyzfile)
-        for nname, node in nodes.items():
-            args = []
-            if remote_debug:
-                args.append("--debug")
-            args += ["apply", nname]
-            if force_apply:
-                args.append("--force-apply")
-            if roles:
-                args += ["--roles", ",".join(roles)]
-
-            # To run progfiguration remotely over ssh, we need:
-            # * To run Python unbuffered with -u
-            # * To ask sshd to create a tty with -tt
-            # * To redirect stdin to /dev/null,
-            #   which fixes some weird issues with bad newlines in the output for reasons I don't understand.
-            # The result isn't perfect, as some lines are not printed exactly as they were in the output, but it's ok.
-            try:
-                remotebrute.cpexec(
-                    f"{node.user}@{node.address}",
-                    pyzfile.as_posix(),
-                    args,
-                    interpreter=[node.python, "-u"],
-                    ssh_tty=True,
-                    ssh_stdin=subprocess.DEVNULL,
-                    keep_remote_file=keep_remote_file,
-                )
-            # except subprocess.CalledProcessError as exc:
-            except Exception as exc:
-                print(f"Error running progfiguration on node {nname}:")
-                logger.debug(exc)
-                errors.append({"node": nname, "error": str(exc)})
+    with zipapps_ctx as node_pyz, multiplexer_ctx as multiplexer:
+        if parallel > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=parallel) as executor:
+                futures = [
+                    executor.submit(deploy_node, nname, node, node_pyz[nname], multiplexer)
+                    for nname, node in nodes.items()
+                ]
+                concurrent.futures.wait(futures)
+        else:
+            for nname, node in nodes.items():
+                deploy_node(nname, node, node_pyz[nname], multiplexer)
 
     if errors:
+        # Sort so that the summary is stable regardless of which node finished first
+        errors.sort(key=lambda e: e["node"])
         print("====================")
-        print("Errors running progfiguration on {len(errors)} node(s):")
+        print(f"Errors running progfiguration on {len(errors)} of {len(nodes)} node(s):")
         for error in errors:
             print(f"  {error['node']}: {error['error']}")
 
@@ -260,6 +499,11 @@ def _action_deploy_copy(
     nodenames: List[str],
     groupnames: List[str],
     remotepath: str,
+    build_cache: bool = True,
+    bytecode: bool = False,
+    reproducible: bool = False,
+    slim: bool = False,
+    minimal_core: bool = False,
 ):
     for group in groupnames:
         nodenames += hoststore.group_members[group]
@@ -267,14 +511,18 @@ def _action_deploy_copy(
 
     nodes = {n: hoststore.node(n).node for n in nodenames}
 
-    sitepath = sitewrapper.get_progfigsite_path()
-    sitename, sitemod = sitewrapper.get_progfigsite()
+    zipapps_ctx = _deploy_zipapps(
+        nodes,
+        build_cache,
+        bytecode,
+        slim_hoststore=hoststore if slim else None,
+        reproducible=reproducible,
+        minimal_core=minimal_core,
+    )
 
-    with tempfile.TemporaryDirectory() as tmpdir:
-        pyzfile = pathlib.Path(os.path.join(tmpdir, "progfiguration.pyz"))
-        progfigbuild.build_progfigsite_zipapp(sitepath, sitename, pyzfile)
+    with zipapps_ctx as node_pyz:
         for nname, node in nodes.items():
-            remotebrute.scp(f"{node.user}@{node.address}", pyzfile.as_posix(), remotepath)
+            remotebrute.scp(f"{node.user}@{node.address}", node_pyz[nname].as_posix(), remotepath)
 
 
 def _action_validate(progfigsite_modname: str):
@@ -322,6 +570,18 @@ def _make_parser():
         help="Log level to send to syslog. Defaults to INFO if /dev/log exists, otherwise NONE. NONE to disable. If a value other than NONE is passed explicitly and /dev/log does not exist, an exception will be raised.",
     )
 
+    parser.add_argument(
+        "--trace",
+        type=pathlib.Path,
+        help="Save a trace of every command, role, and secret decryption to this file, in Chrome trace event JSON format. Open it in a trace viewer like https://ui.perfetto.dev to see where the time went.",
+    )
+
+    parser.add_argument(
+        "--trace-memory",
+        action="store_true",
+        help="Trace memory allocations with tracemalloc, and after loading the site, instantiating the roles for a node, and applying each role, print the memory in use, the peak, and the lines of code that allocated the most to stderr. This makes progfiguration much slower.",
+    )
+
     parser.add_argument(
         "--secret-store-arguments",
         type=CommaSeparatedDict,
@@ -378,6 +638,37 @@ def _make_parser():
     sub_apply.add_argument(
         "--force-apply", action="store_true", help="Force apply, even if the node has TESTING_DO_NOT_APPLY set."
     )
+    sub_apply.add_argument(
+        "--profile",
+        type=pathlib.Path,
+        metavar="DIR",
+        help="Profile instantiating and applying each role with cProfile, save a ROLE.pstats file for each role to DIR, and print a table of the wall, CPU, and subprocess time for each role at the end. Roles are applied one at a time, so this cannot be combined with --parallel-roles.",
+    )
+    sub_apply.add_argument(
+        "--parallel-roles",
+        type=int,
+        default=1,
+        help="Apply up to this many roles at once, each as soon as the roles it depends on have been applied. Output is shown in the same order as when applying one role at a time. Defaults to 1 (apply one role at a time).",
+    )
+    sub_apply.add_argument(
+        "--lazy-secrets",
+        action="store_true",
+        help="Only decrypt a role's secrets when the role reads them, instead of when it is instantiated. Roles can list arguments to decrypt up front in their eager_arguments. Requires a host store with a lazy_secrets attribute, like MemoryHostStore.",
+    )
+    sub_apply.add_argument(
+        "--skip-unchanged",
+        nargs="?",
+        const="/var/lib/progfiguration/role-fingerprints.json",
+        default=None,
+        type=pathlib.Path,
+        metavar="STATEFILE",
+        help="Skip roles whose code, resolved arguments, and progfiguration version haven't changed since they were last applied successfully, as recorded in STATEFILE. If passed without a value, use '%(const)s'.",
+    )
+    sub_apply.add_argument(
+        "--no-skip",
+        action="store_true",
+        help="With --skip-unchanged, apply every role anyway, and record their fingerprints for next time.",
+    )
 
     # deploy subcommand
     sub_deploy = subparsers.add_parser(
@@ -385,6 +676,31 @@ def _make_parser():
         parents=[node_opts],
         description="Deploy progfiguration to remote system in hoststore as a pyz package; requires passwordless SSH configured",
     )
+    sub_deploy.add_argument(
+        "--no-build-cache",
+        action="store_true",
+        help="Always build a new package, instead of reusing an identical package from a previous deploy.",
+    )
+    sub_deploy.add_argument(
+        "--bytecode",
+        action="store_true",
+        help="Compile bytecode into the package so nodes don't have to compile modules on every run. Builds one package per Python interpreter configured for the nodes, compiled by the interpreter of the same name on this machine; nodes running a different Python version ignore the bytecode.",
+    )
+    sub_deploy.add_argument(
+        "--reproducible",
+        action="store_true",
+        help="Build a reproducible package, dated from SOURCE_DATE_EPOCH, that is byte-identical for identical inputs.",
+    )
+    sub_deploy.add_argument(
+        "--slim",
+        action="store_true",
+        help="Build one package per function, containing only the nodes, groups, roles, and secrets that nodes with that function need, instead of one package containing the whole site.",
+    )
+    sub_deploy.add_argument(
+        "--minimal-core",
+        action="store_true",
+        help="Include only the parts of progfiguration core that the site imports in the package. Core modules the site imports dynamically must be listed in the site's core_includes.",
+    )
     sub_deploy_subparsers = sub_deploy.add_subparsers(dest="deploy_action", required=True)
     sub_deploy_sub_apply = sub_deploy_subparsers.add_parser(
         "apply", parents=[roles_opts], description="Deploy and apply configuration"
@@ -400,6 +716,50 @@ def _make_parser():
     sub_deploy_sub_apply.add_argument(
         "--keep-remote-file", action="store_true", help="Don't delete the remote file after execution"
     )
+    sub_deploy_sub_apply.add_argument(
+        "--parallel",
+        "-p",
+        type=int,
+        default=1,
+        help="Deploy to up to this many nodes at once. Output from each node is prefixed with its name. Defaults to 1 (deploy to one node at a time).",
+    )
+    sub_deploy_sub_apply.add_argument(
+        "--parallel-roles",
+        type=int,
+        default=1,
+        help="Apply up to this many roles at once on each node. See 'apply --parallel-roles'. Defaults to 1.",
+    )
+    sub_deploy_sub_apply.add_argument(
+        "--no-ssh-multiplex",
+        action="store_true",
+        help="Don't share one ssh master connection per node between the copy, the command, and the cleanup. Try this if your ssh configuration does not support ControlMaster.",
+    )
+    sub_deploy_sub_apply.add_argument(
+        "--upload",
+        choices=["scp", "stdin"],
+        default="scp",
+        help="How to upload the package. 'scp' copies it with scp and then runs it over ssh with a tty. 'stdin' streams it over a single ssh session that saves, runs, and removes it, without a tty. Defaults to '%(default)s'.",
+    )
+    sub_deploy_sub_apply.add_argument(
+        "--remote-cache-dir",
+        nargs="?",
+        const="/var/cache/progfiguration",
+        default=None,
+        help="Keep packages in this directory on each node, named after their sha256 hash, and only upload a package if the node doesn't already have it. If passed without a value, use '%(const)s'. Implies --keep-remote-file. A cached package is only run if the remote user owns it and nobody else can write to it or the directory.",
+    )
+    sub_deploy_sub_apply.add_argument(
+        "--remote-cache-keep",
+        type=int,
+        default=5,
+        help="With --remote-cache-dir, keep this many packages on each node, removing the least recently used. Defaults to %(default)s.",
+    )
+    sub_deploy_sub_apply.add_argument(
+        "--remote-extract-dir",
+        nargs="?",
+        const="/var/cache/progfiguration/extracted",
+        default=None,
+        help="Build a package that extracts itself to a directory on the node named after its contents and runs from there, so that repeated runs of the same package import from the filesystem instead of the zipfile. If passed without a value, use '%(const)s'.",
+    )
     sub_deploy_sub_copy = sub_deploy_subparsers.add_parser(
         "copy", description="Copy the configuration to the remote system"
     )
@@ -421,6 +781,45 @@ def _make_parser():
         type=pathlib.Path,
         help="The output file for the zipapp",
     )
+    sub_zipapp.add_argument(
+        "--bytecode-python",
+        help="Compile bytecode into the zipapp with this Python interpreter, like 'python3.11'. Only nodes running the same Python version will use it.",
+    )
+    sub_zipapp.add_argument(
+        "--extract-dir",
+        help="Make the zipapp extract itself to a subdirectory of this directory and run from there, like '/var/cache/progfiguration/extracted'.",
+    )
+    sub_zipapp.add_argument(
+        "--reproducible",
+        action="store_true",
+        help="Build a reproducible zipapp, dated from SOURCE_DATE_EPOCH, that is byte-identical for identical inputs.",
+    )
+    sub_zipapp_slim = sub_zipapp.add_mutually_exclusive_group()
+    sub_zipapp_slim.add_argument(
+        "--slim-nodes",
+        type=CommaSeparatedStrList,
+        help="Build a slim zipapp containing only what these nodes need: a node, or list of nodes separated by commas.",
+    )
+    sub_zipapp_slim.add_argument(
+        "--slim-function",
+        help="Build a slim zipapp containing only what the nodes with this function need.",
+    )
+    sub_zipapp.add_argument(
+        "--minimal-core",
+        action="store_true",
+        help="Include only the parts of progfiguration core that the site imports in the zipapp.",
+    )
+    sub_zipapp.add_argument(
+        "--core-includes",
+        default=[],
+        type=CommaSeparatedStrList,
+        help="With --minimal-core, also include these core modules or packages, separated by commas, like 'progfiguration.ssh'.",
+    )
+    sub_zipapp.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Keep a manifest next to the output file, and on the next build reuse entries for files that haven't changed instead of writing the whole zipapp again.",
+    )
 
     # list subcommand
     sub_list = subparsers.add_parser("list", description="List hoststore items")
@@ -478,6 +877,12 @@ def _main_implementation(*arguments):
         sys.excepthook = syslog_excepthook
     configure_logging(parsed.log_stderr, parsed.log_syslog)
 
+    if parsed.trace:
+        # The trace is saved when the program exits
+        tracing.start_trace(parsed.trace, " ".join(["progfigsite"] + list(arguments[1:])))
+    if parsed.trace_memory:
+        memtrace.start_memory_trace()
+
     # Later actions do require a hoststore
 
     # Get a nodename, if we have one
@@ -486,10 +891,11 @@ def _main_implementation(*arguments):
     except AttributeError:
         nodename = None
 
-    progfigsitename, progfigsite = sitewrapper.get_progfigsite()
-    inventory = sitewrapper.site_submodule("inventory")
+    with tracing.span("load site", "site"), memtrace.phase("load site"):
+        progfigsitename, progfigsite = sitewrapper.get_progfigsite()
+        inventory = sitewrapper.site_submodule("inventory")
+        validation = validate(progfigsitename)
 
-    validation = validate(progfigsitename)
     if not validation.is_valid:
         print(f"Progfigsite (Python path: '{progfigsitename}') has {len(validation.errors)} errors:")
         for attrib in validation.errors:
@@ -506,11 +912,39 @@ def _main_implementation(*arguments):
         else:
             _action_version_all()
     elif parsed.action == "apply":
-        _action_apply(hoststore, secretstore, nodename, roles=parsed.roles, force=parsed.force_apply)
+        if parsed.parallel_roles < 1:
+            parser.error("--parallel-roles must be at least 1")
+        if parsed.profile and parsed.parallel_roles > 1:
+            # cProfile can only profile one thread at a time on newer Pythons,
+            # and CPU and subprocess times are for the whole process, so they would include other roles
+            parser.error("--profile cannot be combined with --parallel-roles greater than 1")
+        if parsed.no_skip and not parsed.skip_unchanged:
+            parser.error("--no-skip requires --skip-unchanged")
+        if parsed.lazy_secrets:
+            if not hasattr(hoststore, "lazy_secrets"):
+                parser.error(f"--lazy-secrets is not supported by the site's host store {type(hoststore).__name__}")
+            hoststore.lazy_secrets = True
+        _action_apply(
+            hoststore,
+            secretstore,
+            nodename,
+            roles=parsed.roles,
+            force=parsed.force_apply,
+            profile_dir=parsed.profile,
+            parallel=parsed.parallel_roles,
+            state_file=parsed.skip_unchanged,
+            no_skip=parsed.no_skip,
+        )
     elif parsed.action == "deploy":
         if not parsed.nodes and not parsed.groups:
             parser.error("You must pass at least one of --nodes or --groups")
         if parsed.deploy_action == "apply":
+            if parsed.parallel < 1:
+                parser.error("--parallel must be at least 1")
+            if parsed.remote_cache_keep < 1:
+                parser.error("--remote-cache-keep must be at least 1")
+            if parsed.parallel_roles < 1:
+                parser.error("--parallel-roles must be at least 1")
             _action_deploy_apply(
                 hoststore,
                 parsed.nodes,
@@ -519,14 +953,52 @@ def _main_implementation(*arguments):
                 remote_debug=parsed.remote_debug,
                 force_apply=parsed.force_apply,
                 keep_remote_file=parsed.keep_remote_file,
+                parallel=parsed.parallel,
+                ssh_multiplex=not parsed.no_ssh_multiplex,
+                upload=parsed.upload,
+                remote_cache_dir=parsed.remote_cache_dir,
+                remote_cache_keep=parsed.remote_cache_keep,
+                build_cache=not parsed.no_build_cache,
+                bytecode=parsed.bytecode,
+                remote_extract_dir=parsed.remote_extract_dir,
+                reproducible=parsed.reproducible,
+                slim=parsed.slim,
+                minimal_core=parsed.minimal_core,
+                parallel_roles=parsed.parallel_roles,
             )
         elif parsed.deploy_action == "copy":
-            _action_deploy_copy(hoststore, parsed.nodes, parsed.groups, parsed.destination)
+            _action_deploy_copy(
+                hoststore,
+                parsed.nodes,
+                parsed.groups,
+                parsed.destination,
+                build_cache=not parsed.no_build_cache,
+                bytecode=parsed.bytecode,
+                reproducible=parsed.reproducible,
+                slim=parsed.slim,
+                minimal_core=parsed.minimal_core,
+            )
             print(f"Copied to remote host(s) at {parsed.destination}")
         else:
             parser.error(f"Unknown deploy action {parsed.deploy_action}")
     elif parsed.action == "zipapp":
-        progfigbuild.build_progfigsite_zipapp(sitewrapper.get_progfigsite_path(), progfigsitename, parsed.output)
+        target = None
+        if parsed.slim_nodes:
+            target = progfigbuild.ZipappTarget.for_nodes(hoststore, parsed.slim_nodes)
+        elif parsed.slim_function:
+            target = progfigbuild.ZipappTarget.for_function(hoststore, parsed.slim_function)
+        progfigbuild.build_progfigsite_zipapp(
+            sitewrapper.get_progfigsite_path(),
+            progfigsitename,
+            parsed.output,
+            bytecode_python=parsed.bytecode_python,
+            extract_dir=parsed.extract_dir,
+            incremental=parsed.incremental,
+            reproducible=parsed.reproducible,
+            target=target,
+            minimal_core=parsed.minimal_core,
+            core_includes=parsed.core_includes,
+        )
     elif parsed.action == "list":
         _action_list(hoststore, parsed.collection)
     elif parsed.action == "info":
@@ -1,11 +1,25 @@
 """Command execution"""
 
+import asyncio
+import codecs
+import collections
 import io
-import select
+import locale
+import os
+import selectors
 import subprocess
 import sys
+import tempfile
+from typing import IO, Any, List, Optional, Tuple
 
-from progfiguration import logger
+from progfiguration import logger, tracing
+
+MAGICRUN_CHUNK_SIZE = 64 * 1024
+"""The maximum number of bytes magicrun reads from a command's stdout or stderr at once
+
+This is the size of a pipe buffer on Linux,
+so a command that fills its pipe can be drained in a single read.
+"""
 
 
 class MagicPopen(subprocess.Popen):
@@ -13,7 +27,9 @@ class MagicPopen(subprocess.Popen):
 
     This is a wrapper for subprocess.Popen,
     which is guaranteed to have a .stdout and .stderr property,
-    which will always be StringIO objects (not bytes).
+    which will be StringIO objects (not bytes) by default,
+    or other file objects depending on the capture options passed to magicrun().
+    They are always readable from the beginning.
 
     It's the return value for magicrun(),
     and shouldn't be used elsewhere.
@@ -22,8 +38,278 @@ class MagicPopen(subprocess.Popen):
     stdout: io.StringIO
     stderr: io.StringIO
 
+    stdout_omitted: int
+    """The number of bytes or characters of stdout dropped by magicrun(capture_head=..., capture_tail=...)
+
+    Zero if nothing was dropped.
+    """
+
+    stderr_omitted: int
+    """The number of bytes or characters of stderr dropped by magicrun(capture_head=..., capture_tail=...)
+
+    Zero if nothing was dropped.
+    """
+
+
+class AsyncMagicProcess(asyncio.subprocess.Process):
+    """An asyncio.subprocess.Process with the same superpowers as `MagicPopen`
+
+    It's the return value for amagicrun(),
+    and shouldn't be used elsewhere.
+    """
+
+    stdout: io.StringIO  # type: ignore
+    stderr: io.StringIO  # type: ignore
+
+    stdout_omitted: int
+    """Like `MagicPopen.stdout_omitted`"""
+
+    stderr_omitted: int
+    """Like `MagicPopen.stderr_omitted`"""
+
+
+class _MagicCapture:
+    """Captured output from one of a command's streams
+
+    By default, everything is kept in a StringIO (or a BytesIO if binary).
+    If max_memory is set, output is kept in a tempfile.SpooledTemporaryFile,
+    which is moved to a file on disk once it grows past max_memory.
+    If head or tail are set, only the first head and last tail bytes or characters are kept,
+    and the number of bytes or characters dropped between them is recorded in `omitted`.
+    """
+
+    def __init__(
+        self,
+        binary: bool = False,
+        max_memory: Optional[int] = None,
+        head: Optional[int] = None,
+        tail: Optional[int] = None,
+    ):
+        self.binary = binary
+        self.max_memory = max_memory
+        self.truncating = head is not None or tail is not None
+        self.head = head or 0
+        self.tail = tail or 0
+        self.size = 0
+        """The total number of bytes or characters written, including any that were dropped"""
+        self.omitted = 0
+        """The number of bytes or characters dropped between the head and the tail"""
+
+        self._empty: Any = b"" if binary else ""
+        self._head_chunks: list = []
+        self._head_len = 0
+        self._tail_chunks: collections.deque = collections.deque()
+        self._tail_len = 0
+        self._file: Optional[IO] = None if self.truncating else self._new_file()
+
+    def _new_file(self) -> IO:
+        if self.max_memory is None:
+            return io.BytesIO() if self.binary else io.StringIO()
+        if self.binary:
+            return tempfile.SpooledTemporaryFile(max_size=self.max_memory, mode="w+b")
+        # newline="" means newlines are written and read back unchanged, like StringIO.
+        # surrogatepass lets any str round trip, even one decoded with errors="surrogateescape".
+        return tempfile.SpooledTemporaryFile(
+            max_size=self.max_memory, mode="w+", encoding="utf-8", errors="surrogatepass", newline=""
+        )
+
+    def write(self, data):
+        """Capture a chunk of output"""
+        self.size += len(data)
+        if self._file is not None:
+            self._file.write(data)
+            return
+        if self._head_len < self.head:
+            kept = data[: self.head - self._head_len]
+            self._head_chunks.append(kept)
+            self._head_len += len(kept)
+            data = data[len(kept) :]
+        if data and self.tail:
+            self._tail_chunks.append(data)
+            self._tail_len += len(data)
+            # Drop whole chunks from the front while the rest is still long enough
+            while self._tail_len - len(self._tail_chunks[0]) >= self.tail:
+                self._tail_len -= len(self._tail_chunks.popleft())
+
+    def finish(self) -> IO:
+        """Return a file object with the captured output, positioned at the beginning"""
+        if self._file is None:
+            head = self._empty.join(self._head_chunks)
+            tail = self._empty.join(self._tail_chunks)[-self.tail :] if self.tail else self._empty
+            self.omitted = self.size - len(head) - len(tail)
+            self._file = self._new_file()
+            self._file.write(head)
+            self._file.write(tail)
+        self._file.seek(0)
+        return self._file
+
+
+def _command_name(cmd: str | list) -> str:
+    """The name of the program a command runs, like "curl" for ["/usr/bin/curl", "-O", "..."]"""
+    words = cmd.split() if isinstance(cmd, str) else cmd
+    return os.path.basename(str(words[0])) if words else ""
+
+
+def _prefix_lines(text: str, prefix: str, at_line_start: bool) -> Tuple[str, bool]:
+    """Prepend a prefix to each line in a chunk of output
+
+    :param text: A chunk of output, which may start or end in the middle of a line.
+    :param prefix: The prefix to prepend to each line.
+    :param at_line_start: Whether the previous chunk ended at the end of a line.
+
+    :return: A tuple of the prefixed text, and whether this chunk ended at the end of a line,
+        to pass as at_line_start for the next chunk.
+    """
+    result = []
+    # Iterating over a StringIO splits on newlines only, keeping the newline at the end of each line
+    for line in io.StringIO(text):
+        if at_line_start:
+            result.append(prefix)
+        result.append(line)
+        at_line_start = line.endswith("\n")
+    return ("".join(result), at_line_start)
+
+
+class _MagicStream:
+    """One of a command's output streams, as magicrun() reads it
+
+    Each chunk of output is captured, and printed to the terminal if print_output is True.
+    The decoder is incremental, so a multibyte character split across two chunks is decoded correctly,
+    and translates newlines the same way universal_newlines=True does.
+    """
+
+    def __init__(
+        self,
+        capture: _MagicCapture,
+        terminal: IO[str],
+        encoding: str,
+        errors: str,
+        print_output: bool,
+        output_prefix: str,
+    ):
+        self.capture = capture
+        self.terminal = terminal
+        self.decoder = io.IncrementalNewlineDecoder(codecs.getincrementaldecoder(encoding)(errors), translate=True)
+        self.print_output = print_output
+        self.output_prefix = output_prefix
+        self.at_line_start = True
+        """Whether the last output we printed ended a line (for output_prefix)"""
+        self.bytes_read = 0
+        """The number of bytes read from the stream"""
+
+    def handle(self, data: bytes, final: bool = False):
+        """Capture and print a chunk of output
+
+        Pass final=True when the stream is closed,
+        to flush the decoder in case the output ended with an incomplete character or a "\\r".
+        """
+        self.bytes_read += len(data)
+        if self.capture.binary and data:
+            self.capture.write(data)
+        # When capturing bytes, we only decode output to print it
+        if self.capture.binary and not self.print_output:
+            return
+        text = self.decoder.decode(data, final=final)
+        if not text:
+            return
+        if not self.capture.binary:
+            self.capture.write(text)
+        if self.print_output:
+            printed, self.at_line_start = _prefix_lines(text, self.output_prefix, self.at_line_start)
+            self.terminal.write(printed)
+            # Flush so that partial lines, like progress bars and prompts, are shown right away
+            self.terminal.flush()
+
+
+def _magicrun_prepare(
+    cmd: str | list,
+    print_output: bool,
+    output_prefix: str,
+    capture_bytes: bool,
+    capture_max_memory: Optional[int],
+    capture_head: Optional[int],
+    capture_tail: Optional[int],
+    kwargs: dict,
+) -> Tuple[_MagicStream, _MagicStream]:
+    """Log a command and set up its output streams, for magicrun() and amagicrun()
+
+    Removes the encoding and errors arguments from kwargs, because we decode output ourselves.
+    """
+    msg = f"Running command: {cmd}"
+    if kwargs.get("cwd"):
+        msg += f" from directory {kwargs['cwd']}"
+    logger.debug(msg)
+
+    encoding = kwargs.pop("encoding", None) or locale.getpreferredencoding(False)
+    errors = kwargs.pop("errors", None) or "strict"
+    # When capturing bytes, we only decode output to print it,
+    # so we shouldn't fail on output that isn't valid text.
+    if capture_bytes:
+        errors = "replace"
+
+    streams = []
+    for terminal in [sys.stdout, sys.stderr]:
+        capture = _MagicCapture(capture_bytes, capture_max_memory, capture_head, capture_tail)
+        streams.append(_MagicStream(capture, terminal, encoding, errors, print_output, output_prefix))
+    return (streams[0], streams[1])
+
+
+def _magicrun_trace_result(
+    tracespan: tracing.TraceSpan, process: Any, stdoutstream: _MagicStream, stderrstream: _MagicStream
+):
+    """Add the results of a finished command to its trace span"""
+    tracespan.args["pid"] = process.pid
+    tracespan.args["returncode"] = process.returncode
+    tracespan.args["stdout_bytes"] = stdoutstream.bytes_read
+    tracespan.args["stderr_bytes"] = stderrstream.bytes_read
+
+
+def _magicrun_finish(
+    process: Any,
+    cmd: str | list,
+    stdoutstream: _MagicStream,
+    stderrstream: _MagicStream,
+    check: bool,
+    log_output: bool,
+):
+    """Set the captured output on a finished process, and check and log the result, for magicrun() and amagicrun()"""
+    process.stdout = stdoutstream.capture.finish()
+    process.stdout_omitted = stdoutstream.capture.omitted
+    process.stderr = stderrstream.capture.finish()
+    process.stderr_omitted = stderrstream.capture.omitted
+
+    if check and process.returncode != 0:
+        msg = f"Command failed with exit code {process.returncode}: {cmd}"
+        logger.error(msg)
+        # logger.info(f"stdout: {process.stdout.getvalue()}")
+        # logger.info(f"stderr: {process.stderr.getvalue()}")
+        raise Exception(msg)
 
-def magicrun(cmd: str | list, print_output=True, log_output=False, check=True, *args, **kwargs) -> MagicPopen:
+    logger.info(f"Command completed with return code {process.returncode}: {cmd}")
+
+    # The user may have already seen the output in std out/err,
+    # but logging it here also logs it to syslog (if configured).
+    if log_output:
+        # Read the whole buffer and seek back to the beginning,
+        # because .getvalue() isn't available on the temporary files used by capture_max_memory.
+        for name, buf in [("stdout", process.stdout), ("stderr", process.stderr)]:
+            logger.info(f"{name}: {buf.read()}")
+            buf.seek(0)
+
+
+def magicrun(
+    cmd: str | list,
+    print_output=True,
+    log_output=False,
+    check=True,
+    *args,
+    output_prefix: str = "",
+    capture_bytes: bool = False,
+    capture_max_memory: Optional[int] = None,
+    capture_head: Optional[int] = None,
+    capture_tail: Optional[int] = None,
+    **kwargs,
+) -> MagicPopen:
     """Run a command, with superpowers
 
     Params:
@@ -31,134 +317,268 @@ def magicrun(cmd: str | list, print_output=True, log_output=False, check=True, *
     * `cmd`: The command to run. If a string, it will be passed to a shell.
     * `print_output`: Print the command's stdout/stderr in to the controlling terminal's stdout/stderr in real time.
         stdout/stderr is always captured and returned, whether this is True or False (superpowers).
-        The .stdout and .stderr properties are always strings, not bytes
-        (which is required because we must use universal_newlines=True).
+        The .stdout and .stderr properties are StringIO objects by default;
+        see the capture arguments below for other options.
+        Output is read in chunks as soon as it is available, not line by line,
+        so partial lines like progress bars and prompts are printed immediately.
         * <https://gist.github.com/nawatts/e2cdca610463200c12eac2a14efc0bfb>
         * <https://stackoverflow.com/questions/4417546/constantly-print-subprocess-output-while-process-is-running>
     * `log_output`: Log the command's stdout/stderr in a single log message (each) after the command completes.
+    * `output_prefix`: A string to prepend to each line printed to the terminal when `print_output` is True,
+        like "[node1] ".
+        Useful when several commands run at once and their output is interleaved.
+        The captured stdout/stderr are not prefixed.
     * `check`: Raise an exception if the command returns a non-zero exit code.
         Unlike subprocess.run, this is True by default.
+    * `capture_bytes`: Capture stdout/stderr as bytes, without decoding them or translating newlines.
+        .stdout and .stderr will be BytesIO objects (or binary temporary files, see `capture_max_memory`).
+        Use this for commands with binary output.
+        Output printed to the terminal is still decoded, replacing anything that can't be decoded.
+    * `capture_max_memory`: Keep at most this many bytes (or characters) of stdout/stderr in memory each.
+        Output beyond this is spilled to a temporary file,
+        and .stdout and .stderr will be tempfile.SpooledTemporaryFile objects.
+        They don't have a .getvalue() method; use .read() instead.
+    * `capture_head`, `capture_tail`: Keep only the first capture_head and the last capture_tail
+        bytes (or characters) of stdout/stderr each, and drop the rest.
+        If only one of them is set, the other is 0.
+        .stdout and .stderr contain the head followed by the tail, with nothing in between,
+        and .stdout_omitted and .stderr_omitted on the result are the number of bytes or characters dropped.
+        Use this for very chatty commands when only the beginning or end of the output is useful.
+        This doesn't affect what is printed with `print_output`.
     * `*args, **kwargs`: Passed to subprocess.Popen
         Do not pass the following arguments, as they are used internally:
         * shell: Determined automatically based on the type of cmd
         * stdout: Always subprocess.PIPE
         * stderr: Always subprocess.PIPE
-        * universal_newlines: Always True
-        * bufsize: Always 1
+        * universal_newlines, text: We always decode output ourselves
+        * bufsize: Always 0
+        The `encoding` and `errors` arguments are used to decode the output,
+        and default to the locale encoding and "strict" like they do for subprocess.Popen.
+        Newlines are translated to "\\n" like they are for universal_newlines=True.
 
     A `MagicPopen` object is always returned.
     """
     shell = isinstance(cmd, str)
+    stdoutstream, stderrstream = _magicrun_prepare(
+        cmd, print_output, output_prefix, capture_bytes, capture_max_memory, capture_head, capture_tail, kwargs
+    )
 
-    msg = f"Running command: {cmd}"
-    if kwargs.get("cwd"):
-        msg += f" from directory {kwargs['cwd']}"
-    logger.debug(msg)
+    with tracing.span(_command_name(cmd), "cmd", cmd=cmd) as tracespan:
+        # ignore mypy errors because *args and **kwargs confuses it
+        process = subprocess.Popen(  # type: ignore
+            cmd,
+            shell=shell,
+            bufsize=0,  # Unbuffered, so that select() and os.read() see the same data
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            *args,
+            **kwargs,
+        )
 
-    # ignore mypy errors because *args and **kwargs confuses it
-    process = subprocess.Popen(  # type: ignore
-        cmd,
-        shell=shell,
-        bufsize=1,  # Output is line buffered, required to print output in real time
-        universal_newlines=True,  # Required for line buffering
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        *args,
-        **kwargs,
-    )
+        # Ignore mypy errors related to process.stdout/stderr being None.
+        # We know they're file objects because we set them to subprocess.PIPE.
+        streams = {
+            process.stdout.fileno(): stdoutstream,  # type: ignore
+            process.stderr.fileno(): stderrstream,  # type: ignore
+        }
 
-    stdoutbuf = io.StringIO()
-    stderrbuf = io.StringIO()
+        # Read whatever is available from either stream until both are closed.
+        # The pipes are non-blocking, so a read never waits for more output than is already there;
+        # a command that writes a partial line and then waits doesn't stall us.
+        with selectors.DefaultSelector() as selector:
+            for fileno in streams:
+                os.set_blocking(fileno, False)
+                selector.register(fileno, selectors.EVENT_READ)
+            while selector.get_map():
+                for key, _ in selector.select():
+                    try:
+                        data = os.read(key.fd, MAGICRUN_CHUNK_SIZE)
+                    except BlockingIOError:
+                        continue
+                    if data:
+                        streams[key.fd].handle(data)
+                    else:
+                        # An empty read means the command closed the stream (usually because it exited).
+                        # Flush the decoder in case the output ended with an incomplete character or a "\r".
+                        streams[key.fd].handle(b"", final=True)
+                        selector.unregister(key.fd)
 
-    # Ignore mypy errors related to stdout/stderrbuf not being file objects.
-    # We know they're file objects because we set them to subprocess.PIPE.
+        process.wait()
+        _magicrun_trace_result(tracespan, process, stdoutstream, stderrstream)
 
-    stdout_fileno = process.stdout.fileno()  # type: ignore
-    stderr_fileno = process.stderr.fileno()  # type: ignore
+        # We'd like to just seek(0) on the stdout/stderr buffers, but "underlying stream is not seekable",
+        # So we create new buffers above, write to them chunk by chunk, and replace the old ones with these.
+        process.stdout.close()  # type: ignore
+        process.stderr.close()  # type: ignore
+        _magicrun_finish(process, cmd, stdoutstream, stderrstream, check, log_output)
 
-    # This returns None until the process terminates
-    while process.poll() is None:
+    # Now that we've set stdout/err to readable file objects,
+    # we can return the Popen object as a MagicPopen object.
+    magic_process: MagicPopen = process
 
-        # select() waits until there is data to read (or an "exceptional case") on any of the streams
-        readready, writeready, exceptionready = select.select(
-            [process.stdout, process.stderr],
-            [],
-            [process.stdout, process.stderr],
-            0.5,
-        )
+    return magic_process
 
-        # Check if what is ready is a stream, and if so, which stream.
-        # Copy the stream to the buffer so we can use it,
-        # and print it to stdout/stderr in real time if print_output is True.
-        for stream in readready:
-            if stream.fileno() == stdout_fileno:
-                line = process.stdout.readline()  # type: ignore
-                stdoutbuf.write(line)
-                if print_output:
-                    sys.stdout.write(line)
-            elif stream.fileno() == stderr_fileno:
-                line = process.stderr.readline()  # type: ignore
-                stderrbuf.write(line)
-                if print_output:
-                    sys.stderr.write(line)
-            else:
-                raise Exception(f"Unknown file descriptor in select result. Fileno: {stream.fileno()}")
-
-        # If what is ready is an exceptional situation, blow up I guess;
-        # I haven't encountered this and this should probably do something more sophisticated.
-        for stream in exceptionready:
-            if stream.fileno() == stdout_fileno:
-                raise Exception("Exception on stdout")
-            elif stream.fileno() == stderr_fileno:
-                raise Exception("Exception on stderr")
-            else:
-                raise Exception(f"Unknown exception in select result. Fileno: {stream.fileno()}")
-
-    # Check for any remaining output after the process has exited.
-    # Without this, the last line of output may not be printed,
-    # if output is buffered (very normal)
-    # and the process doesn't explictly flush upon exit
-    # (also very normal, and will definitely happen if the process crashes or gets KILLed).
-    for stream in [process.stdout, process.stderr]:
-        for line in stream.readlines():
-            if stream.fileno() == stdout_fileno:
-                stdoutbuf.write(line)
-                if print_output:
-                    sys.stdout.write(line)
-            elif stream.fileno() == stderr_fileno:
-                stderrbuf.write(line)
-                if print_output:
-                    sys.stderr.write(line)
-
-    # We'd like to just seek(0) on the stdout/stderr buffers, but "underlying stream is not seekable",
-    # So we create new buffers above, write to them line by line, and replace the old ones with these.
-    process.stdout.close()  # type: ignore
-    stdoutbuf.seek(0)
-    process.stdout = stdoutbuf
-    process.stderr.close()  # type: ignore
-    stderrbuf.seek(0)
-    process.stderr = stderrbuf
 
-    if check and process.returncode != 0:
-        msg = f"Command failed with exit code {process.returncode}: {cmd}"
-        logger.error(msg)
-        # logger.info(f"stdout: {process.stdout.getvalue()}")
-        # logger.info(f"stderr: {process.stderr.getvalue()}")
-        raise Exception(msg)
+async def amagicrun(
+    cmd: str | list,
+    print_output=True,
+    log_output=False,
+    check=True,
+    *,
+    output_prefix: str = "",
+    capture_bytes: bool = False,
+    capture_max_memory: Optional[int] = None,
+    capture_head: Optional[int] = None,
+    capture_tail: Optional[int] = None,
+    **kwargs,
+) -> AsyncMagicProcess:
+    """Run a command in an asyncio event loop, with superpowers
 
-    logger.info(f"Command completed with return code {process.returncode}: {cmd}")
+    The asyncio version of `magicrun()`, which takes the same arguments,
+    except that extra positional arguments aren't allowed.
+    `**kwargs` are passed to asyncio.create_subprocess_exec() (or create_subprocess_shell() if cmd is a string),
+    which passes them on to subprocess.Popen.
 
-    # The user may have already seen the output in std out/err,
-    # but logging it here also logs it to syslog (if configured).
-    if log_output:
-        # Note that .getvalue() is not (always?) available on normal Popen stdout/stderr,
-        # but it is available on our StringIO objects.
-        # .getvalue() doesn't change the seek position.
-        logger.info(f"stdout: {process.stdout.getvalue()}")
-        logger.info(f"stderr: {process.stderr.getvalue()}")
+    Many commands can run at once in the same event loop with asyncio.gather(),
+    without a thread for each one.
+    If the coroutine is cancelled, the command is killed.
 
-    # Now that we've set stdout/err to StringIO objects,
-    # we can return the Popen object as a MagicPopen object.
-    magic_process: MagicPopen = process
+    An `AsyncMagicProcess` object is always returned.
+    """
+    stdoutstream, stderrstream = _magicrun_prepare(
+        cmd, print_output, output_prefix, capture_bytes, capture_max_memory, capture_head, capture_tail, kwargs
+    )
+
+    async def pump(reader: asyncio.StreamReader, stream: _MagicStream):
+        """Read a stream in chunks as soon as output is available, until it is closed"""
+        while True:
+            data = await reader.read(MAGICRUN_CHUNK_SIZE)
+            stream.handle(data, final=not data)
+            if not data:
+                return
+
+    with tracing.span(_command_name(cmd), "cmd", cmd=cmd) as tracespan:
+        if isinstance(cmd, str):
+            process = await asyncio.create_subprocess_shell(
+                cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, **kwargs
+            )
+        else:
+            process = await asyncio.create_subprocess_exec(
+                *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, **kwargs
+            )
+        # Commands running at the same time in one thread would overlap on the same row of the trace
+        tracespan.tid = process.pid
 
+        try:
+            # Ignore mypy errors related to process.stdout/stderr being None, like in magicrun().
+            await asyncio.gather(pump(process.stdout, stdoutstream), pump(process.stderr, stderrstream))  # type: ignore
+            await process.wait()
+        except BaseException:
+            # Don't leave the command running if we were cancelled
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            raise
+
+        _magicrun_trace_result(tracespan, process, stdoutstream, stderrstream)
+        _magicrun_finish(process, cmd, stdoutstream, stderrstream, check, log_output)
+
+    magic_process: AsyncMagicProcess = process  # type: ignore
     return magic_process
+
+
+class MagicrunManyError(Exception):
+    """One or more of the commands run by magicrun_many() failed
+
+    The message lists every failure.
+    """
+
+    def __init__(self, msg: str, results: List[Optional[AsyncMagicProcess]]):
+        super().__init__(msg)
+        self.results = results
+        """The results of all the commands, in order, with None for any command that couldn't be started"""
+
+
+def _magicrun_label(idx: int, cmd: str | list) -> str:
+    """A short label for a command run by magicrun_many(), like "2 curl" """
+    return f"{idx} {_command_name(cmd)}".strip()
+
+
+def magicrun_many(
+    cmds: List[str | list],
+    concurrency: int = 4,
+    print_output=True,
+    log_output=False,
+    check=True,
+    labels: Optional[List[str]] = None,
+    **kwargs,
+) -> List[AsyncMagicProcess]:
+    """Run several independent commands at once, with superpowers
+
+    Params:
+
+    * `cmds`: The commands to run, each one like the `cmd` argument to `magicrun()`.
+    * `concurrency`: The maximum number of commands to run at the same time.
+    * `print_output`, `log_output`: Like `magicrun()`.
+        Output from different commands is interleaved as it arrives,
+        and each line printed to the terminal is prefixed with the command's label, like "[2 curl] ".
+    * `check`: Raise a `MagicrunManyError` if any command returns a non-zero exit code.
+        Unlike `magicrun()`, every command is run to completion first,
+        so that the error lists all of the failures, not just the first one.
+    * `labels`: A label for each command, used in the output prefix and the error.
+        Defaults to the index of the command and the name of the program it runs.
+    * `**kwargs`: Passed to `amagicrun()` for every command,
+        including the capture arguments and anything for subprocess.Popen like `cwd` or `env`.
+
+    Return a list of `AsyncMagicProcess` objects, one for each command in the same order.
+    A command that can't be started at all (for instance, because the program doesn't exist)
+    raises a `MagicrunManyError` even if check is False, after the others have finished.
+
+    Commands run in an asyncio event loop with `amagicrun()`,
+    so this must not be called from inside a running event loop;
+    use `amagicrun()` with asyncio.gather() there instead.
+    """
+    if concurrency < 1:
+        raise ValueError("concurrency must be at least 1")
+    if labels is None:
+        labels = [_magicrun_label(idx, cmd) for idx, cmd in enumerate(cmds)]
+    elif len(labels) != len(cmds):
+        raise ValueError(f"Got {len(labels)} labels for {len(cmds)} commands")
+
+    async def run_all():
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def run_one(cmd: str | list, label: str):
+            async with semaphore:
+                return await amagicrun(cmd, print_output, log_output, False, output_prefix=f"[{label}] ", **kwargs)
+
+        return await asyncio.gather(*[run_one(cmd, label) for cmd, label in zip(cmds, labels)], return_exceptions=True)
+
+    outcomes = asyncio.run(run_all())
+
+    results: List[Optional[AsyncMagicProcess]] = []
+    failures: List[str] = []
+    for cmd, label, outcome in zip(cmds, labels, outcomes):
+        if isinstance(outcome, BaseException):
+            results.append(None)
+            failures.append(f"[{label}] Could not run command: {cmd}: {outcome}")
+            continue
+        results.append(outcome)
+        if check and outcome.returncode != 0:
+            failure = f"[{label}] Command failed with exit code {outcome.returncode}: {cmd}"
+            # Include the end of stderr, which usually says what went wrong
+            stderr = outcome.stderr.read()
+            outcome.stderr.seek(0)
+            if isinstance(stderr, bytes):
+                stderr = stderr.decode(errors="replace")
+            for line in stderr.rstrip().splitlines()[-3:]:
+                failure += f"\n    {line}"
+            failures.append(failure)
+
+    if failures:
+        msg = f"{len(failures)} of {len(cmds)} commands failed:\n" + "\n".join(failures)
+        logger.error(msg)
+        raise MagicrunManyError(msg, results)
+
+    logger.info(f"Finished running {len(cmds)} commands")
+    return results  # type: ignore
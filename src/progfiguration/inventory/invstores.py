@@ -6,7 +6,7 @@ Protocols for inventory stores (host stores and secret stores).
 from __future__ import annotations
 
 from types import ModuleType
-from typing import Any, Dict, List, Literal, Protocol, runtime_checkable
+from typing import Any, Callable, ContextManager, Dict, List, Literal, Optional, Protocol, runtime_checkable
 from progfiguration.inventory.nodes import InventoryNode
 
 from progfiguration.inventory.roles import ProgfigurationRole, RoleArgumentReference
@@ -134,8 +134,20 @@ class HostStore(Protocol):
         """
         raise NotImplementedError("node_role not implemented")
 
-    def node_role_list(self, nodename: str, secretstore: SecretStore) -> list[ProgfigurationRole]:
-        """A list of all instantiated roles for a given node
+    def node_role_list(
+        self,
+        nodename: str,
+        secretstore: SecretStore,
+        rolenames: Optional[List[str]] = None,
+        instantiating: Optional[Callable[[str], ContextManager[Any]]] = None,
+    ) -> list[ProgfigurationRole]:
+        """A list of instantiated roles for a given node
+
+        If rolenames is passed, only instantiate the node's roles that are in it
+        (and any roles their arguments reference),
+        so that applying a few roles doesn't decrypt the secrets of every role.
+        If instantiating is passed, instantiate each role inside the context manager
+        it returns for the role's name, like a profiler for that role.
 
         TODO: Deprecate this, it's just a wrapper around node_role anyway.
         """
@@ -0,0 +1,265 @@
+"""Applying a node's roles in dependency order
+
+Roles depend on the roles they take a `progfiguration.inventory.roles.RoleCalculationReference` to,
+and on the roles they list in their ``after`` class attribute.
+`role_order()` sorts roles so that each comes after its dependencies,
+and `apply_roles()` applies them in that order,
+either one at a time or several at once in a thread pool.
+
+When roles are applied in parallel,
+each role's output is held back until the roles before it in the order have finished,
+so the output is the same as if the roles had been applied one at a time.
+"""
+
+import concurrent.futures
+import contextlib
+import logging
+import sys
+import threading
+from typing import IO, TYPE_CHECKING, Callable, Dict, Iterator, List, Optional, Tuple
+
+from progfiguration.inventory.roles import RoleCalculationReference, RoleCycleError, role_argument_definitions
+
+if TYPE_CHECKING:
+    from progfiguration.inventory.invstores import HostStore
+
+
+def node_role_dependencies(
+    hoststore: "HostStore",
+    nodename: str,
+    rolenames: Optional[List[str]] = None,
+) -> Dict[str, List[str]]:
+    """Find the roles that each of a node's roles must be applied after
+
+    :param hoststore: The site's host store.
+    :param nodename: The name of the node.
+    :param rolenames: The roles to consider. Defaults to all the node's roles.
+
+    Returns a dict of `{rolename: [names of roles it depends on]}`.
+    Dependencies on roles that aren't in rolenames are left out,
+    because a role can reference the calculations of a role that the node doesn't apply.
+    """
+    if rolenames is None:
+        rolenames = hoststore.node_rolename_list(nodename)
+    node = hoststore.node(nodename).node
+    nodegroups = {groupname: hoststore.group(groupname) for groupname in hoststore.node_groups[nodename]}
+
+    dependencies = {}
+    for rolename in rolenames:
+        found = list(hoststore.role_module(rolename).Role.after)
+        for value in role_argument_definitions(node, nodegroups, rolename).values():
+            if isinstance(value, RoleCalculationReference):
+                found.append(value.role)
+        # dict.fromkeys() removes duplicates and keeps the order
+        dependencies[rolename] = [dep for dep in dict.fromkeys(found) if dep in rolenames and dep != rolename]
+    return dependencies
+
+
+def _find_cycle(remaining: List[str], dependencies: Dict[str, List[str]]) -> List[str]:
+    """Find a dependency cycle among roles that all have unapplied dependencies"""
+    path = [remaining[0]]
+    while True:
+        dependency = next(dep for dep in dependencies[path[-1]] if dep in remaining)
+        if dependency in path:
+            return path[path.index(dependency) :] + [dependency]
+        path.append(dependency)
+
+
+def role_order(rolenames: List[str], dependencies: Dict[str, List[str]]) -> List[str]:
+    """Sort roles so that each one comes after its dependencies
+
+    Roles are otherwise kept in the order they were passed in,
+    so roles without dependencies are applied in the order they are listed for the node's function.
+
+    Raises `RoleCycleError` if some roles depend on each other in a cycle.
+    """
+    remaining = list(rolenames)
+    deps = {rolename: [dep for dep in dependencies.get(rolename, []) if dep in rolenames] for rolename in rolenames}
+    done = set()
+    order = []
+    while remaining:
+        for rolename in remaining:
+            if all(dep in done for dep in deps[rolename]):
+                break
+        else:
+            cycle = _find_cycle(remaining, deps)
+            raise RoleCycleError(f"Roles depend on each other in a cycle: {' -> '.join(cycle)}")
+        remaining.remove(rolename)
+        done.add(rolename)
+        order.append(rolename)
+    return order
+
+
+class _RoleOutput:
+    """The output a role writes while roles are applied in parallel
+
+    Output is held back until the role is released,
+    and written straight to the terminal after that.
+    """
+
+    def __init__(self, lock: threading.Lock):
+        self.lock = lock
+        self.chunks: List[Tuple[IO[str], str]] = []
+        self.live = False
+
+    def write(self, stream: IO[str], text: str):
+        with self.lock:
+            if self.live:
+                stream.write(text)
+            else:
+                self.chunks.append((stream, text))
+
+    def release(self):
+        """Write the output held back so far, and write output directly from now on"""
+        with self.lock:
+            if self.live:
+                return
+            for stream, text in self.chunks:
+                stream.write(text)
+            for stream in {stream for stream, _ in self.chunks}:
+                stream.flush()
+            self.chunks = []
+            self.live = True
+
+
+class _OrderedStream:
+    """A wrapper for stdout or stderr that sends output from a role's thread to its `_RoleOutput`
+
+    Output from other threads is written directly.
+    """
+
+    def __init__(self, stream: IO[str], local: threading.local):
+        self._stream = stream
+        self._local = local
+
+    def write(self, text: str) -> int:
+        output: Optional[_RoleOutput] = getattr(self._local, "output", None)
+        if output is None:
+            return self._stream.write(text)
+        output.write(self._stream, text)
+        return len(text)
+
+    def flush(self):
+        output: Optional[_RoleOutput] = getattr(self._local, "output", None)
+        if output is None or output.live:
+            self._stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+@contextlib.contextmanager
+def _ordered_output() -> Iterator[threading.local]:
+    """Send output from role threads to their `_RoleOutput`
+
+    Replaces sys.stdout and sys.stderr, and the streams of log handlers that write to them,
+    with `_OrderedStream` wrappers, and puts them back afterwards.
+    Yields a thread local; set its ``output`` attribute to a `_RoleOutput` in each role's thread.
+    """
+    local = threading.local()
+    stdout, stderr = sys.stdout, sys.stderr
+    wrappers = {id(stdout): _OrderedStream(stdout, local), id(stderr): _OrderedStream(stderr, local)}
+    handlers = [
+        handler
+        for handler in logging.root.handlers
+        if isinstance(handler, logging.StreamHandler) and id(handler.stream) in wrappers
+    ]
+    sys.stdout, sys.stderr = wrappers[id(stdout)], wrappers[id(stderr)]
+    for handler in handlers:
+        handler.setStream(wrappers[id(handler.stream)])
+    try:
+        yield local
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+        for handler in handlers:
+            handler.setStream(handler.stream._stream)
+
+
+def apply_roles(
+    rolenames: List[str],
+    dependencies: Dict[str, List[str]],
+    apply: Callable[[str], None],
+    parallel: int = 1,
+):
+    """Apply roles in dependency order
+
+    :param rolenames: The roles to apply, in the order they are listed for the node's function.
+    :param dependencies: A dict of `{rolename: [names of roles it depends on]}`,
+        like from `node_role_dependencies()`.
+    :param apply: A function to apply a role, called with its name.
+    :param parallel: How many roles to apply at once.
+        If 1, apply roles one at a time in `role_order()`, in this thread.
+        If more, apply each role in a thread pool as soon as its dependencies have been applied.
+
+    When applying roles in parallel,
+    output from each role is written in `role_order()` order,
+    as if the roles had been applied one at a time.
+    The output of the first role in that order that hasn't finished is shown as it happens,
+    and the output of the roles after it is held back until it finishes.
+
+    If a role fails, no more roles are started,
+    and once the roles that are already running finish,
+    the exception from the first role to fail in `role_order()` order is raised.
+    """
+    order = role_order(rolenames, dependencies)
+
+    if parallel <= 1:
+        for rolename in order:
+            apply(rolename)
+        return
+
+    lock = threading.Lock()
+    outputs = {rolename: _RoleOutput(lock) for rolename in order}
+    finished = set()
+    failures: Dict[str, BaseException] = {}
+    released = 0
+
+    def release_finished():
+        """Release the output of roles in order, up to and including the first one that hasn't finished"""
+        nonlocal released
+        while released < len(order):
+            outputs[order[released]].release()
+            if order[released] not in finished:
+                break
+            released += 1
+
+    with _ordered_output() as local:
+
+        def run(rolename: str):
+            local.output = outputs[rolename]
+            try:
+                apply(rolename)
+            finally:
+                local.output = None
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=parallel) as executor:
+            pending = list(order)
+            running: Dict[concurrent.futures.Future, str] = {}
+            release_finished()
+            while pending or running:
+                # Stop starting new roles once one has failed
+                if failures:
+                    pending = []
+                for rolename in list(pending):
+                    if len(running) >= parallel:
+                        break
+                    if all(dep in finished for dep in dependencies.get(rolename, []) if dep in outputs):
+                        pending.remove(rolename)
+                        running[executor.submit(run, rolename)] = rolename
+                if not running:
+                    break
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    rolename = running.pop(future)
+                    exc = future.exception()
+                    if exc is not None:
+                        failures[rolename] = exc
+                    finished.add(rolename)
+                release_finished()
+
+        # Show the output of any roles that finished after a failure
+        for rolename in order[released:]:
+            outputs[rolename].release()
+
+    if failures:
+        raise next(failures[rolename] for rolename in order if rolename in failures)
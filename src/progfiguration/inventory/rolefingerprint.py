@@ -0,0 +1,217 @@
+"""Skipping roles that haven't changed since they were last applied
+
+A role's fingerprint is a hash of everything that determines what it does:
+the source and data files of its module,
+its resolved arguments,
+and the version of progfiguration core.
+After a role is applied successfully, its fingerprint is saved in a state file on the node,
+and the next apply can skip the role if its fingerprint is the same.
+
+Arguments are resolved before they are hashed,
+so a role is applied again when a secret or another role's calculation it refers to changes.
+Each argument is hashed separately and only the final hash is stored,
+so secrets are never written to the state file.
+
+This assumes roles only depend on their code and arguments.
+A role that checks the state of the system, like whether a service is running,
+should not be skipped; pass ``--no-skip`` to apply every role.
+"""
+
+import dataclasses
+import hashlib
+import importlib.metadata
+import inspect
+from importlib.abc import Traversable
+from importlib.resources import files as importlib_resources_files
+import json
+import os
+import pathlib
+import tempfile
+import threading
+from types import ModuleType
+from typing import Any, Dict, Iterator, Tuple
+
+from progfiguration import logger
+from progfiguration.inventory.roles import ProgfigurationRole
+
+_base_role_fields = {field.name for field in dataclasses.fields(ProgfigurationRole)}
+"""Fields every role has, which are not role arguments"""
+
+
+def core_version() -> str:
+    """The version of progfiguration core to include in role fingerprints
+
+    When progfiguration core is statically included in a site package, it has no version,
+    so return the site's version instead.
+    That version changes with every build, so roles are applied again after each new build is deployed.
+    """
+    try:
+        return importlib.metadata.version("progfiguration")
+    except importlib.metadata.PackageNotFoundError:
+        from progfiguration import sitewrapper
+
+        _, progfigsite = sitewrapper.get_progfigsite()
+        return f"site {progfigsite.get_version()}"
+
+
+def _walk(directory: Traversable, prefix: str = "") -> Iterator[Tuple[str, Traversable]]:
+    """Yield (relative path, Traversable) for each file under a directory, except bytecode"""
+    for child in directory.iterdir():
+        if child.name == "__pycache__" or child.name.endswith(".pyc"):
+            continue
+        relpath = f"{prefix}{child.name}"
+        if child.is_dir():
+            yield from _walk(child, f"{relpath}/")
+        else:
+            yield (relpath, child)
+
+
+def role_code_digest(module: ModuleType) -> str:
+    """Hash the source of a role module, and if it is a package, all of its data files"""
+    digest = hashlib.sha256()
+    if module.__spec__ and module.__spec__.submodule_search_locations is not None:
+        files = sorted(_walk(importlib_resources_files(module.__name__)), key=lambda item: item[0])
+        for relpath, traversable in files:
+            digest.update(relpath.encode() + b"\0")
+            digest.update(traversable.read_bytes() + b"\0")
+    else:
+        digest.update(_module_source(module))
+    return digest.hexdigest()
+
+
+def _module_source(module: ModuleType) -> bytes:
+    """The source of a module that isn't a package
+
+    Read it with the module's loader if we can, which works inside zipapps.
+    Otherwise, like for frozen modules, fall back to `inspect.getsource()`,
+    and if there is no source at all, return nothing,
+    since the module can then only change along with Python itself.
+    """
+    path = getattr(module, "__file__", None)
+    loader = getattr(module, "__loader__", None)
+    if path is not None and loader is not None and hasattr(loader, "get_data"):
+        # Zipapps with bytecode import from module.pyc, but we want the source
+        if path.endswith(".pyc"):
+            path = path[:-1]
+        return loader.get_data(path)
+    try:
+        return inspect.getsource(module).encode()
+    except (OSError, TypeError):
+        return b""
+
+
+def _canonical(value: Any) -> Any:
+    """Convert a role argument to something json.dumps() always serializes the same way
+
+    Objects we don't know about are represented by their repr(),
+    which might differ between runs (for instance if it includes an id()),
+    in which case the role is just never skipped.
+    """
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    if isinstance(value, bytes):
+        return {"bytes": hashlib.sha256(value).hexdigest()}
+    if isinstance(value, dict):
+        return {str(key): _canonical(val) for key, val in sorted(value.items(), key=lambda item: str(item[0]))}
+    if isinstance(value, (list, tuple)):
+        return [_canonical(val) for val in value]
+    if isinstance(value, (set, frozenset)):
+        return sorted((_canonical(val) for val in value), key=json.dumps)
+    if isinstance(value, pathlib.PurePath):
+        return value.as_posix()
+    if dataclasses.is_dataclass(value) and not isinstance(value, type):
+        return {field.name: _canonical(getattr(value, field.name)) for field in dataclasses.fields(value)}
+    return repr(value)
+
+
+def role_arguments_digest(role: ProgfigurationRole) -> str:
+    """Hash the resolved arguments of an instantiated role
+
+    Each argument is hashed on its own before the hashes are combined,
+    so that no argument, like a decrypted secret, is ever kept in the clear.
+    """
+    hashes = {}
+    for field in dataclasses.fields(role):
+        if field.name in _base_role_fields:
+            continue
+        serialized = json.dumps(_canonical(getattr(role, field.name)), sort_keys=True)
+        hashes[field.name] = hashlib.sha256(serialized.encode()).hexdigest()
+    return hashlib.sha256(json.dumps(hashes, sort_keys=True).encode()).hexdigest()
+
+
+def role_fingerprint(role: ProgfigurationRole, module: ModuleType, version: str) -> str:
+    """The fingerprint of an instantiated role
+
+    :param role: The instantiated role.
+    :param module: The role's module, from `HostStore.role_module()`.
+    :param version: The version of progfiguration core, from `core_version()`.
+    """
+    parts = {
+        "code": role_code_digest(module),
+        "arguments": role_arguments_digest(role),
+        "version": version,
+    }
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+
+class RoleStateFile:
+    """A file on the node that records the fingerprint of each role when it was last applied successfully
+
+    Fingerprints are only kept for one node,
+    so if the file was written for a different node, all roles are applied again.
+    Call `record()` after a role succeeds, `forget()` after it fails, and `save()` at the end of the run.
+    These methods are safe to call from several threads.
+    """
+
+    def __init__(self, path: pathlib.Path, nodename: str):
+        self.path = path
+        self.nodename = nodename
+        self.fingerprints: Dict[str, str] = {}
+        """A dict of `{rolename: fingerprint}`"""
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        try:
+            with self.path.open() as fp:
+                contents = json.load(fp)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as exc:
+            logger.warning(f"Ignoring unreadable role state file {self.path}: {exc}")
+            return
+        if contents.get("node") == self.nodename:
+            self.fingerprints = dict(contents.get("roles", {}))
+
+    def unchanged(self, rolename: str, fingerprint: str) -> bool:
+        """Whether a role was last applied successfully with the same fingerprint"""
+        with self._lock:
+            return self.fingerprints.get(rolename) == fingerprint
+
+    def record(self, rolename: str, fingerprint: str):
+        """Record the fingerprint of a role that was applied successfully"""
+        with self._lock:
+            self.fingerprints[rolename] = fingerprint
+
+    def forget(self, rolename: str):
+        """Forget the fingerprint of a role that failed
+
+        The failure might have left the node half-configured,
+        so the role must be applied again even if it is changed back to the last fingerprint that succeeded.
+        """
+        with self._lock:
+            self.fingerprints.pop(rolename, None)
+
+    def save(self):
+        """Save the state file, replacing it atomically so a crash can't leave it half-written"""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            contents = {"node": self.nodename, "roles": dict(sorted(self.fingerprints.items()))}
+        fd, tmppath = tempfile.mkstemp(dir=self.path.parent, prefix=f".{self.path.name}.")
+        try:
+            with os.fdopen(fd, "w") as fp:
+                json.dump(contents, fp, indent=2)
+            os.replace(tmppath, self.path)
+        except BaseException:
+            os.unlink(tmppath)
+            raise
@@ -10,14 +10,26 @@ from __future__ import annotations
 
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
+import functools
+import threading
 from importlib.abc import Traversable
 from importlib.resources import files as importlib_resources_files
 from types import ModuleType
-from typing import Any, Optional, Protocol, runtime_checkable
+from typing import Any, Callable, ClassVar, List, Optional, Protocol, Type, runtime_checkable
 from progfiguration.inventory.nodes import InventoryNode
 from progfiguration.localhost import LocalhostLinux
 
 
+class RoleCycleError(Exception):
+    """Roles that depend on each other in a cycle
+
+    Raised when roles can't be ordered because they depend on each other,
+    or when instantiating a role or getting its calculations would need the role itself.
+    """
+
+    pass
+
+
 @runtime_checkable
 class RoleArgumentReference(Protocol):
     """A special kind of role argument that is dereferenced at runtime.
@@ -57,7 +69,11 @@ class RoleArgumentReference(Protocol):
 class RoleCalculationReference(RoleArgumentReference):
     """A reference to a calculation from a role
 
-    This is used to allow roles to reference calculations from other roles
+    This is used to allow roles to reference calculations from other roles.
+    Host stores that have a ``node_role_calculations()`` method,
+    like `progfiguration.sitehelpers.memhosts.MemoryHostStore`, memoize each role's calculations,
+    so many references to the same role only call its calculations() once.
+    Otherwise, the role's calculations() is called for each reference.
     """
 
     role: str
@@ -69,7 +85,131 @@ class RoleCalculationReference(RoleArgumentReference):
         hoststore: "HostStore",  # noqa: F821 # type: ignore
         secretstore: "SecretStore",  # noqa: F821 # type: ignore
     ) -> Any:
-        return hoststore.node_role(secretstore, nodename, self.role).calculations()[self.calcname]
+        node_role_calculations = getattr(hoststore, "node_role_calculations", None)
+        if node_role_calculations is None:
+            return hoststore.node_role(secretstore, nodename, self.role).calculations()[self.calcname]
+        return node_role_calculations(secretstore, nodename, self.role)[self.calcname]
+
+
+class LazySecret:
+    """A proxy for a secret role argument that is only decrypted when it is first used
+
+    When secrets are dereferenced lazily,
+    `collect_role_arguments()` passes one of these to the role instead of the decrypted value.
+    Roles that are given one are instantiated from `lazy_argument_role_class()`,
+    so reading the argument from the role, like ``self.password``,
+    decrypts the secret and replaces the proxy with the value,
+    and role code sees a plain value and never needs to know about this class.
+
+    If the proxy is passed somewhere else first, like inside a dict,
+    it decrypts the secret the first time it is used
+    and behaves like the value for common operations like ``str()``, f-strings, ``==``, and ``+``,
+    and for attribute access like ``.encode()``.
+    Code that checks the type of its arguments, like ``file.write()`` or ``json.dumps()``,
+    needs ``str(proxy)`` or ``proxy.value``.
+
+    The secret is decrypted at most once, even if several threads use it at the same time.
+    Its repr() never includes the value.
+    """
+
+    __slots__ = ("name", "_dereference", "_value", "_lock")
+
+    def __init__(self, name: str, dereference: Callable[[], Any]):
+        self.name = name
+        """The name of the secret, for repr()"""
+        self._dereference: Optional[Callable[[], Any]] = dereference
+        self._value: Any = None
+        self._lock = threading.Lock()
+
+    @property
+    def resolved(self) -> bool:
+        """Whether the secret has been decrypted"""
+        return self._dereference is None
+
+    @property
+    def value(self) -> Any:
+        """The decrypted value, decrypting it if this is the first use"""
+        if self._dereference is not None:
+            with self._lock:
+                if self._dereference is not None:
+                    self._value = self._dereference()
+                    self._dereference = None
+        return self._value
+
+    def __repr__(self):
+        state = "decrypted" if self.resolved else "not decrypted"
+        return f"<LazySecret {self.name!r} ({state})>"
+
+    def __getattr__(self, name):
+        # Only called for names that aren't set on the proxy.
+        # Don't forward private and special names: copy and pickle look them up on new, empty proxies,
+        # whose missing _dereference would call __getattr__ again forever.
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.value, name)
+
+    def __str__(self):
+        return str(self.value)
+
+    def __format__(self, format_spec):
+        return format(self.value, format_spec)
+
+    def __bool__(self):
+        return bool(self.value)
+
+    def __len__(self):
+        return len(self.value)
+
+    def __iter__(self):
+        return iter(self.value)
+
+    def __contains__(self, item):
+        return item in self.value
+
+    def __getitem__(self, key):
+        return self.value[key]
+
+    def __eq__(self, other):
+        return self.value == (other.value if isinstance(other, LazySecret) else other)
+
+    def __hash__(self):
+        return hash(self.value)
+
+    def __add__(self, other):
+        return self.value + other
+
+    def __radd__(self, other):
+        return other + self.value
+
+    def __mod__(self, other):
+        return self.value % other
+
+
+class LiveCalculation:
+    """A role argument that reads another role's calculation each time it is used
+
+    `collect_role_arguments()` passes one of these to a role
+    instead of the value of a `RoleCalculationReference`.
+    Roles that are given one are instantiated from `lazy_argument_role_class()`,
+    so reading the argument from the role, like ``self.homedir``,
+    returns the current value of the calculation.
+    The host store memoizes calculations, so this is cheap,
+    and after the other role calls `ProgfigurationRole.invalidate_calculations()`,
+    the next read gets the new value.
+    """
+
+    __slots__ = ("_read",)
+
+    def __init__(self, read: Callable[[], Any]):
+        self._read = read
+
+    @property
+    def value(self) -> Any:
+        """The current value of the calculation"""
+        return self._read()
+
+    def __repr__(self):
+        return f"<LiveCalculation {self.value!r}>"
 
 
 @dataclass(kw_only=True)
@@ -98,6 +238,28 @@ class ProgfigurationRole(ABC):
       and return a calculation like {'homedir': '/home/username'}.
       The user may or may not have been created when it returns this data,
       and the path may or may not exist until the role actually runs.
+      Results are memoized by the host store;
+      if they depend on state that apply() changes, call invalidate_calculations() after changing it.
+
+    Role arguments that are secrets may be decrypted lazily, the first time they are read;
+    see `LazySecret`.
+    Role arguments that reference another role's calculations are read again each time they are used;
+    see `LiveCalculation`.
+
+    Optional class attributes:
+
+    * after: A list of names of roles that must be applied before this one,
+      if the node applies them too.
+      Roles that this role takes a `RoleCalculationReference` to are already applied before it,
+      so this is only needed for dependencies that don't pass any data,
+      like a role that installs a package that this role configures.
+      Set it without a type annotation, like ``after = ["packages"]``,
+      so that it doesn't become a dataclass field.
+    * eager_arguments: A list of names of arguments that are always decrypted when the role is instantiated,
+      even when secrets are decrypted lazily.
+      Use this for secrets that must be checked before any role is applied,
+      or that the role passes to code that can't use a `LazySecret`.
+      Like ``after``, set it without a type annotation.
     """
 
     # Note that you cannot override properties in a subclass of a dataclass.
@@ -107,6 +269,9 @@ class ProgfigurationRole(ABC):
     hoststore: "HostStore"  # noqa: F821 # type: ignore
     rolepkg: str
 
+    after: ClassVar[List[str]] = []
+    eager_arguments: ClassVar[List[str]] = []
+
     # This is just a cache
     _rolefiles: Optional[Any] = None
 
@@ -117,6 +282,19 @@ class ProgfigurationRole(ABC):
     def calculations(self):
         return {}
 
+    def invalidate_calculations(self):
+        """Forget the memoized results of this role's calculations()
+
+        Call this when something calculations() depends on changes,
+        so that roles that reference its calculations get the new results the next time they read them,
+        even if they were already instantiated.
+        Does nothing if the host store doesn't memoize calculations,
+        since then references call calculations() every time.
+        """
+        invalidate_role_calculations = getattr(self.hoststore, "invalidate_role_calculations", None)
+        if invalidate_role_calculations is not None:
+            invalidate_role_calculations(rolename=self.name)
+
     def role_file(self, filename: str) -> Traversable:
         """Get the path to a file in the role's package
 
@@ -127,6 +305,63 @@ class ProgfigurationRole(ABC):
         return self._rolefiles.joinpath(filename)
 
 
+def _lazy_argument_getattribute(self: ProgfigurationRole, name: str) -> Any:
+    """Decrypt lazy secrets the first time they're read and replace them with the value,
+    and read live calculations every time"""
+    value = object.__getattribute__(self, name)
+    if type(value) is LazySecret:
+        value = value.value
+        object.__setattr__(self, name, value)
+    elif type(value) is LiveCalculation:
+        value = value.value
+    return value
+
+
+def has_lazy_arguments(roleargs: dict[str, Any]) -> bool:
+    """Whether role arguments from `collect_role_arguments()` need `lazy_argument_role_class()`"""
+    return any(type(value) in (LazySecret, LiveCalculation) for value in roleargs.values())
+
+
+@functools.lru_cache(maxsize=None)
+def lazy_argument_role_class(role_cls: Type[ProgfigurationRole]) -> Type[ProgfigurationRole]:
+    """A subclass of a role class for roles that were given `LazySecret` or `LiveCalculation` arguments
+
+    Reading an argument from the subclass replaces a `LazySecret` with its decrypted value,
+    and reads the current value of a `LiveCalculation`.
+    That means running Python code for every attribute lookup,
+    so only roles that were actually given one of these are instantiated from it.
+    It has the same name as the role class, and instances are still instances of the role class.
+    """
+    namespace = {
+        "__getattribute__": _lazy_argument_getattribute,
+        "__module__": role_cls.__module__,
+        "__qualname__": role_cls.__qualname__,
+    }
+    # Create it with the role class's metaclass (ABCMeta), like a class statement would
+    metaclass: Callable[..., Type[ProgfigurationRole]] = type(role_cls)
+    return metaclass(role_cls.__name__, (role_cls,), namespace)
+
+
+def role_argument_definitions(node: InventoryNode, nodegroups: dict[str, ModuleType], rolename: str) -> dict[str, Any]:
+    """Find the arguments for a role defined in a node's groups and the node itself, without dereferencing them
+
+    Arguments from the node override arguments from its groups.
+    """
+    roleargs = {}
+
+    for groupname, gmod in nodegroups.items():
+        group_rolevars = gmod.group["roles"].get(rolename, {})
+        for key, value in group_rolevars.items():
+            roleargs[key] = value
+
+    # Apply any role arguments from the node itself
+    node_rolevars = node.roles.get(rolename, {})
+    for key, value in node_rolevars.items():
+        roleargs[key] = value
+
+    return roleargs
+
+
 def collect_role_arguments(
     hoststore: "HostStore",  # noqa: F821 # type: ignore
     secretstore: "SecretStore",  # noqa: F821 # type: ignore
@@ -134,6 +369,7 @@ def collect_role_arguments(
     node: InventoryNode,
     nodegroups: dict[str, ModuleType],
     rolename: str,
+    lazy_secrets: bool = False,
 ):
     """Collect all the arguments for a role
 
@@ -145,25 +381,34 @@ def collect_role_arguments(
     * Arguments from the node itself
 
     Dereference any arg refs.
+    Calculation references are dereferenced now, so that missing roles and reference cycles are found
+    when the role is instantiated, but are then passed as a `LiveCalculation`,
+    so the role sees new results after the referenced role invalidates its calculations.
+    If lazy_secrets is True, secret references are wrapped in a `LazySecret` instead,
+    so they are only decrypted if the role uses them,
+    except for the arguments listed in the role's ``eager_arguments``.
+    If `has_lazy_arguments()` is true for the result, instantiate the role from `lazy_argument_role_class()`.
     """
+    # invstores imports this module, so we can't import it at the top
+    from progfiguration.inventory.invstores import SecretReference
+
     groupmods = {}
     for groupname in hoststore.node_groups[nodename]:
         groupmods[groupname] = hoststore.group(groupname)
 
-    roleargs = {}
-
-    for groupname, gmod in nodegroups.items():
-        group_rolevars = gmod.group["roles"].get(rolename, {})
-        for key, value in group_rolevars.items():
-            roleargs[key] = value
+    roleargs = role_argument_definitions(node, nodegroups, rolename)
 
-    # Apply any role arguments from the node itself
-    node_rolevars = node.roles.get(rolename, {})
-    for key, value in node_rolevars.items():
-        roleargs[key] = value
+    eager = hoststore.role_module(rolename).Role.eager_arguments if lazy_secrets else []
 
     for key, value in roleargs.items():
-        if isinstance(value, RoleArgumentReference):
+        if lazy_secrets and isinstance(value, SecretReference) and key not in eager:
+            dereference = functools.partial(value.dereference, nodename, hoststore, secretstore)
+            roleargs[key] = LazySecret(getattr(value, "name", key), dereference)
+        elif isinstance(value, RoleCalculationReference):
+            dereference = functools.partial(value.dereference, nodename, hoststore, secretstore)
+            dereference()
+            roleargs[key] = LiveCalculation(dereference)
+        elif isinstance(value, RoleArgumentReference):
             roleargs[key] = value.dereference(nodename, hoststore, secretstore)
 
     return roleargs
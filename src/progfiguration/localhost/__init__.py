@@ -10,6 +10,7 @@ from typing import Any, Dict, List, Optional
 
 from progfiguration import temple
 from progfiguration.cmd import magicrun
+from progfiguration.localhost.filecache import FileCache
 from progfiguration.localhost.localusers import LocalhostUsers
 from progfiguration.progfigtypes import AnyPathOrStr, PathOrStr
 
@@ -17,7 +18,12 @@ from progfiguration.progfigtypes import AnyPathOrStr, PathOrStr
 class LocalhostLinux:
     """An interface to localhost running Linux.
 
-    Maintains a cache of files it has read before.
+    Maintains a cache of files it has read before,
+    which is checked against the file's inode, size, and modification time on every read,
+    so it doesn't return stale contents if a file is changed by another program.
+    Files written by this class are removed from the cache.
+    At most file_cache_bytes of files are cached, measured by their size on disk.
+    See `progfiguration.localhost.filecache` for details.
 
     Generally, roles should use the ``.localhost`` attribute of a
     `progfiguration.inventory.Inventory` object,
@@ -25,10 +31,10 @@ class LocalhostLinux:
     That said, nothing bad will happen with multiple instances of this class.
     """
 
-    def __init__(self, nodename="localhost"):
+    def __init__(self, nodename="localhost", file_cache_bytes: int = 8 * 1024 * 1024):
         self.nodename = nodename
         self.users = LocalhostUsers(self)
-        self._cache_files = {}
+        self._cache_files = FileCache(file_cache_bytes)
 
     @property
     def uptime(self) -> float:
@@ -63,15 +69,11 @@ class LocalhostLinux:
 
         path:       The path to retrieve
         chomp:      Remove leading/trailing whitespace
-        refresh:    Ignore cache if any
+        refresh:    Read the file even if its cached contents look current
         """
         if not isinstance(path, str):
             path = str(path)
-        if refresh or path not in self._cache_files:
-            with open(path) as fp:
-                contents = fp.read()
-        else:
-            contents = self._cache_files[path]
+        contents = self._cache_files.read(path, refresh=refresh)
         if chomp:
             return contents.strip()
         else:
@@ -107,10 +109,11 @@ class LocalhostLinux:
         if not isinstance(path, str):
             path = str(path)
         self.makedirs(os.path.dirname(path), owner, group, dirmode)
-        if path in self._cache_files:
-            del self._cache_files[path]
+        self._cache_files.invalidate(path)
         with open(path, "w") as fp:
             fp.write(contents)
+        # Another thread might have cached the file while we were writing it
+        self._cache_files.invalidate(path)
         self.chown(path, owner, group)
         if mode:
             os.chmod(path, mode)
@@ -159,8 +162,11 @@ class LocalhostLinux:
         if isinstance(dest, str):
             dest = Path(dest)
         self.makedirs(dest.parent, owner, group, dirmode)
+        if dest.is_dir():
+            self._cache_files.invalidate(dest.joinpath(src.name))
+        self._cache_files.invalidate(dest)
         if os.path.exists(str(src)):
-            shutil.copy(src, dest)
+            dest = Path(shutil.copy(src, dest))
         elif hasattr(src, "open"):
             if dest.is_dir():
                 dest = dest.joinpath(src.name)
@@ -169,6 +175,7 @@ class LocalhostLinux:
                     shutil.copyfileobj(srcfp, destfp)
         else:
             raise Exception(f"Not sure how to copy src (type: {type(src)}) at {src} (does it exist?)")
+        self._cache_files.invalidate(dest)
         self.chown(dest, owner, group)
         if mode:
             dest.chmod(mode)
@@ -261,7 +268,7 @@ class LocalhostLinux:
                 return
             else:
                 raise FileNotFoundError(f"File {file} does not exist and no owner/group specified to create it")
-        oldlines = self.get_file_contents(file, refresh=True).split("\n")
+        oldlines = self.get_file_contents(file).split("\n")
         newlines = oldlines.copy()
         for line in lines:
             if line not in oldlines:
@@ -293,6 +300,7 @@ class LocalhostLinux:
         if not file.parent.exists():
             self.makedirs(file.parent, owner, group, dirmode)
         file.touch(mode=mode, exist_ok=True)
+        self._cache_files.invalidate(file)
         self.chown(file, owner, group)
 
     def get_user_primary_group(self, user: str):
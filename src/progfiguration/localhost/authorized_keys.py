@@ -13,7 +13,7 @@ def get(localhost: LocalhostLinux, user: str) -> List[str]:
 
     authorized_keys_file = os.path.expanduser(f"~{user}/.ssh/authorized_keys")
     try:
-        authorized_keys = localhost.get_file_contents(authorized_keys_file, refresh=True)
+        authorized_keys = localhost.get_file_contents(authorized_keys_file)
         return authorized_keys.split("\n")
     except FileNotFoundError:
         return []
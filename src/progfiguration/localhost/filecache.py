@@ -0,0 +1,130 @@
+"""A cache of file contents, validated by stat()
+
+Used by `progfiguration.localhost.LocalhostLinux.get_file_contents()`,
+so that reading the same file many times during an apply costs a stat() instead of a read.
+
+Each entry records the inode, size, and modification time of the file when it was read,
+and is only used while the file still has the same ones.
+That catches changes made by other programs, like commands run with magicrun(),
+as long as they change the file's size or modification time.
+LocalhostLinux also invalidates entries itself whenever it writes a file.
+"""
+
+from collections import OrderedDict
+import os
+import stat
+import threading
+import time
+from typing import Optional, Tuple
+
+from progfiguration.progfigtypes import PathOrStr
+
+_StatKey = Tuple[int, int, int]
+"""A file's (st_ino, st_size, st_mtime_ns)"""
+
+
+class FileCache:
+    """A size-bounded LRU cache of text file contents, keyed by path and validated by stat()
+
+    When the total size of the cached files is more than max_bytes,
+    the least recently used entries are dropped.
+    Files bigger than max_bytes are never cached.
+    Sizes are the size of each file on disk, from stat().
+    All methods are safe to call from several threads.
+    """
+
+    racy_ns = 2_000_000_000
+    """Don't cache files modified this recently (in nanoseconds) before they were read
+
+    A file can be changed again within the granularity of its filesystem's timestamps
+    without changing its size or modification time,
+    so we can only trust the modification time of a file that hasn't changed for a little while.
+    This is the same trick git uses for its index.
+    """
+
+    uncached_prefixes = ("/proc/", "/sys/", "/dev/")
+    """Paths under these directories are never cached, because their contents change without their stat() changing"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        """The most to keep in the cache, in bytes"""
+
+        self.size = 0
+        """The total size of the cached files, in bytes"""
+
+        self.hits = 0
+        """How many reads were served from the cache"""
+
+        self.misses = 0
+        """How many reads had to read the file"""
+
+        self._entries: "OrderedDict[str, Tuple[_StatKey, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def read(self, path: PathOrStr, refresh: bool = False) -> str:
+        """Return the contents of a file, from the cache if it hasn't changed
+
+        If refresh is True, always read the file, and cache what was read.
+        Raises the same exceptions as open(), like FileNotFoundError.
+        """
+        path = os.path.abspath(path)
+        if path.startswith(self.uncached_prefixes):
+            return self._read(path)
+
+        st = os.stat(path)
+        key = (st.st_ino, st.st_size, st.st_mtime_ns)
+        if not refresh:
+            with self._lock:
+                entry = self._entries.get(path)
+                if entry is not None and entry[0] == key:
+                    self._entries.move_to_end(path)
+                    self.hits += 1
+                    return entry[1]
+
+        read_ns = time.time_ns()
+        contents = self._read(path)
+        with self._lock:
+            self.misses += 1
+            self._remove(path)
+            cacheable = (
+                stat.S_ISREG(st.st_mode) and st.st_size <= self.max_bytes and st.st_mtime_ns < read_ns - self.racy_ns
+            )
+            # The file might have changed between the stat() and the read, so check it again before caching
+            if cacheable and _stat_key(path) == key:
+                self._entries[path] = (key, contents)
+                self.size += st.st_size
+                while self.size > self.max_bytes:
+                    _, ((_, evicted_size, _), _) = self._entries.popitem(last=False)
+                    self.size -= evicted_size
+        return contents
+
+    def _read(self, path: str) -> str:
+        with open(path) as fp:
+            return fp.read()
+
+    def _remove(self, path: str):
+        """Remove an entry, if there is one; the caller must hold the lock"""
+        entry = self._entries.pop(path, None)
+        if entry is not None:
+            _, size, _ = entry[0]
+            self.size -= size
+
+    def invalidate(self, path: PathOrStr):
+        """Forget the contents of a file, because we are about to write it or just wrote it"""
+        path = os.path.abspath(path)
+        with self._lock:
+            self._remove(path)
+
+    def clear(self):
+        """Forget the contents of every file"""
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+def _stat_key(path: str) -> Optional[_StatKey]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
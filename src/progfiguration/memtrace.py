@@ -0,0 +1,176 @@
+"""Trace where memory goes during a progfiguration run
+
+When memory tracing is started with `start_memory_trace()`,
+`phase()` reports how much memory each step of the run allocated with the standard library tracemalloc module,
+like loading the site, instantiating the roles for a node, or applying a role.
+After each phase it prints the memory in use, the peak during the phase,
+and the lines of code that allocated the most memory during the phase and still hold it.
+
+Memory tracing is off by default,
+and `phase()` does very little when it is off.
+Tracing memory slows Python down noticeably, so only use it to look for memory problems.
+"""
+
+import contextlib
+from dataclasses import dataclass, field
+import sys
+import tracemalloc
+from typing import Iterator, List, Optional, TextIO
+
+
+def _format_size(size: int) -> str:
+    """Format a size in bytes for humans, like '1.5 MiB'"""
+    sign = "-" if size < 0 else ""
+    if abs(size) < 1024:
+        return f"{sign}{abs(size)} B"
+    scaled = abs(size) / 1024
+    for unit in ["KiB", "MiB"]:
+        if scaled < 1024:
+            break
+        scaled /= 1024
+    else:
+        unit = "GiB"
+    return f"{sign}{scaled:.1f} {unit}"
+
+
+@dataclass
+class MemoryPhase:
+    """The memory used by one phase of a run, yielded by `phase()`"""
+
+    name: str
+    """The name of the phase, like "load site" or "apply ROLE\""""
+
+    start: int = 0
+    """Memory traced when the phase started, in bytes"""
+
+    end: int = 0
+    """Memory traced when the phase ended, in bytes"""
+
+    peak: int = 0
+    """The most memory traced at any time during the phase, in bytes"""
+
+    top: List[tracemalloc.StatisticDiff] = field(default_factory=list)
+    """The lines of code whose allocations grew the most during the phase, largest first"""
+
+    def report(self) -> str:
+        """A report of the memory used by the phase and where it was allocated"""
+        growth = self.end - self.start
+        lines = [
+            f"Memory after {self.name}: {_format_size(self.end)} in use ({_format_size(growth)} during phase), peak {_format_size(self.peak)}"
+        ]
+        for stat in self.top:
+            frame = stat.traceback[0]
+            lines.append(
+                f"  {_format_size(stat.size_diff):>10} in {stat.count_diff:>6} blocks  {frame.filename}:{frame.lineno}"
+            )
+        return "\n".join(lines)
+
+
+class MemoryTracer:
+    """Measures phases of a run with tracemalloc and reports on them"""
+
+    def __init__(self, top: int = 10, output: Optional[TextIO] = None):
+        self.top = top
+        """How many allocation sites to report after each phase"""
+
+        self.output = output
+        """Where to print reports, or None for stderr
+
+        We don't print to stdout because commands like ``progfigsite version --site`` are meant to be parsed.
+        """
+
+        self.phases: List[MemoryPhase] = []
+        """Every phase that has finished, in the order they finished"""
+
+        self._peaks: List[int] = []
+        """The peak so far of each phase in progress, outermost first"""
+
+        self._filters = [
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        ]
+
+    def _snapshot(self) -> tracemalloc.Snapshot:
+        return tracemalloc.take_snapshot().filter_traces(self._filters)
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> Iterator[MemoryPhase]:
+        """Measure the memory used by the body of a with statement
+
+        Phases can be nested, like instantiating a role while loading a site.
+        tracemalloc only keeps one peak, so we save the peak of the outer phase before resetting it for the inner one,
+        and fold the inner peak back into the outer one when the inner phase ends.
+        """
+        result = MemoryPhase(name)
+        if self._peaks:
+            self._peaks[-1] = max(self._peaks[-1], tracemalloc.get_traced_memory()[1])
+        before = self._snapshot()
+        tracemalloc.reset_peak()
+        result.start = tracemalloc.get_traced_memory()[0]
+        self._peaks.append(result.start)
+        try:
+            yield result
+        finally:
+            result.end, peak = tracemalloc.get_traced_memory()
+            result.peak = max(self._peaks.pop(), peak)
+            if self._peaks:
+                self._peaks[-1] = max(self._peaks[-1], result.peak)
+            after = self._snapshot()
+            growth = [stat for stat in after.compare_to(before, "lineno") if stat.size_diff > 0]
+            result.top = growth[: self.top]
+            # Don't keep the snapshots around, they can be much bigger than what we're measuring
+            del before, after, growth
+            self.phases.append(result)
+            print(result.report(), file=self.output or sys.stderr)
+
+
+_memtracer: Optional[MemoryTracer] = None
+"""The active memory tracer, if memory tracing is on"""
+
+
+def start_memory_trace(top: int = 10, output: Optional[TextIO] = None):
+    """Start tracing memory allocations
+
+    :param top: How many allocation sites to report after each phase.
+    :param output: Where to print reports. Defaults to stderr.
+
+    Memory allocated before this is called is counted as in use, but not attributed to any allocation site.
+    """
+    global _memtracer
+    if _memtracer is not None:
+        raise RuntimeError("Already tracing memory")
+    tracemalloc.start()
+    _memtracer = MemoryTracer(top, output)
+
+
+def stop_memory_trace() -> List[MemoryPhase]:
+    """Stop tracing memory allocations, and return every phase that was measured"""
+    global _memtracer
+    if _memtracer is None:
+        return []
+    memtracer, _memtracer = _memtracer, None
+    tracemalloc.stop()
+    return memtracer.phases
+
+
+def tracing_memory() -> bool:
+    """Whether memory tracing is on"""
+    return _memtracer is not None
+
+
+@contextlib.contextmanager
+def phase(name: str) -> Iterator[Optional[MemoryPhase]]:
+    """Report the memory used by the body of a with statement, if memory tracing is on
+
+    :param name: The name of the phase, like "load site" or "apply ROLE".
+
+    Yields a `MemoryPhase` when memory tracing is on, which is filled in when the body finishes,
+    or None when it is off.
+    The phase is reported even if the body raises an exception.
+    """
+    memtracer = _memtracer
+    if memtracer is None:
+        yield None
+        return
+    with memtracer.phase(name) as result:
+        yield result
@@ -0,0 +1,104 @@
+"""Profile roles while applying them
+
+Used by ``progfigsite apply --profile DIR``.
+Each role's instantiation and apply() are profiled with cProfile,
+and the results are saved to one .pstats file per role,
+which can be read with the standard library pstats module or tools like snakeviz.
+We also measure the wall time, CPU time, and subprocess time for each role,
+to print a summary at the end of the run.
+"""
+
+import contextlib
+import cProfile
+from dataclasses import dataclass
+import os
+import pathlib
+import time
+from typing import Dict, Iterator, List
+
+
+def _children_time() -> float:
+    """The CPU time used by child processes that have exited and been waited for, in seconds"""
+    times = os.times()
+    return times.children_user + times.children_system
+
+
+@dataclass
+class RoleProfile:
+    """The time spent on one role"""
+
+    name: str
+    """The name of the role"""
+
+    wall: float = 0.0
+    """Wall clock time in seconds"""
+
+    cpu: float = 0.0
+    """CPU time used by this process in seconds"""
+
+    subprocess: float = 0.0
+    """CPU time used by commands the role ran in seconds"""
+
+
+class RoleProfiler:
+    """Profile instantiating and applying roles
+
+    Use `profile()` as a context manager around each step for a role,
+    then call `save()` to write the .pstats files and `table()` to summarize the results.
+    Profiling the same role more than once, like for its instantiation and then its apply(),
+    adds to the same profile.
+
+    Only profile one role at a time:
+    CPU and subprocess times are measured for the whole process,
+    and newer versions of Python only allow one cProfile profiler to be active at once.
+    """
+
+    def __init__(self, directory: pathlib.Path):
+        self.directory = directory
+        """The directory to save .pstats files to"""
+
+        self.profiles: Dict[str, RoleProfile] = {}
+        """A dict of {role name: RoleProfile}"""
+
+        self._profilers: Dict[str, cProfile.Profile] = {}
+
+    @contextlib.contextmanager
+    def profile(self, rolename: str) -> Iterator[RoleProfile]:
+        """Profile the body of a with statement as part of a role"""
+        result = self.profiles.setdefault(rolename, RoleProfile(rolename))
+        profiler = self._profilers.setdefault(rolename, cProfile.Profile())
+        wall, cpu, children = time.perf_counter(), time.process_time(), _children_time()
+        profiler.enable()
+        try:
+            yield result
+        finally:
+            profiler.disable()
+            result.wall += time.perf_counter() - wall
+            result.cpu += time.process_time() - cpu
+            result.subprocess += _children_time() - children
+
+    def save(self) -> List[pathlib.Path]:
+        """Save a .pstats file for each role, and return their paths"""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        paths = []
+        for rolename, profiler in self._profilers.items():
+            path = self.directory / f"{rolename}.pstats"
+            profiler.dump_stats(path)
+            paths.append(path)
+        return paths
+
+    def table(self) -> str:
+        """A table of the time spent on each role, slowest first"""
+        rows = sorted(self.profiles.values(), key=lambda p: p.wall, reverse=True)
+        width = max([len("Role")] + [len(row.name) for row in rows])
+        lines = [f"{'Role':<{width}}  {'Wall':>9}  {'CPU':>9}  {'Subprocess':>10}"]
+        for row in rows:
+            lines.append(f"{row.name:<{width}}  {row.wall:>8.3f}s  {row.cpu:>8.3f}s  {row.subprocess:>9.3f}s")
+        total = RoleProfile(
+            "Total",
+            sum(row.wall for row in rows),
+            sum(row.cpu for row in rows),
+            sum(row.subprocess for row in rows),
+        )
+        lines.append(f"{total.name:<{width}}  {total.wall:>8.3f}s  {total.cpu:>8.3f}s  {total.subprocess:>9.3f}s")
+        return "\n".join(lines)
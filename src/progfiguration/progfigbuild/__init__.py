@@ -1,17 +1,36 @@
 """Support for building pip and zipapp progfigsite packages"""
 
 from dataclasses import dataclass
-from datetime import datetime
+from datetime import datetime, timezone
+import contextlib
+import functools
+import hashlib
+import importlib.resources
+import json
+import os
 import pathlib
 import stat
+import subprocess
+import tempfile
 import textwrap
-from typing import List, Optional
+from typing import Dict, List, Optional, Set, Tuple
 import zipfile
 
 import progfiguration
 from progfiguration import logger
 from progfiguration import sitewrapper
+from progfiguration.progfigbuild import treeshake
+from progfiguration.progfigbuild.zipmanifest import (
+    ZipappManifest,
+    copy_raw_entry,
+    file_sha256,
+    scan_zipapp_files,
+    zipapp_manifest_path,
+)
+from progfiguration.inventory.invstores import HostStore
 from progfiguration.progfigtypes import PathOrStr
+from progfiguration.sitehelpers import siteversion
+from progfiguration.temple import Temple
 
 
 @dataclass
@@ -25,6 +44,63 @@ class InjectedFile:
     """The contents of the file."""
 
 
+@dataclass
+class ZipappTarget:
+    """The nodes that a slim zipapp is built for
+
+    A slim zipapp contains only the node, group, and role modules (and node and group secrets)
+    that these nodes need,
+    rather than those of every node in the site.
+    Everything else in the site package is included as usual.
+    """
+
+    nodes: List[str]
+    """The names of the nodes"""
+
+    groups: List[str]
+    """The names of all groups the nodes are members of"""
+
+    roles: List[str]
+    """The names of all roles the nodes apply"""
+
+    @classmethod
+    def for_nodes(cls, hoststore: HostStore, nodes: List[str]) -> "ZipappTarget":
+        """Find the groups and roles for a list of nodes in the hoststore"""
+        groups = {group for node in nodes for group in hoststore.node_groups[node]}
+        roles = {role for node in nodes for role in hoststore.node_rolename_list(node)}
+        return cls(nodes=sorted(nodes), groups=sorted(groups), roles=sorted(roles))
+
+    @classmethod
+    def for_function(cls, hoststore: HostStore, function: str) -> "ZipappTarget":
+        """Find all the nodes with a function in the hoststore, and their groups and roles"""
+        return cls.for_nodes(hoststore, hoststore.function_nodes[function])
+
+    def includes(self, site_relpath: pathlib.PurePosixPath, is_dir: bool = False) -> bool:
+        """Return True if a path relative to the site package belongs in the zipapp
+
+        Paths under nodes/, groups/, and roles/ that belong to other nodes, groups, or roles are excluded:
+        modules like nodes/NAME.py, secrets like nodes/NAME.secrets.json,
+        and package directories like roles/NAME/ and everything in them.
+        Anything else, including the __init__.py of those packages, is included.
+        """
+        parts = site_relpath.parts
+        if len(parts) < 2 or parts[0] not in ("nodes", "groups", "roles"):
+            return True
+        name = parts[1]
+        if len(parts) > 2 or is_dir:
+            entity = name
+        elif name.endswith(".secrets.json"):
+            entity = name[: -len(".secrets.json")]
+        elif name.endswith(".py"):
+            entity = name[: -len(".py")]
+        else:
+            return True
+        if entity == "__init__":
+            return True
+        allowed = {"nodes": self.nodes, "groups": self.groups, "roles": self.roles}[parts[0]]
+        return entity in allowed
+
+
 def generate_builddata_version_py(version: str, build_date: datetime) -> str:
     """Generate the contents of builddata_version.py"""
 
@@ -70,6 +146,203 @@ def find_pyproject_root_from_package_path(package_path: PathOrStr, traverse_max:
     return pyproject_toml_path.parent
 
 
+def _zipapp_shouldignore(path: pathlib.Path) -> bool:
+    """Return True if the path should be excluded from the zipapp file"""
+    exacts = [
+        "__pycache__",
+        ".gitignore",
+    ]
+    if path.name in exacts:
+        return True
+    if path.name.endswith(".pyc"):
+        return True
+    if path.name.endswith(".dist-info"):
+        return True
+    return False
+
+
+def _zipapp_files(
+    progfigsite_filesystem_path: pathlib.Path,
+    site_zip_directory: str,
+    progfiguration_package_path: pathlib.Path,
+    target: Optional[ZipappTarget] = None,
+) -> List[Tuple[pathlib.Path, str]]:
+    """Find the files from the filesystem that go into a zipapp
+
+    Return a list of (filesystem path, path inside the zipfile) tuples,
+    for the progfigsite package (placed under site_zip_directory)
+    and the progfiguration package (placed under progfiguration/),
+    sorted by path inside the zipfile so that the order doesn't depend on the filesystem.
+
+    If target is set, leave out site files that the target nodes don't need.
+    """
+    result = []
+    for fspath, zipdir in [
+        (progfigsite_filesystem_path, site_zip_directory),
+        (progfiguration_package_path, "progfiguration"),
+    ]:
+        for child in fspath.rglob("*"):
+            if _zipapp_shouldignore(child):
+                continue
+            child_relname = child.relative_to(fspath)
+            if target and zipdir == site_zip_directory:
+                if not target.includes(pathlib.PurePosixPath(child_relname.as_posix()), child.is_dir()):
+                    continue
+            result.append((child, zipdir + "/" + child_relname.as_posix()))
+    return sorted(result, key=lambda f: f[1])
+
+
+def _reproducible_build_date(build_date: Optional[datetime] = None) -> datetime:
+    """Return the build date for a reproducible build
+
+    Use build_date if it is set, otherwise SOURCE_DATE_EPOCH,
+    as a naive datetime in UTC like the datetime.utcnow() that non-reproducible builds use.
+    """
+    if build_date is not None:
+        return build_date
+    epoch = siteversion.source_date_epoch()
+    if epoch is None:
+        raise ValueError("Reproducible builds need a build date; set SOURCE_DATE_EPOCH or pass build_date")
+    return datetime.utcfromtimestamp(epoch)
+
+
+def _reproducible_zipinfo(arcname: str, build_date: datetime) -> zipfile.ZipInfo:
+    """Return a ZipInfo for an entry in a reproducible zipapp
+
+    The metadata doesn't depend on the file on disk or the machine building it:
+    the timestamp is the build date (or 1980, the earliest date a zipfile can hold),
+    the permissions are 0755 for directories (arcnames ending in /) and 0644 for files,
+    and the creating system is always Unix.
+    """
+    date_time = max(build_date.timetuple()[:6], (1980, 1, 1, 0, 0, 0))
+    zinfo = zipfile.ZipInfo(arcname, date_time)
+    zinfo.create_system = 3
+    if arcname.endswith("/"):
+        zinfo.external_attr = (0o40755 << 16) | 0x10
+    else:
+        zinfo.external_attr = 0o100644 << 16
+    return zinfo
+
+
+_COMPILE_BYTECODE_SCRIPT = """
+import json, py_compile, sys
+for source, cfile, dfile in json.load(sys.stdin):
+    try:
+        py_compile.compile(
+            source,
+            cfile=cfile,
+            dfile=dfile,
+            doraise=True,
+            invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH,
+        )
+    except py_compile.PyCompileError as exc:
+        print(f"Could not compile {dfile}, it will be loaded from source: {exc.msg}", file=sys.stderr)
+"""
+"""A script run by the target Python interpreter to compile bytecode
+
+Reads a JSON list of (source path, bytecode path, path to show in tracebacks) from stdin.
+"""
+
+
+@functools.lru_cache(maxsize=None)
+def bytecode_python_tag(bytecode_python: str) -> str:
+    """Return a string identifying the bytecode format of a Python interpreter
+
+    :param bytecode_python: The Python interpreter command, eg "python3.11" or "/usr/bin/python3".
+
+    The result includes the implementation cache tag and the bytecode magic number,
+    like "cpython-311-a70d0d0a".
+    Bytecode is only valid for an interpreter with the same tag.
+    """
+    result = subprocess.run(
+        [
+            bytecode_python,
+            "-c",
+            "import importlib.util, sys; print(sys.implementation.cache_tag + '-' + importlib.util.MAGIC_NUMBER.hex())",
+        ],
+        check=True,
+        capture_output=True,
+    )
+    return result.stdout.decode().strip()
+
+
+def _compile_zipapp_bytecode(
+    bytecode_python: str,
+    files: List[Tuple[pathlib.Path, str]],
+    injected: Dict[str, str],
+) -> Dict[str, bytes]:
+    """Compile Python files with the target Python interpreter
+
+    :param bytecode_python: The Python interpreter command to compile with.
+    :param files: A list of (filesystem path, path inside the zipfile) for files to compile;
+        files that don't end in .py are ignored.
+    :param injected: A dict of {path inside the zipfile: source code} for files that don't exist on disk.
+
+    :return: A dict of {path inside the zipfile of the .py file: bytecode}.
+        Files that fail to compile, perhaps because they use syntax that the target Python doesn't support,
+        are left out, and will be loaded from source.
+
+    The bytecode uses unchecked hash-based invalidation,
+    so zipimport never compares it to the source;
+    the zipfile is never modified, so the bytecode can't go stale.
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmppath = pathlib.Path(tmpdir)
+        jobs = []
+        for idx, (child, arcname) in enumerate(files):
+            if arcname.endswith(".py") and child.is_file():
+                jobs.append((child.as_posix(), (tmppath / f"{idx}.pyc").as_posix(), arcname))
+        for idx, (arcname, contents) in enumerate(injected.items()):
+            injected_source = tmppath / f"injected{idx}.py"
+            injected_source.write_text(contents)
+            jobs.append((injected_source.as_posix(), (tmppath / f"injected{idx}.pyc").as_posix(), arcname))
+
+        logger.debug(f"Compiling {len(jobs)} files to bytecode with {bytecode_python}...")
+        subprocess.run(
+            [bytecode_python, "-c", _COMPILE_BYTECODE_SCRIPT],
+            input=json.dumps(jobs).encode(),
+            check=True,
+        )
+
+        result = {}
+        for source, cfile, arcname in jobs:
+            cpath = pathlib.Path(cfile)
+            if cpath.exists():
+                result[arcname] = cpath.read_bytes()
+        return result
+
+
+def _zipapp_build_id(
+    files: List[Tuple[pathlib.Path, str]],
+    injected: Dict[str, str],
+    hashes: Optional[Dict[str, str]] = None,
+) -> str:
+    """Return a hash of the contents of a zipapp
+
+    :param files: A list of (filesystem path, path inside the zipfile), from `_zipapp_files()`.
+    :param injected: A dict of {path inside the zipfile: contents} for files that don't exist on disk.
+    :param hashes: A dict of {path inside the zipfile: sha256 hex digest} for files that have already been hashed,
+        like the entries of an incremental build manifest.
+    """
+    if hashes is None:
+        hashes = {}
+    entries = []
+    for child, arcname in files:
+        if arcname in hashes:
+            entries.append((arcname, hashes[arcname]))
+        elif child.is_file():
+            entries.append((arcname, file_sha256(child)))
+        else:
+            entries.append((arcname, ""))
+    entries += [
+        (arcname, hashlib.sha256(contents.encode("utf-8")).hexdigest()) for arcname, contents in injected.items()
+    ]
+    digest = hashlib.sha256()
+    for arcname, sha256 in sorted(entries):
+        digest.update(f"{arcname}\0{sha256}\0".encode())
+    return digest.hexdigest()
+
+
 def build_progfigsite_zipapp(
     progfigsite_filesystem_path: pathlib.Path,
     progfigsite_modname: str,
@@ -77,13 +350,24 @@ def build_progfigsite_zipapp(
     build_date: Optional[datetime] = None,
     progfiguration_package_path: Optional[pathlib.Path] = None,
     compression: int = zipfile.ZIP_STORED,
+    bytecode_python: Optional[str] = None,
+    extract_dir: Optional[str] = None,
+    extract_keep: int = 3,
+    incremental: bool = False,
+    incremental_base: Optional[pathlib.Path] = None,
+    reproducible: bool = False,
+    version: Optional[str] = None,
+    target: Optional[ZipappTarget] = None,
+    minimal_core: bool = False,
+    core_includes: Optional[List[str]] = None,
 ):
     """Build a .pyz zipapp progfigsite package
 
     :param progfigsite_filesystem_path: The path to the progfigsite package, eg "/path/to/progfigsite".
     :param package_out_path: The path where the zipfile will be written.
     :param build_date: The build date to embed in the zipapp.
-        If None, the current UTC time will be used.
+        If None, the current UTC time will be used,
+        or SOURCE_DATE_EPOCH for reproducible builds.
     :param progfiguration_package_path: The path to the progfiguration package, eg "/path/to/progfiguration".
         If None, the progfiguration package will be copied from the Python path.
         This will only work if progfiguration is installed via pip
@@ -92,6 +376,58 @@ def build_progfigsite_zipapp(
     :param compression: The compression level to use for the zipapp file.
         This can be zipfile.ZIP_STORED (no compression) or zipfile.ZIP_DEFLATED (deflate compression).
         ZIP_STORED (the default) is faster.
+    :param bytecode_python: A Python interpreter command on this machine, like "python3.11".
+        If set, compile every module with this interpreter,
+        and store the bytecode next to its source as module.pyc,
+        which is where zipimport looks for it.
+        Without bytecode, every run of the zipapp compiles every module it imports from source,
+        because zipimport cannot write a __pycache__.
+        zipimport can only use bytecode from a matching Python version;
+        a different version ignores it and compiles from source as usual,
+        so a zipapp can only be sped up for one Python version.
+    :param extract_dir: A directory on the node, like "/var/cache/progfiguration/extracted".
+        If set, the first time the zipapp runs on a node,
+        it extracts itself to a subdirectory named after a hash of its contents,
+        and runs from there.
+        Subsequent runs of the same zipapp skip extraction and import from the filesystem,
+        where Python can cache bytecode in __pycache__ as usual,
+        and role files are read from the filesystem too.
+        If extraction fails, for instance because the directory isn't writable,
+        the zipapp runs from the zipfile as usual.
+    :param extract_keep: How many extracted zipapps to keep in extract_dir;
+        the least recently used extractions beyond this number are removed.
+    :param incremental: If True, write a manifest of the files in the zipapp next to it,
+        like /path/to/my_progfigsite.pyz.manifest.json,
+        and reuse entries from incremental_base for files that haven't changed since it was built.
+        Unchanged entries are copied without being read from disk or compressed again,
+        and their bytecode is reused rather than compiled again.
+        Injected files like __main__.py and the build data are always written fresh.
+    :param incremental_base: A zipapp from a previous incremental build to reuse entries from.
+        If None, use package_out_path itself.
+        If the base has no manifest, or was built with different compression,
+        the build is a full build (and still writes a manifest for next time).
+    :param reproducible: If True, build the same bytes every time from the same inputs.
+        Entries are written in sorted order,
+        with the build date as their timestamp and fixed permissions,
+        rather than the modification times and modes of the files on disk.
+        The build date must be passed as build_date or set in SOURCE_DATE_EPOCH,
+        and the version must not change between builds either;
+        pass it as version, or use a site `mint_version()` that respects SOURCE_DATE_EPOCH,
+        like the one from `progfiguration.sitehelpers.siteversion.mint_version_factory_from_epoch()`.
+        Bytecode is reproducible as long as it is compiled by the same Python version.
+    :param version: The version to embed in the zipapp.
+        If None, mint one with the site's `mint_version()`.
+    :param target: If set, build a slim zipapp for only these nodes;
+        see `ZipappTarget`.
+        A slim zipapp can't apply roles to any other node,
+        and roles can't reference nodes, groups, or roles that it doesn't contain.
+    :param minimal_core: If True, include only the parts of progfiguration core
+        that __main__.py and the site's modules import, directly or indirectly,
+        rather than all of it;
+        see `progfiguration.progfigbuild.treeshake`.
+    :param core_includes: Names of core modules or packages to include in a minimal_core build
+        even if nothing imports them, like "progfiguration.ssh".
+        These are added to the names in the site's optional ``core_includes`` root member.
 
     :return: The path to the zipapp file, eg "/path/to/my_progfigsite.pyz".
 
@@ -117,7 +453,9 @@ def build_progfigsite_zipapp(
     if progfiguration_package_path is None:
         progfiguration_package_path = pathlib.Path(progfiguration.__file__).parent
 
-    if build_date is None:
+    if reproducible:
+        build_date = _reproducible_build_date(build_date)
+    elif build_date is None:
         build_date = datetime.utcnow()
 
     progfigsite = sitewrapper.set_progfigsite_by_filepath(progfigsite_filesystem_path, progfigsite_modname)
@@ -125,6 +463,13 @@ def build_progfigsite_zipapp(
     # We need to use the name of the progfigsite package as the directory inside the zipfile.
     site_zip_directory = progfigsite_modname
 
+    if version is None:
+        inventory = sitewrapper.site_submodule("inventory")
+        version = inventory.mint_version()
+    if progfigsite.__file__ is None:
+        raise ValueError("Cannot find the filesystem path to the progfigsite package")
+    builddata_version_py = generate_builddata_version_py(version, build_date)
+
     main_py = textwrap.dedent(
         f"""
         import {site_zip_directory}
@@ -135,59 +480,331 @@ def build_progfigsite_zipapp(
         """
     )
 
-    def shouldignore(path: pathlib.Path) -> bool:
-        """Return True if the path should be excluded from the zipapp file"""
-        exacts = [
-            "__pycache__",
-            ".gitignore",
+    files = _zipapp_files(progfigsite_filesystem_path, site_zip_directory, progfiguration_package_path, target)
+    if minimal_core:
+        # Keep only the parts of core reachable from __main__.py and the site
+        includes = [*(core_includes or []), *getattr(progfigsite, "core_includes", [])]
+        site_sources = [
+            child.read_text()
+            for child, arcname in files
+            if arcname.startswith(site_zip_directory + "/") and arcname.endswith(".py") and child.is_file()
         ]
-        if path.name in exacts:
-            return True
-        if path.name.endswith(".pyc"):
-            return True
-        if path.name.endswith(".dist-info"):
-            return True
-        return False
+        core_paths = treeshake.minimal_core_paths(progfiguration_package_path, [main_py, *site_sources], includes)
+        files = [
+            (child, arcname)
+            for child, arcname in files
+            if not arcname.startswith("progfiguration/")
+            or pathlib.PurePosixPath(arcname[len("progfiguration/") :]) in core_paths
+        ]
+    injected = {
+        site_zip_directory + "/builddata/version.py": builddata_version_py,
+    }
+
+    manifest: Optional[ZipappManifest] = None
+    base_manifest: Optional[ZipappManifest] = None
+    unchanged: Set[str] = set()
+    if incremental:
+        if incremental_base is None:
+            incremental_base = package_out_path
+        manifest = ZipappManifest(
+            compression=compression,
+            bytecode_tag=bytecode_python_tag(bytecode_python) if bytecode_python else None,
+            source_date=int(build_date.replace(tzinfo=timezone.utc).timestamp()) if reproducible else None,
+        )
+        if incremental_base.exists():
+            base_manifest = ZipappManifest.load(zipapp_manifest_path(incremental_base))
+        if base_manifest and base_manifest.compression != compression:
+            logger.debug(f"Not reusing entries from {incremental_base}, which was built with different compression")
+            base_manifest = None
+        if base_manifest and base_manifest.source_date != manifest.source_date:
+            logger.debug(f"Not reusing entries from {incremental_base}, which has different entry timestamps")
+            base_manifest = None
+        manifest.entries, unchanged = scan_zipapp_files(files, base_manifest)
+    else:
+        # A manifest left over from an earlier incremental build no longer describes this file
+        zipapp_manifest_path(package_out_path).unlink(missing_ok=True)
+
+    if extract_dir:
+        if extract_keep < 1:
+            raise ValueError("extract_keep must be at least 1")
+        # The build ID covers everything except __main__.py itself, including the build date,
+        # so every build extracts to its own directory.
+        hashes = {arcname: entry.sha256 for arcname, entry in manifest.entries.items()} if manifest else None
+        build_id = _zipapp_build_id(files, injected, hashes)
+        extract_py = Temple(importlib.resources.read_text(__package__, "zipapp_extract.py.temple")).substitute(
+            extract_dir=repr(extract_dir),
+            build_id=repr(build_id),
+            extract_keep=repr(extract_keep),
+        )
+        main_py = extract_py + main_py
+    injected["__main__.py"] = main_py
+
+    # Bytecode for unchanged files can be copied from the base if it was compiled for the same Python
+    reuse_bytecode: Set[str] = set()
+    if base_manifest and manifest and bytecode_python and base_manifest.bytecode_tag == manifest.bytecode_tag:
+        reuse_bytecode = {arcname for arcname in unchanged if arcname.endswith(".py")}
+
+    bytecode: Dict[str, bytes] = {}
+    if bytecode_python:
+        compile_files = [(child, arcname) for child, arcname in files if arcname not in reuse_bytecode]
+        bytecode = _compile_zipapp_bytecode(bytecode_python, compile_files, injected)
+
+    # An incremental build may be reading from the file it replaces,
+    # so write to a temporary file next to it and move it into place at the end.
+    write_path = package_out_path.with_name(package_out_path.name + ".partial") if incremental else package_out_path
+
+    try:
+        copied = 0
+        with contextlib.ExitStack() as stack:
+            base_zip: Optional[zipfile.ZipFile] = None
+            if base_manifest and incremental_base:
+                base_zip = stack.enter_context(zipfile.ZipFile(incremental_base))
+            base_names = set(base_zip.namelist()) if base_zip else set()
+
+            def copy_from_base(z: zipfile.ZipFile, arcname: str) -> bool:
+                """Copy an entry from the base zipapp, returning False if the base doesn't have it"""
+                nonlocal copied
+                if base_zip is None or arcname not in base_names:
+                    return False
+                if not copy_raw_entry(base_zip, z, arcname):
+                    z.writestr(base_zip.getinfo(arcname), base_zip.read(arcname))
+                copied += 1
+                return True
+
+            fp = stack.enter_context(open(write_path, "wb"))
+
+            # Writing a shebang like this is optional in zipapp,
+            # but there's no reason not to since it's a valid zip file either way.
+            # TODO: allow customizing the shebang path
+            fp.write(b"#!/usr/bin/env python3\n")
+
+            # Note that we cannot open the zipfile in the same step as the file,
+            # because the zipfile context manager writes a zip header when it opens,
+            # and we need to write the shebang before the zip header.
+            with zipfile.ZipFile(fp, "w", compression=compression) as z:
+
+                def writestr(arcname: str, data: bytes):
+                    """Write an entry, with fixed metadata if the build is reproducible"""
+                    if reproducible:
+                        zinfo = _reproducible_zipinfo(arcname, build_date)
+                        z.writestr(zinfo, data, compress_type=zipfile.ZIP_STORED if zinfo.is_dir() else compression)
+                    else:
+                        z.writestr(arcname, data)
+
+                # Copy the progfigsite package and the progfiguration package into the zipfile
+                for child, arcname in files:
+                    if arcname in unchanged and copy_from_base(z, arcname):
+                        continue
+                    if not reproducible:
+                        z.write(child, arcname)
+                    elif child.is_dir():
+                        writestr(arcname + "/", b"")
+                    else:
+                        writestr(arcname, child.read_bytes())
+
+                # Inject the build date file,
+                # and the __main__.py file to the zipfile root, which is required for zipapps
+                for arcname, contents in injected.items():
+                    writestr(arcname, contents.encode("utf-8"))
+
+                # Add bytecode next to each source file, like module.py -> module.pyc
+                for arcname in sorted(reuse_bytecode | bytecode.keys()):
+                    if arcname in bytecode:
+                        writestr(arcname + "c", bytecode[arcname])
+                    else:
+                        copy_from_base(z, arcname + "c")
+    except BaseException:
+        if incremental:
+            write_path.unlink(missing_ok=True)
+        raise
 
-    inventory = sitewrapper.site_submodule("inventory")
-    version = inventory.mint_version()
-    if progfigsite.__file__ is None:
-        raise ValueError("Cannot find the filesystem path to the progfigsite package")
-    builddata_version_py = generate_builddata_version_py(version, build_date)
+    # Make the zipapp executable
+    write_path.chmod(write_path.stat().st_mode | stat.S_IEXEC)
 
-    with open(package_out_path, "wb") as fp:
-        # Writing a shebang like this is optional in zipapp,
-        # but there's no reason not to since it's a valid zip file either way.
-        # TODO: allow customizing the shebang path
-        fp.write(b"#!/usr/bin/env python3\n")
+    if manifest:
+        os.replace(write_path, package_out_path)
+        manifest.save(zipapp_manifest_path(package_out_path))
+        if base_manifest:
+            logger.info(f"Reused {copied} unchanged entries from {incremental_base}")
 
-        # Note that we cannot combine the zipfile context manager with the open() context manager,
-        # because the zipfile context manager writes a zip header when it opens,
-        # and we need to write the shebang before the zip header.
-        with zipfile.ZipFile(fp, "w", compression=compression) as z:
 
-            # Copy the progfigsite package into the zipfile
-            for child in progfigsite_filesystem_path.rglob("*"):
-                if shouldignore(child):
-                    continue
-                child_relname = child.relative_to(progfigsite_filesystem_path)
-                z.write(child, site_zip_directory + "/" + child_relname.as_posix())
+ZIPAPP_BUILD_CACHE_FORMAT = 1
+"""The version of the zipapp build cache key format
 
-            # Copy the progfiguration package into the zipfile
-            for child in progfiguration_package_path.rglob("*"):
-                if shouldignore(child):
-                    continue
-                child_relname = child.relative_to(progfiguration_package_path)
-                z.write(child, "progfiguration/" + child_relname.as_posix())
+Increment this when the contents of a zipapp change in a way that the cache key doesn't capture,
+like a change to the generated __main__.py,
+so that older cached builds are not reused.
+"""
 
-            # Inject build date file
-            z.writestr(site_zip_directory + "/builddata/version.py", builddata_version_py.encode("utf-8"))
 
-            # Add the __main__.py file to the zipfile root, which is required for zipapps
-            z.writestr("__main__.py", main_py.encode("utf-8"))
+def default_zipapp_build_cache_dir() -> pathlib.Path:
+    """The default directory for cached zipapp builds
 
-    # Make the zipapp executable
-    package_out_path.chmod(package_out_path.stat().st_mode | stat.S_IEXEC)
+    Use $XDG_CACHE_HOME/progfiguration/zipapps, or ~/.cache/progfiguration/zipapps if XDG_CACHE_HOME is not set.
+    """
+    xdg_cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return pathlib.Path(xdg_cache_home) / "progfiguration" / "zipapps"
+
+
+def zipapp_build_cache_key(
+    progfigsite_filesystem_path: pathlib.Path,
+    progfigsite_modname: str,
+    progfiguration_package_path: Optional[pathlib.Path] = None,
+    compression: int = zipfile.ZIP_STORED,
+    bytecode_python: Optional[str] = None,
+    extract_dir: Optional[str] = None,
+    extract_keep: int = 3,
+    reproducible: bool = False,
+    target: Optional[ZipappTarget] = None,
+    minimal_core: bool = False,
+    core_includes: Optional[List[str]] = None,
+) -> str:
+    """Return a key that changes whenever the zipapp built from these arguments would change
+
+    Hash the path and contents of every file that would go into the zipapp,
+    from both the progfigsite package and the progfiguration package,
+    along with the arguments that affect the build.
+
+    The progfigsite's `mint_version()` is usually based on the current time,
+    so its result is not part of the key.
+    Its inputs are, though, because the inventory module is part of the progfigsite package.
+    A cached zipapp keeps the version that was minted when it was first built.
+    For reproducible builds, SOURCE_DATE_EPOCH is part of the key.
+    Slim zipapps only hash the files for their target,
+    so targets that need exactly the same files share a cached zipapp.
+    Minimal core builds still hash all of core, which is simpler and at worst causes an unnecessary rebuild.
+    """
+    if progfiguration_package_path is None:
+        progfiguration_package_path = pathlib.Path(progfiguration.__file__).parent
+
+    digest = hashlib.sha256()
+    digest.update(f"format={ZIPAPP_BUILD_CACHE_FORMAT}\0".encode())
+    digest.update(f"modname={progfigsite_modname}\0".encode())
+    digest.update(f"compression={compression}\0".encode())
+    if bytecode_python:
+        digest.update(f"bytecode={bytecode_python_tag(bytecode_python)}\0".encode())
+    if extract_dir:
+        digest.update(f"extract={extract_dir}\0{extract_keep}\0".encode())
+    if reproducible:
+        digest.update(f"reproducible={_reproducible_build_date().isoformat()}\0".encode())
+    if minimal_core:
+        digest.update(f"minimal_core={','.join(core_includes or [])}\0".encode())
+    files = _zipapp_files(progfigsite_filesystem_path, progfigsite_modname, progfiguration_package_path, target)
+    for child, arcname in files:
+        digest.update(f"{arcname}\0".encode())
+        if child.is_file():
+            digest.update(child.read_bytes())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def build_progfigsite_zipapp_cached(
+    progfigsite_filesystem_path: pathlib.Path,
+    progfigsite_modname: str,
+    cache_dir: Optional[pathlib.Path] = None,
+    progfiguration_package_path: Optional[pathlib.Path] = None,
+    compression: int = zipfile.ZIP_STORED,
+    bytecode_python: Optional[str] = None,
+    extract_dir: Optional[str] = None,
+    extract_keep: int = 3,
+    reproducible: bool = False,
+    target: Optional[ZipappTarget] = None,
+    minimal_core: bool = False,
+    core_includes: Optional[List[str]] = None,
+    keep: int = 10,
+) -> Tuple[pathlib.Path, bool]:
+    """Build a .pyz zipapp progfigsite package, or reuse an identical one built before
+
+    :param progfigsite_filesystem_path: The path to the progfigsite package, eg "/path/to/progfigsite".
+    :param progfigsite_modname: The name of the progfigsite module.
+    :param cache_dir: The directory to keep cached zipapps in.
+        If None, use `default_zipapp_build_cache_dir()`.
+    :param progfiguration_package_path: Passed to `build_progfigsite_zipapp()`.
+    :param compression: Passed to `build_progfigsite_zipapp()`.
+    :param bytecode_python: Passed to `build_progfigsite_zipapp()`.
+    :param extract_dir: Passed to `build_progfigsite_zipapp()`.
+    :param extract_keep: Passed to `build_progfigsite_zipapp()`.
+    :param reproducible: Passed to `build_progfigsite_zipapp()`.
+    :param target: Passed to `build_progfigsite_zipapp()`.
+    :param minimal_core: Passed to `build_progfigsite_zipapp()`.
+    :param core_includes: Passed to `build_progfigsite_zipapp()`.
+    :param keep: How many zipapps to keep in the cache;
+        the least recently used zipapps beyond this number are removed.
+
+    :return: A tuple of the path to the zipapp file inside the cache directory,
+        and whether it was a cache hit.
+        Callers must not modify or delete the file.
+
+    The cache is keyed by `zipapp_build_cache_key()`.
+    On a cache miss, the zipapp is built incrementally from the most recently used zipapp in the cache,
+    so entries for files that haven't changed are copied from it instead of written again.
+    """
+    if cache_dir is None:
+        cache_dir = default_zipapp_build_cache_dir()
+    cache_dir.mkdir(parents=True, exist_ok=True)
+
+    cache_key = zipapp_build_cache_key(
+        progfigsite_filesystem_path,
+        progfigsite_modname,
+        progfiguration_package_path,
+        compression,
+        bytecode_python,
+        extract_dir,
+        extract_keep,
+        reproducible,
+        target,
+        minimal_core,
+        core_includes,
+    )
+    cached_path = cache_dir / f"{cache_key}.pyz"
+
+    if cached_path.exists():
+        logger.info(f"Using cached zipapp {cached_path}")
+        # Touch it so that it counts as recently used when pruning
+        cached_path.touch()
+        return (cached_path, True)
+
+    cached_zipapps = sorted(cache_dir.glob("*.pyz"), key=lambda p: p.stat().st_mtime, reverse=True)
+
+    # Build incrementally from the most recently used cached zipapp,
+    # which is usually the previous build of the same site with a few files changed.
+    incremental_base = next((p for p in cached_zipapps if zipapp_manifest_path(p).exists()), None)
+
+    # Build to a temporary file in the same directory and then move it into place,
+    # so that a concurrent or interrupted build never leaves a partial zipapp in the cache.
+    with tempfile.NamedTemporaryFile(dir=cache_dir, prefix=f"{cache_key}.", suffix=".partial", delete=False) as tmp:
+        partial_path = pathlib.Path(tmp.name)
+    try:
+        build_progfigsite_zipapp(
+            progfigsite_filesystem_path,
+            progfigsite_modname,
+            partial_path,
+            progfiguration_package_path=progfiguration_package_path,
+            compression=compression,
+            bytecode_python=bytecode_python,
+            extract_dir=extract_dir,
+            extract_keep=extract_keep,
+            incremental=True,
+            incremental_base=incremental_base,
+            reproducible=reproducible,
+            target=target,
+            minimal_core=minimal_core,
+            core_includes=core_includes,
+        )
+        os.replace(partial_path, cached_path)
+        os.replace(zipapp_manifest_path(partial_path), zipapp_manifest_path(cached_path))
+    finally:
+        partial_path.unlink(missing_ok=True)
+        zipapp_manifest_path(partial_path).unlink(missing_ok=True)
+    logger.info(f"Built zipapp {cached_path}")
+
+    cached_zipapps.insert(0, cached_path)
+    for old in cached_zipapps[keep:]:
+        logger.debug(f"Removing old cached zipapp {old}")
+        old.unlink(missing_ok=True)
+        zipapp_manifest_path(old).unlink(missing_ok=True)
+
+    return (cached_path, False)
 
 
 class ProgfigsitePythonPackagePreparer:
@@ -371,6 +988,14 @@ class ProgfigsitePythonPackagePreparer:
             raise RuntimeError("\n".join(msg))
 
 
+PIP_PACKAGE_FORMATS = {
+    "sdist": ["sdist"],
+    "wheel": ["wheel"],
+    "both": ["sdist", "wheel"],
+}
+"""The package formats `build_progfigsite_pip_packages()` can build, and the distributions to build for each"""
+
+
 def build_progfigsite_pip(
     progfigsite_filesystem_path: pathlib.Path,
     progfigsite_modname: str,
@@ -395,7 +1020,49 @@ def build_progfigsite_pip(
         Intended for debugging.
 
     :return: The path to the pip package, eg "/path/to/my_progfigsite/dist/my_progfigsite-0.1.0.tar.gz"
+
+    To build a wheel as well, use `build_progfigsite_pip_packages()`.
     """
+    (built,) = build_progfigsite_pip_packages(
+        progfigsite_filesystem_path,
+        progfigsite_modname,
+        package_out_path,
+        build_date=build_date,
+        progfiguration_package_path=progfiguration_package_path,
+        keep_injected_files=keep_injected_files,
+        package_format="sdist",
+    )
+    return built
+
+
+def build_progfigsite_pip_packages(
+    progfigsite_filesystem_path: pathlib.Path,
+    progfigsite_modname: str,
+    package_out_path: pathlib.Path,
+    build_date: Optional[datetime] = None,
+    progfiguration_package_path: Optional[pathlib.Path] = None,
+    keep_injected_files: bool = False,
+    package_format: str = "sdist",
+) -> List[pathlib.Path]:
+    """Build one or more pip packages
+
+    Takes the same arguments as `build_progfigsite_pip()`, plus:
+
+    :param package_format: One of `PIP_PACKAGE_FORMATS`:
+        "sdist" for a source distribution,
+        "wheel" for a pure-Python wheel,
+        or "both".
+        Nodes can install a wheel without running a build step,
+        so it's much faster to install on small machines.
+
+    :return: A list of paths to the built packages, eg
+        ["/path/to/my_progfigsite/dist/my_progfigsite-0.1.0.tar.gz"] or
+        ["/path/to/my_progfigsite/dist/my_progfigsite-0.1.0-py3-none-any.whl"].
+    """
+
+    if package_format not in PIP_PACKAGE_FORMATS:
+        raise ValueError(f"Unknown pip package format {package_format}, must be one of {list(PIP_PACKAGE_FORMATS)}")
+    distributions = PIP_PACKAGE_FORMATS[package_format]
 
     # We only want to import build if we're building a pip package
     import build
@@ -410,7 +1077,9 @@ def build_progfigsite_pip(
     ) as preparer:
 
         builder = build.ProjectBuilder(preparer.progfigsite_project_path)
-        # TODO: support whl packages
-        built = builder.build("sdist", package_out_path, {})
+        # Build the wheel straight from the prepared project directory, rather than from the sdist,
+        # so we only inject build data once.
+        # The wheel build dereferences the progfiguration static include symlink just like the sdist build does.
+        built = [pathlib.Path(builder.build(distribution, package_out_path, {})) for distribution in distributions]
 
-    return pathlib.Path(built)
+    return built
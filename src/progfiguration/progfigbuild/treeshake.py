@@ -0,0 +1,125 @@
+"""Find the parts of progfiguration core that a built package needs
+
+A zipapp normally contains all of progfiguration core,
+including parts that only run on the controller, like the newsite templates and the core command.
+To build a minimal package, we read the imports from the zipapp's __main__.py and every module in the site,
+and follow them through progfiguration core,
+keeping only the core modules they reach.
+
+This is static analysis like the standard library modulefinder module does,
+but it parses the source rather than compiling and scanning bytecode,
+and only follows imports inside progfiguration core.
+Imports inside functions are followed too, so a module is kept even if it is only imported lazily.
+Modules imported dynamically, like with importlib.import_module(), can't be found this way;
+list them in the core_includes argument or the site's ``core_includes`` root member.
+"""
+
+import ast
+import pathlib
+from typing import Dict, Iterable, List, Optional, Set
+
+
+def _module_name(core_name: str, relpath: pathlib.PurePosixPath) -> str:
+    """Return the module name for a .py file relative to the core package, like progfiguration.cli.util"""
+    parts = [core_name, *relpath.parts]
+    parts[-1] = parts[-1][: -len(".py")]
+    if parts[-1] == "__init__":
+        parts.pop()
+    return ".".join(parts)
+
+
+def module_imports(source: str, modname: str, is_package: bool = False) -> Set[str]:
+    """Return the absolute names of everything a module imports
+
+    :param source: The Python source code of the module.
+    :param modname: The name of the module, used to resolve relative imports.
+    :param is_package: Whether the module is a package (an __init__.py), also used for relative imports.
+
+    For ``from package import name``, the result contains both ``package`` and ``package.name``,
+    because the name might be a submodule.
+    Callers should ignore names that aren't modules.
+    """
+    result: Set[str] = set()
+    for node in ast.walk(ast.parse(source)):
+        if isinstance(node, ast.Import):
+            result.update(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom):
+            if node.level:
+                package = modname.split(".") if is_package else modname.split(".")[:-1]
+                if node.level > 1:
+                    package = package[: -(node.level - 1)]
+                base = ".".join(package + ([node.module] if node.module else []))
+            else:
+                base = node.module or ""
+            result.add(base)
+            result.update(f"{base}.{alias.name}" for alias in node.names if alias.name != "*")
+    return result
+
+
+def minimal_core_paths(
+    core_path: pathlib.Path,
+    root_sources: Iterable[str],
+    includes: List[str],
+    core_name: str = "progfiguration",
+) -> Set[pathlib.PurePosixPath]:
+    """Return the paths inside progfiguration core that a package needs
+
+    :param core_path: The path to the progfiguration package on the filesystem.
+    :param root_sources: The source code of the modules outside of core to start from,
+        like __main__.py and every module in the site.
+    :param includes: Names of extra core modules or packages to keep.
+        A module is kept along with everything it imports.
+        A package is kept entirely, including all its submodules and data files.
+    :param core_name: The name of the core package.
+
+    :return: A set of paths relative to core_path,
+        for every file and directory that should go into the package.
+
+    Every package a kept module is in is kept too, because importing a module imports its parents.
+    Data files, like templates, are kept if the package they're in is kept,
+    including files in subdirectories of the package that aren't packages themselves.
+    """
+    modules: Dict[str, pathlib.PurePosixPath] = {}
+    for child in core_path.rglob("*.py"):
+        relpath = pathlib.PurePosixPath(child.relative_to(core_path).as_posix())
+        modules[_module_name(core_name, relpath)] = relpath
+
+    whole_packages = {name for name in includes if name in modules and modules[name].name == "__init__.py"}
+
+    pending: List[str] = []
+    for source in root_sources:
+        pending.extend(module_imports(source, "__main__"))
+    pending.extend(includes)
+    for package in whole_packages:
+        pending.extend(name for name in modules if name.startswith(package + "."))
+
+    kept: Set[str] = set()
+    while pending:
+        name = pending.pop()
+        if name in kept or name not in modules:
+            continue
+        kept.add(name)
+        # Importing a.b.c imports a and a.b first
+        parts = name.split(".")
+        pending.extend(".".join(parts[:i]) for i in range(1, len(parts)))
+        relpath = modules[name]
+        source = (core_path / relpath).read_text()
+        pending.extend(module_imports(source, name, relpath.name == "__init__.py"))
+
+    package_dirs = {relpath.parent for relpath in modules.values() if relpath.name == "__init__.py"}
+    kept_dirs = {modules[name].parent for name in kept if modules[name].name == "__init__.py"}
+    result: Set[pathlib.PurePosixPath] = {modules[name] for name in kept}
+    for child in core_path.rglob("*"):
+        relpath = pathlib.PurePosixPath(child.relative_to(core_path).as_posix())
+        if relpath.suffix == ".py" and not child.is_dir():
+            continue
+        owner: Optional[pathlib.PurePosixPath]
+        if relpath in package_dirs:
+            owner = relpath
+        else:
+            owner = next((parent for parent in relpath.parents if parent in package_dirs), None)
+        if owner is None:
+            raise ValueError(f"{child} is not inside any package in {core_path}; is {core_path} a package?")
+        if owner in kept_dirs:
+            result.add(relpath)
+    return result
@@ -0,0 +1,185 @@
+"""Manifests for incremental zipapp builds
+
+An incremental build keeps a manifest next to the zipapp it builds,
+recording the size, mtime, and hash of every file that went into it.
+The next build compares the files on disk to the manifest,
+and copies the entries for unchanged files out of the previous zipapp as raw compressed bytes,
+rather than reading, checksumming, and compressing them again.
+"""
+
+import copy
+from dataclasses import asdict, dataclass, field
+import hashlib
+import json
+import pathlib
+import struct
+from typing import Dict, List, Optional, Set, Tuple
+import zipfile
+
+ZIPAPP_MANIFEST_FORMAT = 1
+"""The version of the manifest file format
+
+Manifests with a different format are ignored, and the next build is a full build.
+"""
+
+
+_LOCAL_FILE_HEADER = struct.Struct("<4s2B4HL2L2H")
+"""The fixed-size part of a zip local file header
+
+See section 4.3.7 of the zip specification <https://pkware.cachefly.net/webdocs/casestudies/APPNOTE.TXT>.
+The last two fields are the lengths of the variable-size filename and extra fields that follow.
+"""
+
+_LOCAL_FILE_HEADER_SIGNATURE = b"PK\003\004"
+
+
+@dataclass
+class ZipappManifestEntry:
+    """A file from the filesystem that went into a zipapp"""
+
+    size: int
+    """The size of the file in bytes"""
+
+    mtime_ns: int
+    """The modification time of the file in nanoseconds"""
+
+    sha256: str
+    """The sha256 hex digest of the file contents"""
+
+
+@dataclass
+class ZipappManifest:
+    """A record of the files that went into a zipapp"""
+
+    compression: int
+    """The compression used for the zipapp, like zipfile.ZIP_STORED"""
+
+    bytecode_tag: Optional[str] = None
+    """The `progfiguration.progfigbuild.bytecode_python_tag()` of the bytecode in the zipapp, if any"""
+
+    source_date: Optional[int] = None
+    """The build date of a reproducible zipapp in seconds since the epoch, or None if it isn't reproducible
+
+    Entries in a reproducible zipapp carry this date,
+    so they can only be reused by a build with the same date.
+    """
+
+    entries: Dict[str, ZipappManifestEntry] = field(default_factory=dict)
+    """A dict of {path inside the zipfile: ZipappManifestEntry}"""
+
+    def save(self, path: pathlib.Path):
+        """Save the manifest to a JSON file"""
+        contents = {"format": ZIPAPP_MANIFEST_FORMAT, **asdict(self)}
+        with path.open("w") as fp:
+            json.dump(contents, fp, indent=1, sort_keys=True)
+
+    @classmethod
+    def load(cls, path: pathlib.Path) -> Optional["ZipappManifest"]:
+        """Load a manifest from a JSON file
+
+        Return None if the file doesn't exist or isn't a manifest we understand.
+        """
+        try:
+            with path.open() as fp:
+                contents = json.load(fp)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        if contents.get("format") != ZIPAPP_MANIFEST_FORMAT:
+            return None
+        return cls(
+            compression=contents["compression"],
+            bytecode_tag=contents["bytecode_tag"],
+            source_date=contents.get("source_date"),
+            entries={k: ZipappManifestEntry(**v) for k, v in contents["entries"].items()},
+        )
+
+
+def zipapp_manifest_path(zipapp_path: pathlib.Path) -> pathlib.Path:
+    """The path to the manifest for a zipapp, like /path/to/site.pyz.manifest.json"""
+    return zipapp_path.with_name(zipapp_path.name + ".manifest.json")
+
+
+def file_sha256(path: pathlib.Path) -> str:
+    """Return the sha256 hex digest of a file"""
+    digest = hashlib.sha256()
+    with path.open("rb") as fp:
+        for chunk in iter(lambda: fp.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def scan_zipapp_files(
+    files: List[Tuple[pathlib.Path, str]],
+    base: Optional[ZipappManifest],
+) -> Tuple[Dict[str, ZipappManifestEntry], Set[str]]:
+    """Compare files on disk to the manifest of a previous build
+
+    :param files: A list of (filesystem path, path inside the zipfile),
+        from `progfiguration.progfigbuild._zipapp_files()`.
+        Directories are skipped.
+    :param base: The manifest of the previous build, if any.
+
+    :return: A tuple of the manifest entries for the new build,
+        and the set of paths inside the zipfile whose contents are unchanged since the previous build.
+
+    Files whose size and mtime match the previous manifest are assumed unchanged without reading them.
+    Other files are hashed, so a file that was touched but not modified is still reused.
+    """
+    entries: Dict[str, ZipappManifestEntry] = {}
+    unchanged: Set[str] = set()
+    for child, arcname in files:
+        if not child.is_file():
+            continue
+        st = child.stat()
+        old = base.entries.get(arcname) if base else None
+        if old and old.size == st.st_size and old.mtime_ns == st.st_mtime_ns:
+            sha256 = old.sha256
+        else:
+            sha256 = file_sha256(child)
+        entries[arcname] = ZipappManifestEntry(size=st.st_size, mtime_ns=st.st_mtime_ns, sha256=sha256)
+        if old and old.sha256 == sha256:
+            unchanged.add(arcname)
+    return (entries, unchanged)
+
+
+def copy_raw_entry(src: zipfile.ZipFile, dst: zipfile.ZipFile, name: str) -> bool:
+    """Copy an entry from one zipfile to another without decompressing it
+
+    :param src: A zipfile opened for reading.
+    :param dst: A zipfile opened for writing.
+    :param name: The name of the entry to copy.
+
+    :return: True if the entry was copied,
+        or False if it can't be copied raw and must be written normally.
+
+    The zipfile module doesn't have an API for this,
+    so we read the compressed bytes from after the entry's local header in src,
+    and write them to dst with a new local header,
+    registering the entry with dst the same way ZipFile.write() does.
+    """
+    info = src.getinfo(name)
+    # Entries with a data descriptor (bit 3) or encryption (bit 0) have a different layout.
+    # We never write those, but zipfiles from elsewhere might have them.
+    if info.flag_bits & 0x09:
+        return False
+    if src.fp is None or dst.fp is None:
+        raise ValueError("Both zipfiles must be open")
+
+    src.fp.seek(info.header_offset)
+    header = _LOCAL_FILE_HEADER.unpack(src.fp.read(_LOCAL_FILE_HEADER.size))
+    if header[0] != _LOCAL_FILE_HEADER_SIGNATURE:
+        return False
+    filename_len, extra_len = header[-2], header[-1]
+    src.fp.seek(info.header_offset + _LOCAL_FILE_HEADER.size + filename_len + extra_len)
+    raw = src.fp.read(info.compress_size)
+
+    newinfo = copy.copy(info)
+    zip64 = info.file_size > zipfile.ZIP64_LIMIT or info.compress_size > zipfile.ZIP64_LIMIT
+    dst.fp.seek(dst.start_dir)
+    newinfo.header_offset = dst.fp.tell()
+    dst.fp.write(newinfo.FileHeader(zip64))
+    dst.fp.write(raw)
+    dst.start_dir = dst.fp.tell()
+    dst.filelist.append(newinfo)
+    dst.NameToInfo[newinfo.filename] = newinfo
+    return True
@@ -58,6 +58,7 @@ class ValidationResult:
         ProgfigsiteProperty("", "site_name", str),
         ProgfigsiteProperty("", "site_description", str),
         ProgfigsiteProperty("", "get_version", Callable[[], str]),
+        ProgfigsiteProperty("", "core_includes", list, required=False),
         # We can't require builddata, because it's only present in a build,
         # not in an editable install,
         # but the progfiguration_site_cmd requires validation before it will run.
@@ -6,20 +6,30 @@ We endeavor to keep it "nasty, brutish, and short".
 
 TODO:
 * Wrapper of scp for multi-host scp
-* Use a thread pool for multi-host execution
 * Wrapper of scp that will mkdir the destination parent
 * Make sure dest is always clear/consistent. Does it make a new dest directory?
-* Implement ControlMaster for faster repeated copies/commands
 """
 
+import asyncio
+import contextlib
+import functools
+import hashlib
 import os.path
 import secrets
 import shlex
+import shutil
 import string
-from typing import Any, List, Optional, Union
+import subprocess
+import tempfile
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Literal, Optional, Union
 
 from progfiguration import logger
-from progfiguration.cmd import magicrun
+from progfiguration.cmd import amagicrun, magicrun
+
+UploadMethod = Literal["scp", "stdin"]
+"""How `cpexec()` uploads a file: with scp, or over the stdin of the ssh session that runs it"""
 
 
 def generate_random_string(length):
@@ -28,16 +38,265 @@ def generate_random_string(length):
     return "".join(secrets.choice(alphabet) for i in range(length))
 
 
-def scp(host: str, sources: Union[str, List[str]], dest: str):
-    """Use scp to copy a file, directory, or list"""
+class SshMultiplexer:
+    """Share one SSH connection per host between many ssh/scp commands
+
+    Use as a context manager.
+    The first time a host is requested with `options()`,
+    start an ssh master process for it with its control socket in a private temporary directory.
+    Subsequent ssh/scp commands that pass the returned options reuse that connection,
+    skipping key exchange and authentication.
+    When the context manager exits, all master connections are closed
+    and the temporary directory is removed.
+
+    If a master connection cannot be established,
+    `options()` returns an empty list and commands connect normally.
+
+    Safe to use from multiple threads.
+    """
+
+    def __init__(self, master_timeout: float = 30.0):
+        """
+
+        master_timeout: how many seconds to wait for a master connection to be established
+        """
+        self.master_timeout = master_timeout
+        self.socket_dir: Optional[str] = None
+        self._masters: Dict[str, subprocess.Popen] = {}
+        self._failed: List[str] = []
+        self._host_locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        # mkdtemp creates the directory readable only by the current user
+        self.socket_dir = tempfile.mkdtemp(prefix="progfiguration-ssh-")
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def socket_path(self, host: str) -> str:
+        """The path to the control socket for a host
+
+        Hash the host so that the path is short enough for a unix socket, no matter how long the hostname is.
+        """
+        if self.socket_dir is None:
+            raise RuntimeError("SshMultiplexer must be used as a context manager")
+        hosthash = hashlib.sha256(host.encode()).hexdigest()[:16]
+        return os.path.join(self.socket_dir, hosthash)
+
+    def _start_master(self, host: str) -> bool:
+        """Start a master connection for a host, and wait for its control socket to appear
+
+        Return True if the master connection is ready.
+        """
+        sockpath = self.socket_path(host)
+        master_cmd = ["ssh", "-M", "-N", "-o", "BatchMode=yes", "-o", f"ControlPath={sockpath}", host]
+        logger.debug(f"Starting ssh master connection to {host}: {master_cmd}")
+        # Don't connect the master to our stdout/stderr;
+        # it outlives the commands that use it, and would hold their output pipes open.
+        master = subprocess.Popen(
+            master_cmd,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        self._masters[host] = master
+        deadline = time.monotonic() + self.master_timeout
+        while time.monotonic() < deadline:
+            if os.path.exists(sockpath):
+                return True
+            if master.poll() is not None:
+                logger.warning(f"ssh master connection to {host} exited with code {master.returncode}")
+                return False
+            time.sleep(0.1)
+        logger.warning(f"Timed out waiting for ssh master connection to {host}")
+        master.terminate()
+        return False
+
+    def options(self, host: str) -> List[str]:
+        """Command-line options for ssh/scp to reuse the master connection for a host
+
+        Start the master connection if it isn't already running.
+        """
+        with self._lock:
+            if host not in self._host_locks:
+                self._host_locks[host] = threading.Lock()
+            host_lock = self._host_locks[host]
+        with host_lock:
+            if host in self._failed:
+                return []
+            if host not in self._masters:
+                if not self._start_master(host):
+                    self._failed.append(host)
+                    return []
+        return ["-o", f"ControlPath={self.socket_path(host)}", "-o", "ControlMaster=no"]
+
+    async def aoptions(self, host: str) -> List[str]:
+        """The asyncio version of `options()`
+
+        Starting a master connection waits for its control socket,
+        so do it in a thread rather than blocking the event loop.
+        """
+        return await asyncio.to_thread(self.options, host)
+
+    def close(self):
+        """Close all master connections and remove the socket directory"""
+        for host, master in self._masters.items():
+            if master.poll() is None:
+                subprocess.run(
+                    ["ssh", "-o", f"ControlPath={self.socket_path(host)}", "-O", "exit", host],
+                    stdin=subprocess.DEVNULL,
+                    capture_output=True,
+                )
+                try:
+                    master.wait(timeout=5)
+                except subprocess.TimeoutExpired:
+                    master.terminate()
+                    master.wait()
+            logger.debug(f"Closed ssh master connection to {host}")
+        self._masters = {}
+        self._failed = []
+        if self.socket_dir is not None:
+            shutil.rmtree(self.socket_dir, ignore_errors=True)
+            self.socket_dir = None
+
+
+def scp(
+    host: str,
+    sources: Union[str, List[str]],
+    dest: str,
+    output_prefix: str = "",
+    multiplexer: Optional[SshMultiplexer] = None,
+):
+    """Use scp to copy a file, directory, or list
+
+    output_prefix: a string to prepend to each line of output printed to the terminal, like "[node1] "
+    multiplexer: if passed, reuse its master connection to the host
+    """
+
+    ssh_opts = multiplexer.options(host) if multiplexer is not None else []
+    magicrun(_scp_command(host, sources, dest, ssh_opts), output_prefix=output_prefix)
+
 
+async def ascp(
+    host: str,
+    sources: Union[str, List[str]],
+    dest: str,
+    output_prefix: str = "",
+    multiplexer: Optional[SshMultiplexer] = None,
+):
+    """The asyncio version of `scp()`"""
+    ssh_opts = await multiplexer.aoptions(host) if multiplexer is not None else []
+    await amagicrun(_scp_command(host, sources, dest, ssh_opts), output_prefix=output_prefix)
+
+
+def _scp_command(host: str, sources: Union[str, List[str]], dest: str, ssh_opts: List[str]) -> List[str]:
+    """The scp command line for scp() and ascp()"""
     if isinstance(sources, str):
         sources = [sources]
+    return ["scp", "-r"] + ssh_opts + sources + [f"{host}:{dest}"]
 
-    cmd = ["scp", "-r"]
-    cmd += sources
-    cmd += [f"{host}:{dest}"]
-    magicrun(cmd)
+
+def stdin_upload_script(
+    dest: str,
+    command_list: List[str],
+    size: int,
+    keep_remote_file: bool = False,
+    install_path: Optional[str] = None,
+) -> str:
+    """Generate a shell script that saves its stdin to a file, executes it, and removes it
+
+    dest: the path to save stdin to
+    command_list: the command to run after the file is saved, which should include dest (or install_path)
+    size: the expected size of the file in bytes; if the saved file is a different size, fail without running it
+    keep_remote_file: if True, do not remove the file after the command finishes
+    install_path: if passed, move the file here after it is saved and checked, before running the command.
+        The file at install_path is never removed.
+
+    The script exits with the exit code of the command.
+    The file is removed even if the script is interrupted by a signal.
+    After the file is saved, stdin is at EOF, so the command sees an empty stdin.
+    """
+    qdest = shlex.quote(dest)
+    remote_cmd = " ".join(shlex.quote(arg) for arg in command_list)
+    lines = ["umask 077"]
+    if not keep_remote_file:
+        lines += [
+            f"trap 'rm -f {qdest}' EXIT",
+            # Signals don't run the EXIT trap on their own in all shells, so exit explicitly
+            "trap 'exit 129' HUP",
+            "trap 'exit 130' INT",
+            "trap 'exit 143' TERM",
+        ]
+    lines += [
+        f"cat > {qdest} || exit 1",
+        f"received=$(wc -c < {qdest})",
+        f'if test "$received" -ne {size}; then echo "Expected {size} bytes but received $received" >&2; exit 1; fi',
+    ]
+    if install_path:
+        lines += [f"mv -f {qdest} {shlex.quote(install_path)} || exit 1"]
+    lines += [remote_cmd]
+    return "\n".join(lines) + "\n"
+
+
+@functools.lru_cache(maxsize=32)
+def _file_sha256_cached(path: str, size: int, mtime_ns: int) -> str:
+    """Hash a file; size and mtime_ns are only used as part of the cache key"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_sha256(path: str) -> str:
+    """Return the sha256 hex digest of a file
+
+    The result is cached until the file's size or mtime changes,
+    so hashing the same package for many hosts only reads it once.
+    """
+    st = os.stat(path)
+    return _file_sha256_cached(os.path.abspath(path), st.st_size, st.st_mtime_ns)
+
+
+def remote_cache_prepare_script(cache_dir: str, cache_name: str, cache_keep: int) -> str:
+    """Generate a shell script that checks for a file in a remote cache directory
+
+    cache_dir: the cache directory, which will be created if it doesn't exist
+    cache_name: the name of the file to look for in the cache directory
+    cache_keep: how many files to keep in the cache, including cache_name
+
+    The script prints "hit" if the file exists and "miss" if it doesn't.
+    On a hit, it touches the file so that it counts as recently used.
+    Then it removes the least recently used files beyond cache_keep,
+    as well as any partial uploads older than an hour.
+
+    The cache only holds files that we are about to execute,
+    so it only trusts files and directories that the remote user owns and that nobody else can write to.
+    If the cache directory is not trustworthy, the script prints "untrusted" and does nothing else.
+    If the file is not trustworthy, the script removes it and prints "miss".
+    """
+    qdir = shlex.quote(cache_dir)
+    qname = shlex.quote(cache_name)
+    _, ext = os.path.splitext(cache_name)
+
+    def others_can_write(qpath: str) -> str:
+        return f'test -n "$(find {qpath} -prune \\( -perm -020 -o -perm -002 \\) -print)"'
+
+    trusted_file = f"test -f {qname} && ! test -L {qname} && test -O {qname} && ! {others_can_write(qname)}"
+    lines = [
+        "umask 077",
+        f"mkdir -p {qdir} || exit 1",
+        f"cd {qdir} || exit 1",
+        f"if ! test -O . || {others_can_write('.')}; then echo untrusted; exit 0; fi",
+        f"if {trusted_file}; then touch {qname}; echo hit; else rm -f {qname}; echo miss; fi",
+        # Every file in the cache is named after its hash, so we don't need to worry about spaces etc in the names
+        f"ls -t -- *{ext} 2>/dev/null | grep -v -x -F {qname} | tail -n +{cache_keep} | xargs rm -f --",
+        "find . -name '*.partial-*' -mmin +60 -exec rm -f {} + 2>/dev/null",
+        "exit 0",
+    ]
+    return "\n".join(lines) + "\n"
 
 
 def cpexec(
@@ -49,6 +308,11 @@ def cpexec(
     ssh_tty: bool = True,
     ssh_stdin: Any = None,
     keep_remote_file: bool = False,
+    output_prefix: str = "",
+    multiplexer: Optional[SshMultiplexer] = None,
+    upload: UploadMethod = "scp",
+    cache_dir: Optional[str] = None,
+    cache_keep: int = 5,
 ):
     """Copy a file to a remote host, then execute and delete the remote copy
 
@@ -60,43 +324,290 @@ def cpexec(
     ssh_tty: whether to allocate a tty for the ssh connection
     ssh_stdin: a file-like object which we pass to run() as stdin (e.g. subprocess.DEVNULL)
     keep_remote_file: if True, the remote file will not be deleted after execution
+    output_prefix: a string to prepend to each line of output printed to the terminal, like "[node1] ".
+        Useful when running cpexec against several hosts at once.
+    multiplexer: if passed, reuse its master connection to the host for the copy, the command, and the cleanup
+    upload: how to get the file to the remote host.
+        "scp" copies it with scp, runs it with ssh, and removes it with another ssh (three connections).
+        "stdin" streams it over the stdin of a single ssh session,
+        which saves it, runs it, and removes it (one connection).
+        Because stdin carries the file, "stdin" cannot be combined with ssh_tty
+        (a tty would mangle the binary data)
+        or ssh_stdin (the command sees an empty stdin, like subprocess.DEVNULL).
+    cache_dir: if passed, keep the file in this directory on the remote host, named after its sha256 hash,
+        like /var/cache/progfiguration/<sha256>.pyz.
+        Only upload it if it isn't there already, and never delete it after execution.
+        dest and keep_remote_file are ignored.
+    cache_keep: how many files to keep in cache_dir;
+        the least recently used files beyond this number are removed.
     """
 
-    if args is None:
-        args = []
+    _cpexec_check_args(ssh_tty, ssh_stdin, upload, cache_dir, cache_keep)
+    ssh_opts = multiplexer.options(host) if multiplexer is not None else []
+    plan = _CpexecPlan(
+        host,
+        source,
+        args,
+        dest,
+        interpreter,
+        ssh_tty,
+        ssh_stdin,
+        keep_remote_file,
+        upload,
+        cache_dir,
+        cache_keep,
+        ssh_opts,
+    )
 
-    if dest == "":
-        bname = os.path.basename(source)
-        dstname = f"{generate_random_string(16)}-{bname}"
-        dest = f"/tmp/{dstname}"
+    if plan.prepare is not None:
+        prepared = magicrun(plan.prepare, print_output=False, stdin=subprocess.DEVNULL)
+        plan.cache_checked(prepared.stdout.read())
 
-    scp(host, [source], dest)
+    if plan.upload is not None:
+        magicrun(plan.upload, output_prefix=output_prefix)
 
     try:
-        command_list = []
-        if interpreter:
-            command_list += interpreter
-        command_list += [dest] + args
-        remote_cmd = " ".join(shlex.quote(arg) for arg in command_list)
-        logger.debug(f"Will connect to {host} and execute command: {remote_cmd}")
+        with plan.run_args() as run_args:
+            execresult = magicrun(plan.run, output_prefix=output_prefix, **run_args)
+        logger.debug(f"Finished ssh command to {host}")
+    finally:
+        if plan.cleanup is not None:
+            # We don't need to fuck with ttys/fds here because rm is simple
+            magicrun(plan.cleanup, output_prefix=output_prefix)
+        elif plan.kept is not None:
+            print(f"{output_prefix}Kept the remote file at {plan.kept}")
 
-        ssh_cmd_run_args = {}
-        if ssh_stdin is not None:
-            ssh_cmd_run_args["stdin"] = ssh_stdin
+    return execresult
 
-        ssh_cmd = ["ssh"]
-        if ssh_tty:
-            ssh_cmd += ["-tt"]
-        ssh_cmd += [host, remote_cmd]
 
-        execresult = magicrun(ssh_cmd, **ssh_cmd_run_args)
+async def acpexec(
+    host: str,
+    source: str,
+    args: Optional[List[str]] = None,
+    dest: str = "",
+    interpreter: Optional[List[str]] = None,
+    ssh_tty: bool = True,
+    ssh_stdin: Any = None,
+    keep_remote_file: bool = False,
+    output_prefix: str = "",
+    multiplexer: Optional[SshMultiplexer] = None,
+    upload: UploadMethod = "scp",
+    cache_dir: Optional[str] = None,
+    cache_keep: int = 5,
+):
+    """The asyncio version of `cpexec()`
+
+    Takes the same arguments and behaves the same way,
+    but runs its commands with `progfiguration.cmd.amagicrun()`,
+    so that many hosts can be handled at once in one event loop with asyncio.gather().
+    Returns an `progfiguration.cmd.AsyncMagicProcess`.
+    """
 
+    _cpexec_check_args(ssh_tty, ssh_stdin, upload, cache_dir, cache_keep)
+    ssh_opts = await multiplexer.aoptions(host) if multiplexer is not None else []
+    plan = _CpexecPlan(
+        host,
+        source,
+        args,
+        dest,
+        interpreter,
+        ssh_tty,
+        ssh_stdin,
+        keep_remote_file,
+        upload,
+        cache_dir,
+        cache_keep,
+        ssh_opts,
+    )
+
+    if plan.prepare is not None:
+        prepared = await amagicrun(plan.prepare, print_output=False, stdin=subprocess.DEVNULL)
+        plan.cache_checked(prepared.stdout.read())
+
+    if plan.upload is not None:
+        await amagicrun(plan.upload, output_prefix=output_prefix)
+
+    try:
+        with plan.run_args() as run_args:
+            execresult = await amagicrun(plan.run, output_prefix=output_prefix, **run_args)
         logger.debug(f"Finished ssh command to {host}")
     finally:
+        if plan.cleanup is not None:
+            await amagicrun(plan.cleanup, output_prefix=output_prefix)
+        elif plan.kept is not None:
+            print(f"{output_prefix}Kept the remote file at {plan.kept}")
+
+    return execresult
+
+
+class _CpexecPlan:
+    """The commands that `cpexec()` and `acpexec()` run
+
+    Both functions run the same commands in the same order,
+    and only differ in whether they run them with magicrun() or amagicrun():
+
+    1.  `prepare`, if it is not None, to check the remote cache and prune old entries.
+        Pass its stdout to `cache_checked()`, which fills in the commands below.
+    2.  `upload`, if it is not None, to copy the file with scp.
+    3.  `run`, with the keyword arguments from `run_args()`, to run the file.
+    4.  `cleanup`, if it is not None, to remove the remote file, even if `run` failed.
+        Otherwise, if `kept` is not None, tell the user the remote file was kept at that path.
+
+    With a remote cache, check the cache and prune old entries in one ssh command.
+    If the cache directory can't be trusted, upload and run the file as if there were no cache.
+    On a miss, upload to a partial file, and move it into place right before running it,
+    so that an interrupted upload never leaves a broken file in the cache.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        source: str,
+        args: Optional[List[str]],
+        dest: str,
+        interpreter: Optional[List[str]],
+        ssh_tty: bool,
+        ssh_stdin: Any,
+        keep_remote_file: bool,
+        upload: UploadMethod,
+        cache_dir: Optional[str],
+        cache_keep: int,
+        ssh_opts: List[str],
+    ):
+        self.host = host
+        self.source = source
+        self.ssh_tty = ssh_tty
+        self.upload_method = upload
+        self.ssh_opts = ssh_opts
+        self._interpreter = interpreter
+        self._args = args
+
+        self.prepare: Optional[List[str]] = None
+        self.upload: Optional[List[str]] = None
+        self.run: List[str] = []
+        self.cleanup: Optional[List[str]] = None
+        self.kept: Optional[str] = None
+
+        self._run_stdin: Any = ssh_stdin
+        """What to pass as stdin to the run command, or None to leave it alone"""
+        self._upload_over_stdin = False
+        """Whether to open source and pass it as stdin to the run command"""
+
+        if cache_dir is None:
+            if dest == "":
+                dest = _cpexec_random_dest(source)
+            self._command_list = (interpreter or []) + [dest] + (args or [])
+            self._plan_uncached(dest, keep_remote_file)
+        else:
+            cache_name, self._cached_path, self._partial_path = _cpexec_cache_paths(source, cache_dir)
+            self._command_list = (interpreter or []) + [self._cached_path] + (args or [])
+            prepare_script = remote_cache_prepare_script(cache_dir, cache_name, cache_keep)
+            self.prepare = ["ssh"] + ssh_opts + [host, f"sh -c {shlex.quote(prepare_script)}"]
+
+    def _plan_uncached(self, dest: str, keep_remote_file: bool):
+        if self.upload_method == "stdin":
+            script = stdin_upload_script(dest, self._command_list, os.path.getsize(self.source), keep_remote_file)
+            self._run_over_stdin(script)
+            logger.debug(
+                f"Will connect to {self.host}, upload {self.source} to {dest} over stdin, "
+                f"and execute: {self._command_list}"
+            )
+        else:
+            self.upload = _scp_command(self.host, [self.source], dest, self.ssh_opts)
+            self._run_over_ssh(self._remote_cmd())
+            if not keep_remote_file:
+                self.cleanup = ["ssh"] + self.ssh_opts + [self.host, f"rm -f {dest}"]
         if keep_remote_file:
-            print(f"Kept the remote file at {dest}")
+            self.kept = dest
+
+    def cache_checked(self, prepare_output: str):
+        """Plan the rest of the commands from the output of the `prepare` command"""
+        if prepare_output.strip() == "untrusted":
+            logger.warning(
+                f"Not using the remote cache directory {os.path.dirname(self._cached_path)} on {self.host}, "
+                "because it is not owned by the remote user or is writable by others"
+            )
+            dest = _cpexec_random_dest(self.source)
+            self._command_list = (self._interpreter or []) + [dest] + (self._args or [])
+            self._plan_uncached(dest, keep_remote_file=False)
+            return
+
+        hit = prepare_output.strip() == "hit"
+        logger.debug(f"Remote cache {'hit' if hit else 'miss'} for {self._cached_path} on {self.host}")
+
+        if self.upload_method == "stdin" and not hit:
+            size = os.path.getsize(self.source)
+            script = stdin_upload_script(self._partial_path, self._command_list, size, install_path=self._cached_path)
+            self._run_over_stdin(script)
+            return
+
+        remote_cmd = self._remote_cmd()
+        if not hit:
+            self.upload = _scp_command(self.host, [self.source], self._partial_path, self.ssh_opts)
+            install_cmd = f"mv -f {shlex.quote(self._partial_path)} {shlex.quote(self._cached_path)}"
+            remote_cmd = f"{install_cmd} && {remote_cmd}"
+        if self.upload_method == "stdin":
+            # We are not streaming the file over stdin because it was a cache hit,
+            # but the caller expects the same empty stdin as if we had.
+            self._run_stdin = subprocess.DEVNULL
+        self._run_over_ssh(remote_cmd)
+
+    def _remote_cmd(self) -> str:
+        return " ".join(shlex.quote(arg) for arg in self._command_list)
+
+    def _run_over_stdin(self, script: str):
+        self.run = ["ssh", "-T"] + self.ssh_opts + [self.host, f"sh -c {shlex.quote(script)}"]
+        self._upload_over_stdin = True
+
+    def _run_over_ssh(self, remote_cmd: str):
+        logger.debug(f"Will connect to {self.host} and execute command: {remote_cmd}")
+        self.run = _ssh_command(self.host, self.ssh_opts, self.ssh_tty, remote_cmd)
+
+    @contextlib.contextmanager
+    def run_args(self) -> Iterator[Dict[str, Any]]:
+        """Keyword arguments for magicrun() or amagicrun() to run `run` with
+
+        When uploading over stdin, the source file is open while in the context.
+        """
+        if self._upload_over_stdin:
+            with open(self.source, "rb") as srcfp:
+                yield {"stdin": srcfp}
+        elif self._run_stdin is not None:
+            yield {"stdin": self._run_stdin}
         else:
-            # We don't need to fuck with ttys/fds here because rm is simple
-            magicrun(["ssh", host, f"rm -f {dest}"])
+            yield {}
 
-    return execresult
+
+def _cpexec_check_args(ssh_tty: bool, ssh_stdin: Any, upload: UploadMethod, cache_dir: Optional[str], cache_keep: int):
+    """Raise ValueError for invalid combinations of cpexec() arguments"""
+    if upload not in ["scp", "stdin"]:
+        raise ValueError(f"Unknown upload method {upload}")
+    if upload == "stdin" and ssh_tty:
+        raise ValueError("Cannot allocate a tty with upload='stdin', because stdin carries the file")
+    if upload == "stdin" and ssh_stdin is not None:
+        raise ValueError("Cannot pass ssh_stdin with upload='stdin', because stdin carries the file")
+    if cache_dir is not None and cache_keep < 1:
+        raise ValueError("cache_keep must be at least 1")
+
+
+def _cpexec_random_dest(source: str) -> str:
+    """A random path in /tmp on the remote host to copy source to"""
+    return f"/tmp/{generate_random_string(16)}-{os.path.basename(source)}"
+
+
+def _cpexec_cache_paths(source: str, cache_dir: str):
+    """Return the name of source in a remote cache_dir, its path, and a partial path to upload it to"""
+    _, ext = os.path.splitext(source)
+    cache_name = f"{file_sha256(source)}{ext}"
+    cached_path = f"{cache_dir}/{cache_name}"
+    partial_path = f"{cached_path}.partial-{generate_random_string(16)}"
+    return (cache_name, cached_path, partial_path)
+
+
+def _ssh_command(host: str, ssh_opts: List[str], ssh_tty: bool, remote_cmd: str) -> List[str]:
+    """The ssh command line to run a command on a remote host"""
+    ssh_cmd = ["ssh"] + ssh_opts
+    if ssh_tty:
+        ssh_cmd += ["-tt"]
+    ssh_cmd += [host, remote_cmd]
+    return ssh_cmd
@@ -13,7 +13,7 @@ from pathlib import Path
 import subprocess
 from typing import Any, Dict, List, Literal, Optional, Union
 
-from progfiguration import logger, sitewrapper
+from progfiguration import logger, sitewrapper, tracing
 from progfiguration.inventory.invstores import Secret, SecretStore, SecretReference, HostStore, get_inherited_secret
 from progfiguration.inventory.nodes import InventoryNode
 
@@ -131,7 +131,8 @@ class AgeSecretReference(SecretReference):
         if node.sitedata and node.sitedata.get("age_key_path"):
             secret.privkey_path = node.sitedata["age_key_path"]
 
-        value = secret.decrypt()
+        with tracing.span(f"secret {self.name}", "secret", node=nodename):
+            value = secret.decrypt()
         return value
 
 
@@ -151,12 +152,13 @@ def decrypt(value: str, privkey_path: Optional[str]) -> str:
     """Decrypt an encrypted age value"""
     if not privkey_path:
         raise MissingAgeKeyException
-    proc = subprocess.run(
-        ["age", "--decrypt", "--identity", privkey_path],
-        input=value.encode(),
-        check=True,
-        capture_output=True,
-    )
+    with tracing.span("age decrypt", "secret", encrypted_bytes=len(value)):
+        proc = subprocess.run(
+            ["age", "--decrypt", "--identity", privkey_path],
+            input=value.encode(),
+            check=True,
+            capture_output=True,
+        )
     return proc.stdout.decode()
 
 
@@ -5,11 +5,19 @@ perhaps with a configuration file or by defining the nodes/groups/etc in the sit
 """
 
 
+import contextlib
+import threading
 from types import ModuleType
-from typing import Dict, List
-from progfiguration import sitewrapper
+from typing import Any, Callable, ContextManager, Dict, Iterator, List, Optional, Tuple
+from progfiguration import sitewrapper, tracing
 from progfiguration.inventory.invstores import SecretStore
-from progfiguration.inventory.roles import ProgfigurationRole, collect_role_arguments
+from progfiguration.inventory.roles import (
+    ProgfigurationRole,
+    RoleCycleError,
+    collect_role_arguments,
+    has_lazy_arguments,
+    lazy_argument_role_class,
+)
 
 from progfiguration.localhost import LocalhostLinux
 
@@ -22,6 +30,7 @@ class MemoryHostStore:
         groups: Dict[str, List[str]],
         node_function_map: Dict[str, str],
         function_role_map: Dict[str, List[str]],
+        lazy_secrets: bool = False,
     ):
 
         self.localhost = LocalhostLinux()
@@ -40,6 +49,13 @@ class MemoryHostStore:
         self.group_members = {"universal": [n for n in self.node_function.keys()], **groups}
         """a dict where keys are group names and values are lists of node names"""
 
+        self.lazy_secrets = lazy_secrets
+        """Only decrypt secret role arguments when a role reads them
+
+        See `progfiguration.inventory.roles.LazySecret`.
+        Set by ``progfigsite apply --lazy-secrets``.
+        """
+
         self._node_groups: Dict[str, List[str]] = {}
         self._function_nodes: Dict[str, List[str]] = {}
 
@@ -47,6 +63,10 @@ class MemoryHostStore:
         self._group_modules: Dict[str, ModuleType] = {}
         self._role_modules: Dict[str, ModuleType] = {}
         self._node_roles: Dict[str, Dict[str, ProgfigurationRole]] = {}
+        self._node_role_calculations: Dict[str, Dict[str, Dict[str, Any]]] = {}
+
+        # The roles each thread is instantiating or calculating, to detect cycles
+        self._resolving = threading.local()
 
     @property
     def groups(self) -> List[str]:
@@ -137,28 +157,66 @@ class MemoryHostStore:
         You can then call `.apply()` or `.calculations()` on the role.
 
         Results are cached for subsequent calls.
+
+        Raises `progfiguration.inventory.roles.RoleCycleError`
+        if the role's arguments refer back to the role itself, directly or through other roles.
         """
         if nodename not in self._node_roles:
             self._node_roles[nodename] = {}
         if rolename not in self._node_roles[nodename]:
+            with self._resolving_role("instantiate", nodename, rolename):
+                self._node_roles[nodename][rolename] = self._instantiate_role(secretstore, nodename, rolename)
 
-            # rolepkg is a string containing the package name of the role, like 'progfigsite.roles.role_name'
-            rolepkg = self.role_module(rolename).__package__
-
-            # The class it the subclass of ProgfigurationRole that implements the role
-            role_cls = self.role_module(rolename).Role
-
-            # Get a list of all the groups this node is a member of so that we can get any role arg definitions they may have
-            groupmods = {}
-            for groupname in self.node_groups[nodename]:
-                groupmods[groupname] = self.group(groupname)
+        return self._node_roles[nodename][rolename]
 
-            # Get the node module so we can get any role arg definitions it may have
-            node = self.node(nodename).node
+    @contextlib.contextmanager
+    def _resolving_role(self, step: str, nodename: str, rolename: str) -> Iterator[None]:
+        """Track a step in resolving a role, and raise RoleCycleError if the role is already being resolved
 
+        Instantiating a role resolves its arguments,
+        which can get the calculations of another role, which instantiates that role, and so on.
+        Without this, a cycle of references would recurse until Python gives up.
+        """
+        stack: List[Tuple[str, str, str]] = self._resolving.__dict__.setdefault("stack", [])
+        key = (step, nodename, rolename)
+        if key in stack:
+            cycle = stack[stack.index(key) :] + [key]
+            path = [f"{cstep} {cnode}:{crole}" for cstep, cnode, crole in cycle]
+            raise RoleCycleError(f"Role references form a cycle: {' -> '.join(path)}")
+        stack.append(key)
+        try:
+            yield
+        finally:
+            stack.pop()
+
+    def _instantiate_role(self, secretstore: SecretStore, nodename: str, rolename: str) -> ProgfigurationRole:
+        """Instantiate a role for a node, without caching it"""
+
+        # rolepkg is a string containing the package name of the role, like 'progfigsite.roles.role_name'
+        rolepkg = self.role_module(rolename).__package__
+
+        # The class it the subclass of ProgfigurationRole that implements the role
+        role_cls = self.role_module(rolename).Role
+
+        # Get a list of all the groups this node is a member of so that we can get any role arg definitions they may have
+        groupmods = {}
+        for groupname in self.node_groups[nodename]:
+            groupmods[groupname] = self.group(groupname)
+
+        # Get the node module so we can get any role arg definitions it may have
+        node = self.node(nodename).node
+
+        # Trace collecting arguments too, because that's where secrets are decrypted
+        with tracing.span(f"instantiate {rolename}", "role", node=nodename):
             # Collect all the arguments we need to instantiate the role class
             # This function finds the most specific definition of each argument
-            roleargs = collect_role_arguments(self, secretstore, nodename, node, groupmods, rolename)
+            roleargs = collect_role_arguments(
+                self, secretstore, nodename, node, groupmods, rolename, lazy_secrets=self.lazy_secrets
+            )
+
+            # Only roles with lazy secrets or calculations need the slower class that resolves them when they're read
+            if has_lazy_arguments(roleargs):
+                role_cls = lazy_argument_role_class(role_cls)
 
             # Instantiate the role class, now that we have all the arguments we need
             try:
@@ -169,11 +227,60 @@ class MemoryHostStore:
                     msg += " This might happen if you have two properties with the same name (perhaps one as a function with a @property decorator)."
                 raise Exception(msg) from exc
 
-            # And set the role in the cache
-            self._node_roles[nodename][rolename] = role
+        return role
 
-        return self._node_roles[nodename][rolename]
+    def node_role_calculations(self, secretstore: SecretStore, nodename: str, rolename: str) -> Dict[str, Any]:
+        """The results of `ProgfigurationRole.calculations()` for a given node and role
 
-    def node_role_list(self, nodename: str, secretstore: SecretStore) -> list[ProgfigurationRole]:
-        """A list of all instantiated roles for a given node"""
-        return [self.node_role(secretstore, nodename, rolename) for rolename in self.node_rolename_list(nodename)]
+        Results are cached for subsequent calls,
+        so that many `progfiguration.inventory.roles.RoleCalculationReference` arguments
+        to the same role only call its calculations() once,
+        until `invalidate_role_calculations()` is called.
+        """
+        node_calculations = self._node_role_calculations.setdefault(nodename, {})
+        if rolename not in node_calculations:
+            role = self.node_role(secretstore, nodename, rolename)
+            with self._resolving_role("calculate", nodename, rolename):
+                node_calculations[rolename] = role.calculations()
+        return node_calculations[rolename]
+
+    def invalidate_role_calculations(self, nodename: Optional[str] = None, rolename: Optional[str] = None) -> None:
+        """Forget cached calculations
+
+        Forget calculations for the given node and/or role, or all calculations if neither is passed.
+        Roles whose calculations depend on state that changes during apply should call this,
+        usually through `ProgfigurationRole.invalidate_calculations()`.
+        """
+        for cnode, node_calculations in self._node_role_calculations.items():
+            if nodename is not None and cnode != nodename:
+                continue
+            for crole in list(node_calculations):
+                if rolename is None or crole == rolename:
+                    del node_calculations[crole]
+
+    def node_role_list(
+        self,
+        nodename: str,
+        secretstore: SecretStore,
+        rolenames: Optional[List[str]] = None,
+        instantiating: Optional[Callable[[str], ContextManager[Any]]] = None,
+    ) -> list[ProgfigurationRole]:
+        """A list of instantiated roles for a given node
+
+        If rolenames is passed, only the node's roles that are in it are instantiated and returned,
+        in the order they are listed for the node's function.
+        Roles they take a `progfiguration.inventory.roles.RoleCalculationReference` to
+        are instantiated too, when their arguments are resolved, but are not returned.
+        Other roles are not instantiated, so their secrets are not decrypted.
+
+        If instantiating is passed, it is called with the name of each role,
+        and the role is instantiated inside the context manager it returns,
+        like a profiler for that role.
+        """
+        roles = []
+        for rolename in self.node_rolename_list(nodename):
+            if rolenames is not None and rolename not in rolenames:
+                continue
+            with instantiating(rolename) if instantiating else contextlib.nullcontext():
+                roles.append(self.node_role(secretstore, nodename, rolename))
+        return roles
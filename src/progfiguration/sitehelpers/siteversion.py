@@ -2,10 +2,28 @@
 
 
 from datetime import datetime
+import os
+from typing import Optional
 
 from progfiguration import sitewrapper
 
 
+def source_date_epoch() -> Optional[int]:
+    """Return the build date from the SOURCE_DATE_EPOCH environment variable, if it is set
+
+    SOURCE_DATE_EPOCH is the standard way to give a fixed build date to reproducible builds,
+    in seconds since the epoch;
+    see <https://reproducible-builds.org/specs/source-date-epoch/>.
+    """
+    epoch = os.environ.get("SOURCE_DATE_EPOCH")
+    if not epoch:
+        return None
+    try:
+        return int(epoch)
+    except ValueError:
+        raise ValueError(f"SOURCE_DATE_EPOCH must be an integer number of seconds since the epoch, not {epoch!r}")
+
+
 def mint_version_factory_from_epoch(major: int = 1, minor: int = 0):
     """Return a mint_version() function.
 
@@ -19,12 +37,16 @@ def mint_version_factory_from_epoch(major: int = 1, minor: int = 0):
     This function returns a function that can be used as mint_version().
     The version number is based on the current time,
     in the format 1.0.<seconds since the epoch>.
+    If SOURCE_DATE_EPOCH is set, it is used instead of the current time,
+    so that reproducible builds get the same version every time.
     """
 
     def mint_version() -> str:
         """Mint a new version number"""
-        dt = datetime.utcnow()
-        epoch = int(dt.timestamp())
+        epoch = source_date_epoch()
+        if epoch is None:
+            dt = datetime.utcnow()
+            epoch = int(dt.timestamp())
         version = f"{major}.{minor}.{epoch}"
         return version
 
@@ -0,0 +1,144 @@
+"""Trace where time goes during a progfiguration run
+
+When tracing is started with `start_trace()`,
+`span()` records how long each command, role, and secret decryption took,
+and `stop_trace()` saves them in the Chrome trace event format:
+<https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU>.
+Open the result in a trace viewer like <https://ui.perfetto.dev> or ``chrome://tracing``
+to see the slow steps of a node's configuration.
+
+Tracing is off by default,
+and `span()` does very little when it is off.
+"""
+
+import atexit
+import contextlib
+from dataclasses import dataclass, field
+import json
+import os
+import pathlib
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional
+
+from progfiguration import logger
+
+
+@dataclass
+class TraceSpan:
+    """A span of time in a trace, yielded by `span()`
+
+    Callers can add results to `args`, like the exit code of a command,
+    and set `tid` to show the span on a different row of the trace.
+    """
+
+    name: str
+    """The name of the span, shown in the trace viewer"""
+
+    category: str
+    """The category of the span, like "cmd", "role", or "secret\""""
+
+    args: Dict[str, Any] = field(default_factory=dict)
+    """Extra data shown in the trace viewer when the span is selected"""
+
+    tid: Optional[int] = None
+    """The row to show the span on, which defaults to the thread that ran it
+
+    Spans on the same row must nest,
+    so spans that overlap without nesting, like commands run concurrently with amagicrun(),
+    should set this to something unique, like the pid of the command.
+    """
+
+
+class Tracer:
+    """Collects trace events in memory and saves them to a file"""
+
+    def __init__(self, path: pathlib.Path, process_name: str = ""):
+        self.path = path
+        self.pid = os.getpid()
+        self.start_ns = time.perf_counter_ns()
+        self.events: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+        if process_name:
+            self.events.append({"name": "process_name", "ph": "M", "pid": self.pid, "args": {"name": process_name}})
+
+    def add(self, span: TraceSpan, start_ns: int, end_ns: int):
+        """Record a finished span"""
+        event = {
+            "name": span.name,
+            "cat": span.category,
+            "ph": "X",
+            "ts": (start_ns - self.start_ns) / 1000,
+            "dur": (end_ns - start_ns) / 1000,
+            "pid": self.pid,
+            "tid": span.tid if span.tid is not None else threading.get_ident(),
+            "args": span.args,
+        }
+        with self._lock:
+            self.events.append(event)
+
+    def save(self):
+        """Save the trace to its path as JSON"""
+        with self._lock:
+            contents = {"traceEvents": self.events, "displayTimeUnit": "ms"}
+            with self.path.open("w") as fp:
+                json.dump(contents, fp, default=str)
+        logger.info(f"Saved trace with {len(self.events)} events to {self.path}")
+
+
+_tracer: Optional[Tracer] = None
+"""The active tracer, if tracing is on"""
+
+
+def start_trace(path: pathlib.Path, process_name: str = ""):
+    """Start tracing, and save the trace to path when `stop_trace()` is called or the program exits
+
+    :param path: Where to save the trace.
+    :param process_name: A name for this process in the trace viewer, like "progfigsite apply node1".
+    """
+    global _tracer
+    if _tracer is not None:
+        raise RuntimeError(f"Already tracing to {_tracer.path}")
+    _tracer = Tracer(path, process_name)
+    # Save the trace even if the program exits with an exception or sys.exit()
+    atexit.register(stop_trace)
+
+
+def stop_trace():
+    """Stop tracing and save the trace, if tracing is on"""
+    global _tracer
+    atexit.unregister(stop_trace)
+    if _tracer is not None:
+        tracer, _tracer = _tracer, None
+        tracer.save()
+
+
+def tracing() -> bool:
+    """Whether tracing is on"""
+    return _tracer is not None
+
+
+@contextlib.contextmanager
+def span(name: str, category: str, **args) -> Iterator[TraceSpan]:
+    """Record how long the body of a with statement takes, if tracing is on
+
+    :param name: The name of the span, like the name of a role.
+    :param category: The category of the span, like "cmd", "role", or "secret".
+    :param args: Extra data to show in the trace viewer.
+
+    Yields a `TraceSpan`, whose args the body can add to.
+    The span is recorded even if the body raises an exception.
+    """
+    tracespan = TraceSpan(name, category, args)
+    tracer = _tracer
+    if tracer is None:
+        yield tracespan
+        return
+    start_ns = time.perf_counter_ns()
+    try:
+        yield tracespan
+    except BaseException as exc:
+        tracespan.args["exception"] = repr(exc)
+        raise
+    finally:
+        tracer.add(tracespan, start_ns, time.perf_counter_ns())
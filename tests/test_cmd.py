@@ -1,9 +1,15 @@
+import asyncio
 import io
+import os
 import sys
+import tempfile
+import time
 import unittest
 
 from progfiguration import cmd
 
+from tests import skipUnlessAnyEnv
+
 
 class TestRun(unittest.TestCase):
     def test_run_basic_stdout_stderr(self):
@@ -36,3 +42,167 @@ class TestRun(unittest.TestCase):
 
         self.assertEqual(terminal_out, "hello\n")
         self.assertEqual(terminal_err, "world\n")
+
+    def test_run_with_output_prefix(self):
+        """Test that printed output is prefixed, but captured output is not"""
+
+        outbuf = io.StringIO()
+        sys.stdout = outbuf
+        errbuf = io.StringIO()
+        sys.stderr = errbuf
+
+        result = cmd.magicrun(["sh", "-c", "(echo hello); (echo world >&2)"], output_prefix="[node1] ")
+
+        terminal_out = outbuf.getvalue()
+        terminal_err = errbuf.getvalue()
+
+        sys.stdout = sys.__stdout__
+        sys.stderr = sys.__stderr__
+
+        self.assertEqual(result.stdout.read(), "hello\n")
+        self.assertEqual(result.stderr.read(), "world\n")
+        self.assertEqual(terminal_out, "[node1] hello\n")
+        self.assertEqual(terminal_err, "[node1] world\n")
+
+    def test_run_partial_lines(self):
+        """Test that output split across reads in the middle of a line or character is handled correctly"""
+
+        outbuf = io.StringIO()
+        sys.stdout = outbuf
+
+        # The sleeps make sure each printf arrives in its own read.
+        # \342\202\254 is the UTF-8 encoding of "€", split across two reads.
+        script = r"printf 'one\ntw'; sleep 0.1; printf 'o\r\nthree \342\202'; sleep 0.1; printf '\254'"
+        result = cmd.magicrun(["sh", "-c", script], output_prefix="[node1] ", encoding="utf-8")
+
+        terminal_out = outbuf.getvalue()
+        sys.stdout = sys.__stdout__
+
+        self.assertEqual(result.stdout.read(), "one\ntwo\nthree €")
+        self.assertEqual(terminal_out, "[node1] one\n[node1] two\n[node1] three €")
+
+    def test_run_capture_bytes(self):
+        """Test capturing output as bytes, without decoding it or translating newlines"""
+        result = cmd.magicrun(
+            ["sh", "-c", r"printf 'a\r\n\377'; printf 'b' >&2"], print_output=False, capture_bytes=True
+        )
+        self.assertEqual(result.stdout.read(), b"a\r\n\xff")
+        self.assertEqual(result.stderr.read(), b"b")
+
+    def test_run_capture_max_memory(self):
+        """Test spilling captured output to a temporary file"""
+        result = cmd.magicrun(["sh", "-c", "seq 1000"], print_output=False, capture_max_memory=100)
+        self.assertIsInstance(result.stdout, tempfile.SpooledTemporaryFile)
+        self.assertTrue(result.stdout._rolled)
+        self.assertEqual(result.stdout.read(), "".join(f"{i}\n" for i in range(1, 1001)))
+        self.assertEqual(result.stderr.read(), "")
+
+    def test_run_capture_head_tail(self):
+        """Test keeping only the beginning and end of captured output"""
+
+        # The sleep makes sure the output arrives in more than one read
+        script = "seq 1 500; sleep 0.1; seq 501 1000"
+        expected = "".join(f"{i}\n" for i in range(1, 1001))
+
+        cases = [
+            (10, 10, expected[:10] + expected[-10:]),
+            (10, None, expected[:10]),
+            (None, 10, expected[-10:]),
+            (0, 3000, expected[-3000:]),
+            (5000, 5000, expected),
+        ]
+        for head, tail, kept in cases:
+            with self.subTest(head=head, tail=tail):
+                result = cmd.magicrun(["sh", "-c", script], print_output=False, capture_head=head, capture_tail=tail)
+                self.assertEqual(result.stdout.read(), kept)
+                self.assertEqual(result.stdout_omitted, len(expected) - len(kept))
+                self.assertEqual(result.stderr_omitted, 0)
+
+    @skipUnlessAnyEnv(["PROGFIGURATION_TEST_SLOW_ALL", "PROGFIGURATION_TEST_SLOW_CMD"])
+    def test_run_throughput(self):
+        """Benchmark capturing a large amount of output
+
+        Set PROGFIGURATION_TEST_CMD_THROUGHPUT_MB to change the amount of output, which defaults to 256MB.
+        """
+        size = int(os.environ.get("PROGFIGURATION_TEST_CMD_THROUGHPUT_MB", "256")) * 1024 * 1024
+        start = time.monotonic()
+        result = cmd.magicrun(f"yes 'the quick brown fox jumps over the lazy dog' | head -c {size}", print_output=False)
+        elapsed = time.monotonic() - start
+        self.assertEqual(len(result.stdout.getvalue()), size)
+        print(
+            f"\nmagicrun captured {size // 1024 // 1024}MB in {elapsed:.2f}s ({size / elapsed / 1024 / 1024:.0f}MB/s)"
+        )
+
+    def test_amagicrun(self):
+        """Test the asyncio version of magicrun, running several commands at once"""
+
+        outbuf = io.StringIO()
+        sys.stdout = outbuf
+
+        async def run_all():
+            return await asyncio.gather(
+                *[
+                    cmd.amagicrun(["sh", "-c", f"sleep 0.5; echo hello {idx}; echo world >&2"], print_output=idx == 0)
+                    for idx in range(3)
+                ]
+            )
+
+        start = time.monotonic()
+        results = asyncio.run(run_all())
+        elapsed = time.monotonic() - start
+
+        terminal_out = outbuf.getvalue()
+        sys.stdout = sys.__stdout__
+
+        for idx, result in enumerate(results):
+            self.assertEqual(result.returncode, 0)
+            self.assertEqual(result.stdout.read(), f"hello {idx}\n")
+            self.assertEqual(result.stderr.read(), "world\n")
+        self.assertEqual(terminal_out, "hello 0\n")
+        # The commands ran at the same time, not one after another
+        self.assertLess(elapsed, 1.4)
+
+    def test_amagicrun_check(self):
+        """Test that amagicrun raises on a failed command like magicrun does"""
+        with self.assertRaises(Exception):
+            asyncio.run(cmd.amagicrun("exit 3", print_output=False))
+        result = asyncio.run(cmd.amagicrun("echo hi; exit 3", print_output=False, check=False))
+        self.assertEqual(result.returncode, 3)
+        self.assertEqual(result.stdout.read(), "hi\n")
+
+    def test_magicrun_many(self):
+        """Test running a batch of commands with a concurrency limit"""
+
+        outbuf = io.StringIO()
+        sys.stdout = outbuf
+
+        cmds = [["sh", "-c", f"sleep 0.3; echo {idx}"] for idx in range(4)]
+        start = time.monotonic()
+        results = cmd.magicrun_many(cmds, concurrency=2)
+        elapsed = time.monotonic() - start
+
+        terminal_out = outbuf.getvalue()
+        sys.stdout = sys.__stdout__
+
+        self.assertEqual([result.stdout.read() for result in results], ["0\n", "1\n", "2\n", "3\n"])
+        self.assertCountEqual(terminal_out.splitlines(), ["[0 sh] 0", "[1 sh] 1", "[2 sh] 2", "[3 sh] 3"])
+        # Two batches of two commands at a time
+        self.assertGreater(elapsed, 0.55)
+        self.assertLess(elapsed, 1.1)
+
+    def test_magicrun_many_errors(self):
+        """Test that magicrun_many reports every failure after running every command"""
+        cmds = ["echo one; exit 1", "echo two", "echo three >&2; exit 3", ["/nonexistent/command"]]
+        with self.assertRaises(cmd.MagicrunManyError) as ctx:
+            cmd.magicrun_many(cmds, print_output=False, labels=["one", "two", "three", "four"])
+        msg = str(ctx.exception)
+        self.assertIn("3 of 4 commands failed", msg)
+        self.assertIn("[one] Command failed with exit code 1", msg)
+        self.assertIn("[three] Command failed with exit code 3: echo three >&2; exit 3\n    three", msg)
+        self.assertIn("[four] Could not run command", msg)
+        self.assertNotIn("[two]", msg)
+        self.assertEqual(ctx.exception.results[1].stdout.read(), "two\n")
+        self.assertIsNone(ctx.exception.results[3])
+
+        results = cmd.magicrun_many(cmds[:3], print_output=False, check=False)
+        self.assertEqual([result.returncode for result in results], [1, 0, 3])
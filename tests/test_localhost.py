@@ -0,0 +1,87 @@
+import os
+import pathlib
+import tempfile
+import time
+from unittest import mock
+
+from progfiguration.localhost import LocalhostLinux
+
+from tests import PdbTestCase, pdbexc
+
+
+def backdate(path: pathlib.Path):
+    """Set a file's modification time in the past, so the cache doesn't consider it too recently modified to trust"""
+    past = time.time() - 60
+    os.utime(path, (past, past))
+
+
+class TestLocalhostFileCache(PdbTestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.tmppath = pathlib.Path(tmpdir.name)
+
+    @pdbexc
+    def test_cache_hit_and_invalidation(self):
+        """Test that unchanged files are read once, and that writes and outside changes are seen"""
+        localhost = LocalhostLinux()
+        path = self.tmppath / "file.conf"
+        path.write_text("one\n")
+        backdate(path)
+
+        self.assertEqual(localhost.get_file_contents(path), "one")
+        with mock.patch("builtins.open", side_effect=AssertionError("File was read again")):
+            self.assertEqual(localhost.get_file_contents(path, chomp=False), "one\n")
+        self.assertEqual(localhost._cache_files.hits, 1)
+
+        # Changed by another program
+        path.write_text("two two\n")
+        backdate(path)
+        self.assertEqual(localhost.get_file_contents(path), "two two")
+
+        # Changed by linesinfile(), which writes with set_file_contents()
+        localhost.linesinfile(path, ["three"])
+        self.assertEqual(localhost.get_file_contents(path), "two two\nthree")
+
+        # Overwritten by cp() into its directory
+        backdate(path)
+        localhost.get_file_contents(path)
+        srcdir = self.tmppath / "src"
+        srcdir.mkdir()
+        (srcdir / "file.conf").write_text("four\n")
+        localhost.cp(srcdir / "file.conf", self.tmppath)
+        self.assertEqual(localhost.get_file_contents(path), "four")
+
+    @pdbexc
+    def test_uncached_files(self):
+        """Test that recently modified files and files under /proc are not cached"""
+        localhost = LocalhostLinux()
+        path = self.tmppath / "recent"
+        path.write_text("recent")
+        localhost.get_file_contents(path)
+        self.assertEqual(localhost._cache_files.size, 0)
+        localhost.get_file_contents("/proc/self/status")
+        self.assertEqual(localhost._cache_files.size, 0)
+
+    @pdbexc
+    def test_lru_eviction(self):
+        """Test that the least recently used files are dropped when the cache is full, and big files are not cached"""
+        localhost = LocalhostLinux(file_cache_bytes=10)
+        for name, contents in [("a", "aaaa"), ("b", "bbbb"), ("c", "cccc"), ("big", "x" * 11)]:
+            (self.tmppath / name).write_text(contents)
+            backdate(self.tmppath / name)
+
+        localhost.get_file_contents(self.tmppath / "a")
+        localhost.get_file_contents(self.tmppath / "b")
+        localhost.get_file_contents(self.tmppath / "a")
+        localhost.get_file_contents(self.tmppath / "c")
+        localhost.get_file_contents(self.tmppath / "big")
+        cached = [pathlib.Path(path).name for path in localhost._cache_files._entries]
+        self.assertEqual(cached, ["a", "c"])
+        self.assertEqual(localhost._cache_files.size, 8)
+
+        # Sizes are in bytes on disk, not characters
+        (self.tmppath / "utf8").write_text("éé", encoding="utf-8")
+        backdate(self.tmppath / "utf8")
+        localhost.get_file_contents(self.tmppath / "utf8")
+        self.assertEqual(localhost._cache_files.size, 8)
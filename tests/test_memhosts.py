@@ -0,0 +1,236 @@
+import copy
+import contextlib
+from dataclasses import dataclass
+from types import SimpleNamespace
+from typing import Any, List, Optional
+
+from progfiguration.inventory.invstores import SecretReference
+from progfiguration.inventory.nodes import InventoryNode
+from progfiguration.inventory.roles import LazySecret, ProgfigurationRole, RoleCalculationReference, RoleCycleError
+from progfiguration.sitehelpers.memhosts import MemoryHostStore
+
+from tests import PdbTestCase, pdbexc
+
+
+@dataclass
+class CountingReference:
+    """An argument reference that records each time it is dereferenced, like a secret being decrypted"""
+
+    value: str
+    dereferenced: List[str]
+
+    def dereference(self, nodename, hoststore, secretstore) -> Any:
+        self.dereferenced.append(self.value)
+        return self.value
+
+
+@dataclass
+class CountingSecret(SecretReference):
+    """A secret reference that records each time it is decrypted"""
+
+    name: str
+    decrypted: List[str]
+
+    def dereference(self, nodename, hoststore, secretstore) -> Any:
+        self.decrypted.append(self.name)
+        return f"{self.name} value"
+
+
+@dataclass(kw_only=True)
+class Role(ProgfigurationRole):
+    arg: Any = None
+
+    def apply(self):
+        pass
+
+    def calculations(self):
+        return {"calc": f"{self.name} calculation"}
+
+
+@dataclass(kw_only=True)
+class EagerRole(Role):
+    eager_arguments = ["arg"]
+
+
+calculation_calls: List[str] = []
+
+
+@dataclass(kw_only=True)
+class CountingRole(Role):
+    """A role that records each time its calculations are run"""
+
+    def calculations(self):
+        calculation_calls.append(self.name)
+        return {"calc": f"{self.name} calculation {len(calculation_calls)}"}
+
+
+class FakeHostStore(MemoryHostStore):
+    """A host store with roles, nodes, and groups defined in memory instead of in a site"""
+
+    def __init__(self, node: InventoryNode, lazy_secrets: bool = False, role_classes: Optional[dict] = None):
+        super().__init__({}, {"node1": "func1"}, {"func1": ["a", "b", "c"]}, lazy_secrets=lazy_secrets)
+        self._node = node
+        self._role_classes = role_classes or {"b": EagerRole}
+
+    def node(self, name):
+        return SimpleNamespace(node=self._node)
+
+    def group(self, name):
+        return SimpleNamespace(group={"roles": {}})
+
+    def role_module(self, name):
+        return SimpleNamespace(__package__="tests", Role=self._role_classes.get(name, Role))
+
+
+class TestMemoryHostStore(PdbTestCase):
+    @pdbexc
+    def test_node_role_list_selected(self):
+        """Test that only selected roles and the roles they reference are instantiated"""
+        dereferenced = []
+        node = InventoryNode(
+            address="node1",
+            ssh_host_fingerprint="",
+            roles={
+                "a": {"arg": CountingReference("a secret", dereferenced)},
+                "b": {"arg": CountingReference("b secret", dereferenced)},
+                "c": {"arg": RoleCalculationReference("a", "calc")},
+            },
+        )
+        hoststore = FakeHostStore(node)
+
+        roles = hoststore.node_role_list("node1", None, ["c"])
+        self.assertEqual([role.name for role in roles], ["c"])
+        self.assertEqual(roles[0].arg, "a calculation")
+        self.assertCountEqual(hoststore._node_roles["node1"], ["a", "c"])
+        self.assertEqual(dereferenced, ["a secret"])
+
+        instantiated = []
+
+        @contextlib.contextmanager
+        def instantiating(rolename):
+            instantiated.append(rolename)
+            yield
+
+        roles = hoststore.node_role_list("node1", None, instantiating=instantiating)
+        self.assertEqual([role.name for role in roles], ["a", "b", "c"])
+        self.assertEqual(dereferenced, ["a secret", "b secret"])
+        self.assertEqual(instantiated, ["a", "b", "c"])
+        # Roles without lazy secrets or calculations are instances of their own class,
+        # which doesn't hook attribute access
+        self.assertIs(type(roles[0]), Role)
+        self.assertIs(type(roles[1]), EagerRole)
+        self.assertIsNot(type(roles[2]), Role)
+
+    @pdbexc
+    def test_lazy_secrets(self):
+        """Test that secrets are only decrypted when a role reads them, unless they are eager"""
+        decrypted = []
+        node = InventoryNode(
+            address="node1",
+            ssh_host_fingerprint="",
+            roles={
+                "a": {"arg": CountingSecret("a secret", decrypted)},
+                "b": {"arg": CountingSecret("b secret", decrypted)},
+                "c": {"arg": {"nested": CountingSecret("c secret", decrypted)}},
+            },
+        )
+        hoststore = FakeHostStore(node, lazy_secrets=True)
+        a, b, c = hoststore.node_role_list("node1", None)
+        # b's secret is eager, and c's is nested inside another value, which is never dereferenced
+        self.assertEqual(decrypted, ["b secret"])
+        # Only a was given a LazySecret, so only a needs the class that decrypts it when it's read
+        self.assertIsInstance(a, Role)
+        self.assertIsNot(type(a), Role)
+        self.assertIs(type(b), EagerRole)
+        self.assertIs(type(c), Role)
+
+        self.assertEqual(a.arg, "a secret value")
+        self.assertIs(type(a.arg), str)
+        self.assertEqual(a.arg, "a secret value")
+        self.assertEqual(decrypted, ["b secret", "a secret"])
+
+    @pdbexc
+    def test_lazy_secret_proxy(self):
+        """Test that a LazySecret acts like its value and only dereferences once"""
+        calls = []
+
+        def dereference():
+            calls.append(1)
+            return "hunter2"
+
+        secret = LazySecret("password", dereference)
+        self.assertNotIn("hunter2", repr(secret))
+        self.assertFalse(secret.resolved)
+        self.assertEqual(f"pw={secret}", "pw=hunter2")
+        self.assertEqual(secret, "hunter2")
+        self.assertEqual(secret + "!", "hunter2!")
+        self.assertEqual(">" + secret, ">hunter2")
+        self.assertEqual(secret.encode(), b"hunter2")
+        self.assertEqual(len(secret), 7)
+        self.assertTrue(secret.resolved)
+        self.assertNotIn("hunter2", repr(secret))
+        self.assertEqual(calls, [1])
+
+        copied = copy.copy(LazySecret("password", dereference))
+        self.assertEqual(copied, "hunter2")
+        with self.assertRaises(AttributeError):
+            secret._private
+
+    @pdbexc
+    def test_calculations_memoized(self):
+        """Test that calculations are run once for many references, until they are invalidated
+
+        Roles that reference the calculations see the new results after they are invalidated,
+        even though they were instantiated before.
+        """
+        calculation_calls.clear()
+        node = InventoryNode(
+            address="node1",
+            ssh_host_fingerprint="",
+            roles={
+                "b": {"arg": RoleCalculationReference("a", "calc")},
+                "c": {"arg": RoleCalculationReference("a", "calc")},
+            },
+        )
+        hoststore = FakeHostStore(node, role_classes={"a": CountingRole})
+        a, b, c = hoststore.node_role_list("node1", None)
+        self.assertEqual(calculation_calls, ["a"])
+        self.assertEqual(b.arg, "a calculation 1")
+        self.assertEqual(c.arg, "a calculation 1")
+
+        a.invalidate_calculations()
+        self.assertEqual(hoststore.node_role_calculations(None, "node1", "a"), {"calc": "a calculation 2"})
+        self.assertEqual(hoststore.node_role_calculations(None, "node1", "a"), {"calc": "a calculation 2"})
+        self.assertEqual(calculation_calls, ["a", "a"])
+        self.assertEqual(b.arg, "a calculation 2")
+        self.assertEqual(c.arg, "a calculation 2")
+        self.assertEqual(calculation_calls, ["a", "a"])
+
+    @pdbexc
+    def test_reference_cycle(self):
+        """Test that roles referencing each other in a cycle raise a clear error"""
+        node = InventoryNode(
+            address="node1",
+            ssh_host_fingerprint="",
+            roles={
+                "a": {"arg": RoleCalculationReference("c", "calc")},
+                "c": {"arg": RoleCalculationReference("a", "calc")},
+            },
+        )
+        hoststore = FakeHostStore(node)
+        with self.assertRaisesRegex(RoleCycleError, "instantiate node1:a -> .* -> instantiate node1:a"):
+            hoststore.node_role(None, "node1", "a")
+
+    @pdbexc
+    def test_calculation_reference_without_memoization(self):
+        """Test that calculation references work with host stores that don't memoize calculations"""
+
+        class PlainHostStore:
+            def node_role(self, secretstore, nodename, rolename):
+                return Role(name=rolename, localhost=None, hoststore=self, rolepkg="tests")
+
+        hoststore = PlainHostStore()
+        reference = RoleCalculationReference("a", "calc")
+        self.assertEqual(reference.dereference("node1", hoststore, None), "a calculation")
+        # Nothing to invalidate, but it shouldn't fail either
+        hoststore.node_role(None, "node1", "a").invalidate_calculations()
@@ -0,0 +1,52 @@
+import io
+
+from progfiguration import memtrace
+
+from tests import PdbTestCase, pdbexc
+
+
+class TestMemtrace(PdbTestCase):
+    @pdbexc
+    def test_phases(self):
+        """Test that nested phases report their peak and where their memory was allocated"""
+        output = io.StringIO()
+        memtrace.start_memory_trace(top=3, output=output)
+        try:
+            with memtrace.phase("outer"):
+                kept = [bytearray(1024) for _ in range(1024)]
+                with memtrace.phase("inner") as inner:
+                    dropped = bytearray(8 * 1024 * 1024)
+                    del dropped
+        finally:
+            phases = memtrace.stop_memory_trace()
+        self.assertFalse(memtrace.tracing_memory())
+
+        self.assertEqual([phase.name for phase in phases], ["inner", "outer"])
+        self.assertIs(phases[0], inner)
+        inner, outer = phases
+
+        # The dropped bytearray counts toward the peak of both phases, but isn't in use at the end of either
+        self.assertGreater(inner.peak - inner.start, 7 * 1024 * 1024)
+        self.assertLess(inner.end - inner.start, 1024 * 1024)
+        self.assertGreaterEqual(outer.peak, inner.peak)
+
+        # The kept bytearrays are in use at the end of the outer phase, and it reports where they were allocated
+        self.assertGreaterEqual(outer.end - outer.start, 1024 * 1024)
+        self.assertLessEqual(len(outer.top), 3)
+        self.assertEqual(outer.top[0].traceback[0].filename, __file__)
+        self.assertGreaterEqual(outer.top[0].size_diff, 1024 * 1024)
+
+        report = output.getvalue()
+        self.assertIn("Memory after inner:", report)
+        self.assertIn("Memory after outer:", report)
+        self.assertIn(f"{__file__}:", report)
+        del kept
+
+    @pdbexc
+    def test_phase_without_trace(self):
+        """Test that phases do nothing when memory tracing is off"""
+        self.assertFalse(memtrace.tracing_memory())
+        with memtrace.phase("name") as result:
+            pass
+        self.assertIsNone(result)
+        self.assertEqual(memtrace.stop_memory_trace(), [])
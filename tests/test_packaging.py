@@ -1,8 +1,15 @@
+import importlib.util
+import os
 import pathlib
+import sys
 import tempfile
+import unittest
+from unittest import mock
+import zipfile
 
 from progfiguration import progfigbuild
 from progfiguration.cmd import magicrun
+from progfiguration.progfigbuild import treeshake, zipmanifest
 
 from tests import PdbTestCase, pdbexc, skipUnlessAnyEnv, verbose_test_output
 from tests.data import nnss_test_data
@@ -37,3 +44,284 @@ class TestRun(PdbTestCase):
             self.assertTrue("progfiguration core" in stdout)
             self.assertTrue("nss_progfigsite" in stdout)
             self.assertTrue(nnss.progfigsite.site_description in stdout)
+
+    @pdbexc
+    @unittest.skipUnless(importlib.util.find_spec("build"), "the build package is not installed")
+    @skipUnlessAnyEnv(["PROGFIGURATION_TEST_SLOW_ALL", "PROGFIGURATION_TEST_SLOW_PACKAGING"])
+    def test_package_nnss_pip_wheel(self):
+        """Test that a wheel and an sdist can be built together, and the wheel includes progfiguration core"""
+        with nnss_test_data as nnss, tempfile.TemporaryDirectory() as tmpdir:
+            outdir = pathlib.Path(tmpdir)
+            built = progfigbuild.build_progfigsite_pip_packages(
+                nnss.progfigsite_path, nnss.progfigsite_name, outdir, package_format="both"
+            )
+            self.assertEqual(len(built), 2)
+            sdist, wheel = built
+            self.assertTrue(sdist.name.endswith(".tar.gz"))
+            self.assertTrue(wheel.name.endswith("-py3-none-any.whl"))
+            with zipfile.ZipFile(wheel) as z:
+                names = z.namelist()
+            self.assertIn(f"{nnss.progfigsite_name}/builddata/version.py", names)
+            self.assertIn(f"{nnss.progfigsite_name}/builddata/static_include/progfiguration/cmd.py", names)
+
+    @pdbexc
+    def test_package_pip_unknown_format(self):
+        """Test that an unknown pip package format is rejected before building anything"""
+        with nnss_test_data as nnss, tempfile.TemporaryDirectory() as tmpdir:
+            with self.assertRaises(ValueError):
+                progfigbuild.build_progfigsite_pip_packages(
+                    nnss.progfigsite_path, nnss.progfigsite_name, pathlib.Path(tmpdir), package_format="egg"
+                )
+
+    @pdbexc
+    def test_zipapp_build_cache(self):
+        """Test that an unchanged site is only built once"""
+        with nnss_test_data as nnss, tempfile.TemporaryDirectory() as tmpdir:
+            cache_dir = pathlib.Path(tmpdir)
+            first, first_hit = progfigbuild.build_progfigsite_zipapp_cached(
+                nnss.progfigsite_path, nnss.progfigsite_name, cache_dir
+            )
+            second, second_hit = progfigbuild.build_progfigsite_zipapp_cached(
+                nnss.progfigsite_path, nnss.progfigsite_name, cache_dir
+            )
+            self.assertFalse(first_hit)
+            self.assertTrue(second_hit)
+            self.assertEqual(first, second)
+            self.assertEqual([p.name for p in cache_dir.glob("*.pyz")], [first.name])
+
+    @pdbexc
+    def test_zipapp_bytecode(self):
+        """Test that bytecode is stored next to each module, where zipimport looks for it"""
+        with nnss_test_data as nnss, tempfile.TemporaryDirectory() as tmpdir:
+            pyzfile = pathlib.Path(tmpdir) / "test.pyz"
+            progfigbuild.build_progfigsite_zipapp(
+                nnss.progfigsite_path, nnss.progfigsite_name, pyzfile, bytecode_python=sys.executable
+            )
+            with zipfile.ZipFile(pyzfile) as z:
+                names = z.namelist()
+            self.assertIn("__main__.pyc", names)
+            self.assertIn("progfiguration/cmd.pyc", names)
+            self.assertIn(f"{nnss.progfigsite_name}/builddata/version.pyc", names)
+
+    @pdbexc
+    def test_zipapp_incremental(self):
+        """Test that an incremental build copies unchanged entries and rewrites changed ones"""
+        with nnss_test_data as nnss, tempfile.TemporaryDirectory() as tmpdir:
+            pyzfile = pathlib.Path(tmpdir) / "test.pyz"
+            progfigbuild.build_progfigsite_zipapp(
+                nnss.progfigsite_path, nnss.progfigsite_name, pyzfile, incremental=True
+            )
+
+            # Pretend that the inventory changed since the first build
+            changed = f"{nnss.progfigsite_name}/inventory.py"
+            manifest_path = zipmanifest.zipapp_manifest_path(pyzfile)
+            manifest = zipmanifest.ZipappManifest.load(manifest_path)
+            assert manifest is not None
+            manifest.entries[changed].size = -1
+            manifest.entries[changed].sha256 = "0" * 64
+            manifest.save(manifest_path)
+
+            with mock.patch.object(progfigbuild, "copy_raw_entry", wraps=zipmanifest.copy_raw_entry) as copy:
+                progfigbuild.build_progfigsite_zipapp(
+                    nnss.progfigsite_path, nnss.progfigsite_name, pyzfile, incremental=True
+                )
+            copied = {call.args[2] for call in copy.call_args_list}
+            self.assertIn("progfiguration/cmd.py", copied)
+            self.assertIn(f"{nnss.progfigsite_name}/__init__.py", copied)
+            self.assertNotIn(changed, copied)
+            self.assertNotIn("__main__.py", copied)
+
+            with zipfile.ZipFile(pyzfile) as z:
+                self.assertIsNone(z.testzip())
+                self.assertEqual(z.read(changed), (nnss.progfigsite_path / "inventory.py").read_bytes())
+                self.assertEqual(
+                    z.read("progfiguration/cmd.py"),
+                    (pathlib.Path(progfigbuild.__file__).parent.parent / "cmd.py").read_bytes(),
+                )
+            manifest = zipmanifest.ZipappManifest.load(manifest_path)
+            assert manifest is not None
+            self.assertEqual(
+                manifest.entries[changed].sha256, zipmanifest.file_sha256(nnss.progfigsite_path / "inventory.py")
+            )
+
+    @pdbexc
+    def test_zipapp_reproducible(self):
+        """Test that reproducible builds of the same inputs are byte-identical"""
+        with nnss_test_data as nnss, tempfile.TemporaryDirectory() as tmpdir:
+            tmppath = pathlib.Path(tmpdir)
+            with mock.patch.dict(os.environ, {"SOURCE_DATE_EPOCH": "1700000000"}):
+                for name, incremental in [
+                    ("full1", False),
+                    ("full2", False),
+                    ("incremental", True),
+                    ("incremental", True),
+                ]:
+                    progfigbuild.build_progfigsite_zipapp(
+                        nnss.progfigsite_path,
+                        nnss.progfigsite_name,
+                        tmppath / f"{name}.pyz",
+                        version="1.0.0",
+                        reproducible=True,
+                        incremental=incremental,
+                    )
+            full = (tmppath / "full1.pyz").read_bytes()
+            self.assertEqual(full, (tmppath / "full2.pyz").read_bytes())
+            self.assertEqual(full, (tmppath / "incremental.pyz").read_bytes())
+
+            with zipfile.ZipFile(tmppath / "full1.pyz") as z:
+                infos = z.infolist()
+            for info in infos:
+                self.assertEqual(info.date_time, (2023, 11, 14, 22, 13, 20))
+                self.assertIn(info.external_attr >> 16, (0o40755, 0o100644))
+
+    @pdbexc
+    def test_zipapp_reproducible_requires_date(self):
+        """Test that a reproducible build without a build date is an error"""
+        with nnss_test_data as nnss, tempfile.TemporaryDirectory() as tmpdir:
+            with mock.patch.dict(os.environ):
+                os.environ.pop("SOURCE_DATE_EPOCH", None)
+                with self.assertRaises(ValueError):
+                    progfigbuild.build_progfigsite_zipapp(
+                        nnss.progfigsite_path,
+                        nnss.progfigsite_name,
+                        pathlib.Path(tmpdir) / "test.pyz",
+                        reproducible=True,
+                    )
+
+    @pdbexc
+    def test_zipapp_target_includes(self):
+        """Test which site files a slim zipapp target includes"""
+        target = progfigbuild.ZipappTarget(nodes=["node1"], groups=["universal"], roles=["settz"])
+        cases = [
+            ("inventory.py", False, True),
+            ("nodes", True, True),
+            ("nodes/__init__.py", False, True),
+            ("nodes/node1.py", False, True),
+            ("nodes/node1.secrets.json", False, True),
+            ("nodes/node2.py", False, False),
+            ("nodes/node2.secrets.json", False, False),
+            ("groups/universal.py", False, True),
+            ("groups/group1.py", False, False),
+            ("roles/settz.py", False, True),
+            ("roles/other", True, False),
+            ("roles/other/__init__.py", False, False),
+            ("roles/other/templates/file.txt", False, False),
+            ("roles/README.md", False, True),
+        ]
+        for relpath, is_dir, expected in cases:
+            with self.subTest(relpath=relpath):
+                self.assertEqual(target.includes(pathlib.PurePosixPath(relpath), is_dir), expected)
+
+    @pdbexc
+    def test_zipapp_slim(self):
+        """Test that a slim zipapp leaves out nodes, groups, and roles its target doesn't need"""
+        with nnss_test_data as nnss, tempfile.TemporaryDirectory() as tmpdir:
+            target = progfigbuild.ZipappTarget.for_function(nnss.inventory.hoststore, "func1")
+            self.assertEqual(target.nodes, ["node1"])
+            self.assertEqual(target.groups, ["group1", "universal"])
+            self.assertEqual(target.roles, ["settz"])
+
+            pyzfile = pathlib.Path(tmpdir) / "test.pyz"
+            target = progfigbuild.ZipappTarget(nodes=["node1"], groups=["universal"], roles=[])
+            progfigbuild.build_progfigsite_zipapp(nnss.progfigsite_path, nnss.progfigsite_name, pyzfile, target=target)
+            with zipfile.ZipFile(pyzfile) as z:
+                names = z.namelist()
+            self.assertIn(f"{nnss.progfigsite_name}/nodes/node1.py", names)
+            self.assertIn(f"{nnss.progfigsite_name}/nodes/node1.secrets.json", names)
+            self.assertIn(f"{nnss.progfigsite_name}/groups/universal.py", names)
+            self.assertIn(f"{nnss.progfigsite_name}/roles/__init__.py", names)
+            self.assertNotIn(f"{nnss.progfigsite_name}/groups/group1.py", names)
+            self.assertNotIn(f"{nnss.progfigsite_name}/roles/settz.py", names)
+
+    @pdbexc
+    def test_treeshake_module_imports(self):
+        """Test that absolute and relative imports resolve to module names"""
+        source = "\n".join(
+            [
+                "import os.path",
+                "from progfiguration import cmd, logger",
+                "from . import sibling",
+                "from ..cli.util import configure_logging",
+                "def lazy():",
+                "    import progfiguration.ssh",
+            ]
+        )
+        imports = treeshake.module_imports(source, "progfiguration.localhost.disks")
+        for name in [
+            "os.path",
+            "progfiguration",
+            "progfiguration.cmd",
+            "progfiguration.logger",
+            "progfiguration.localhost.sibling",
+            "progfiguration.cli.util",
+            "progfiguration.ssh",
+        ]:
+            self.assertIn(name, imports)
+
+    @pdbexc
+    def test_zipapp_minimal_core(self):
+        """Test that a minimal core zipapp leaves out unused parts of core"""
+        with nnss_test_data as nnss, tempfile.TemporaryDirectory() as tmpdir:
+            pyzfile = pathlib.Path(tmpdir) / "test.pyz"
+            progfigbuild.build_progfigsite_zipapp(
+                nnss.progfigsite_path,
+                nnss.progfigsite_name,
+                pyzfile,
+                minimal_core=True,
+                core_includes=["progfiguration.ssh"],
+            )
+            with zipfile.ZipFile(pyzfile) as z:
+                names = z.namelist()
+            self.assertIn("progfiguration/__init__.py", names)
+            self.assertIn("progfiguration/cli/progfiguration_site_cmd.py", names)
+            self.assertIn("progfiguration/sitehelpers/agesecrets.py", names)
+            self.assertIn("progfiguration/progfigbuild/zipapp_extract.py.temple", names)
+            self.assertIn("progfiguration/ssh.py", names)
+            self.assertNotIn("progfiguration/cli/progfiguration_core_cmd.py", names)
+            self.assertFalse([n for n in names if n.startswith("progfiguration/newsite/")])
+
+            result = magicrun(
+                [sys.executable, str(pyzfile), "version"], print_output=verbose_test_output(), check=False
+            )
+            self.assertEqual(result.returncode, 0)
+
+    @pdbexc
+    @skipUnlessAnyEnv(["PROGFIGURATION_TEST_SLOW_ALL", "PROGFIGURATION_TEST_SLOW_PACKAGING"])
+    def test_zipapp_extract(self):
+        """Test that a zipapp built with extract_dir runs from an extracted copy"""
+        with nnss_test_data as nnss, tempfile.TemporaryDirectory() as tmpdir:
+            pyzfile = pathlib.Path(tmpdir) / "test.pyz"
+            extract_dir = pathlib.Path(tmpdir) / "extracted"
+            progfigbuild.build_progfigsite_zipapp(
+                nnss.progfigsite_path, nnss.progfigsite_name, pyzfile, extract_dir=extract_dir.as_posix()
+            )
+            for _ in range(2):
+                result = magicrun([str(pyzfile), "version"], print_output=verbose_test_output(), check=False)
+                self.assertEqual(result.returncode, 0)
+                extractions = list(extract_dir.iterdir())
+                self.assertEqual(len(extractions), 1)
+                self.assertIn(f"path: {extractions[0]}/progfiguration", result.stdout.read())
+
+    @pdbexc
+    @skipUnlessAnyEnv(["PROGFIGURATION_TEST_SLOW_ALL", "PROGFIGURATION_TEST_SLOW_PACKAGING"])
+    def test_zipapp_extract_untrusted(self):
+        """Test that an existing extraction writable by other users is replaced rather than imported from"""
+        with nnss_test_data as nnss, tempfile.TemporaryDirectory() as tmpdir:
+            pyzfile = pathlib.Path(tmpdir) / "test.pyz"
+            extract_dir = pathlib.Path(tmpdir) / "extracted"
+            progfigbuild.build_progfigsite_zipapp(
+                nnss.progfigsite_path, nnss.progfigsite_name, pyzfile, extract_dir=extract_dir.as_posix()
+            )
+            result = magicrun([str(pyzfile), "version"], print_output=verbose_test_output(), check=False)
+            self.assertEqual(result.returncode, 0)
+            (extraction,) = extract_dir.iterdir()
+            planted = extraction / "planted"
+            planted.write_text("planted by someone else")
+            extraction.chmod(0o777)
+
+            result = magicrun([str(pyzfile), "version"], print_output=verbose_test_output(), check=False)
+            self.assertEqual(result.returncode, 0)
+            self.assertEqual(list(extract_dir.iterdir()), [extraction])
+            self.assertFalse(planted.exists())
+            self.assertEqual(extraction.stat().st_mode & 0o777, 0o700)
+            self.assertIn(f"path: {extraction}/progfiguration", result.stdout.read())
@@ -0,0 +1,41 @@
+import pathlib
+import pstats
+import tempfile
+import time
+
+from progfiguration import cmd, profiling
+
+from tests import PdbTestCase, pdbexc
+
+
+class TestProfiling(PdbTestCase):
+    @pdbexc
+    def test_role_profiler(self):
+        """Test profiling roles, saving .pstats files, and summarizing them"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            profile_dir = pathlib.Path(tmpdir) / "profiles"
+            profiler = profiling.RoleProfiler(profile_dir)
+
+            with profiler.profile("busy_subprocess"):
+                cmd.magicrun(["sh", "-c", "i=0; while test $i -lt 50000; do i=$((i+1)); done"], print_output=False)
+            with profiler.profile("sleepy"):
+                time.sleep(0.05)
+            # Profiling the same role again adds to its profile
+            with profiler.profile("sleepy"):
+                time.sleep(0.05)
+
+            paths = profiler.save()
+            self.assertCountEqual([path.name for path in paths], ["busy_subprocess.pstats", "sleepy.pstats"])
+            stats = pstats.Stats(str(profile_dir / "sleepy.pstats"))
+            self.assertTrue(any(func[2] == "<built-in method time.sleep>" for func in stats.stats))
+
+        sleepy = profiler.profiles["sleepy"]
+        self.assertGreaterEqual(sleepy.wall, 0.1)
+        self.assertLess(sleepy.cpu, 0.05)
+        self.assertGreater(profiler.profiles["busy_subprocess"].subprocess, 0)
+
+        table = profiler.table().splitlines()
+        self.assertEqual(table[0].split(), ["Role", "Wall", "CPU", "Subprocess"])
+        self.assertEqual(table[-1].split()[0], "Total")
+        slowest = max(profiler.profiles.values(), key=lambda p: p.wall)
+        self.assertEqual(table[1].split()[0], slowest.name)
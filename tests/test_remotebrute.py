@@ -0,0 +1,400 @@
+import asyncio
+import contextlib
+import io
+import os
+import pathlib
+import subprocess
+import tempfile
+from unittest import mock
+
+from progfiguration import remotebrute
+from progfiguration.cli import progfiguration_site_cmd
+from progfiguration.inventory.nodes import InventoryNode
+
+from tests import PdbTestCase, pdbexc
+
+_FAKE_SSH = """#!/bin/sh
+# Skip options, and the host, then run the remote command locally
+while test "${1#-}" != "$1"; do
+    if test "$1" = "-o"; then shift; fi
+    shift
+done
+shift
+exec sh -c "$*"
+"""
+
+_FAKE_SCP = """#!/bin/sh
+# Skip options, then copy the sources to the destination after the host: locally
+while test "${1#-}" != "$1"; do
+    if test "$1" = "-o"; then shift; fi
+    shift
+done
+for last in "$@"; do :; done
+while test $# -gt 1; do
+    cp -r "$1" "${last#*:}"
+    shift
+done
+"""
+
+_FAKE_SSH_MULTIPLEXED = """#!/bin/sh
+# Like _FAKE_SSH, but also act as a master connection for SshMultiplexer.
+# A master creates its control socket and runs until "-O exit" removes it,
+# unless FAKE_SSH_MASTER is "fail" (exit immediately) or "hang" (never create the socket).
+master=
+control=
+controlpath=
+while test "${1#-}" != "$1"; do
+    case "$1" in
+        -M) master=1 ;;
+        -O) shift; control="$1" ;;
+        -o) shift; case "$1" in ControlPath=*) controlpath="${1#ControlPath=}" ;; esac ;;
+    esac
+    shift
+done
+if test "$master"; then
+    case "$FAKE_SSH_MASTER" in
+        fail) exit 255 ;;
+        hang) exec sleep 30 ;;
+    esac
+    touch "$controlpath"
+    while test -e "$controlpath"; do sleep 0.1; done
+    exit 0
+fi
+if test "$control" = exit; then
+    rm -f "$controlpath"
+    exit 0
+fi
+shift
+exec sh -c "$*"
+"""
+
+
+def _logging(script: str, logfile: pathlib.Path) -> str:
+    """Make a fake command log its name and arguments, one invocation per line, before doing anything else"""
+    shebang, body = script.split("\n", 1)
+    return f'{shebang}\nprintf "%s\\n" "$(basename "$0") $*" | tr "\\n" " " >> {logfile}; echo >> {logfile}\n{body}'
+
+
+def _write_executable(path: pathlib.Path, contents: str):
+    path.write_text(contents)
+    path.chmod(0o755)
+
+
+class TestRun(PdbTestCase):
+    @pdbexc
+    def test_stdin_upload_script(self):
+        """Test that the stdin upload script saves, runs, and removes the file
+
+        Run the script with a local shell instead of over ssh.
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            payload = pathlib.Path(tmpdir) / "payload.sh"
+            payload.write_text('echo "hello $1"\nexit 3\n')
+            dest = os.path.join(tmpdir, "dest.sh")
+            script = remotebrute.stdin_upload_script(dest, ["sh", dest, "world"], payload.stat().st_size)
+            with payload.open("rb") as fp:
+                result = subprocess.run(["sh", "-c", script], stdin=fp, capture_output=True)
+            self.assertEqual(result.stdout, b"hello world\n")
+            self.assertEqual(result.returncode, 3)
+            self.assertFalse(os.path.exists(dest))
+
+    @pdbexc
+    def test_stdin_upload_script_truncated(self):
+        """Test that the stdin upload script refuses to run a file of the wrong size"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            payload = pathlib.Path(tmpdir) / "payload.sh"
+            payload.write_text("echo hello\n")
+            dest = os.path.join(tmpdir, "dest.sh")
+            script = remotebrute.stdin_upload_script(dest, ["sh", dest], payload.stat().st_size + 1)
+            with payload.open("rb") as fp:
+                result = subprocess.run(["sh", "-c", script], stdin=fp, capture_output=True)
+            self.assertEqual(result.stdout, b"")
+            self.assertNotEqual(result.returncode, 0)
+            self.assertFalse(os.path.exists(dest))
+
+    @pdbexc
+    def test_remote_cache_prepare_script(self):
+        """Test that the remote cache prepare script reports hits and prunes least recently used files
+
+        Run the script with a local shell instead of over ssh.
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache_dir = pathlib.Path(tmpdir) / "cache"
+
+            script = remotebrute.remote_cache_prepare_script(cache_dir.as_posix(), "current.pyz", 3)
+            result = subprocess.run(["sh", "-c", script], capture_output=True, check=True)
+            self.assertEqual(result.stdout, b"miss\n")
+            self.assertTrue(cache_dir.is_dir())
+
+            for idx, name in enumerate(["old1.pyz", "old2.pyz", "old3.pyz", "current.pyz"]):
+                path = cache_dir / name
+                path.write_text(name)
+                os.utime(path, (1000 + idx, 1000 + idx))
+
+            result = subprocess.run(["sh", "-c", script], capture_output=True, check=True)
+            self.assertEqual(result.stdout, b"hit\n")
+            self.assertCountEqual(os.listdir(cache_dir), ["current.pyz", "old3.pyz", "old2.pyz"])
+
+            # A cached file that others can write to might not be the file we uploaded
+            (cache_dir / "current.pyz").chmod(0o666)
+            result = subprocess.run(["sh", "-c", script], capture_output=True, check=True)
+            self.assertEqual(result.stdout, b"miss\n")
+            self.assertFalse((cache_dir / "current.pyz").exists())
+
+            # Nothing in a cache directory that others can write to can be trusted
+            (cache_dir / "current.pyz").write_text("current.pyz")
+            cache_dir.chmod(0o777)
+            result = subprocess.run(["sh", "-c", script], capture_output=True, check=True)
+            self.assertEqual(result.stdout, b"untrusted\n")
+            self.assertCountEqual(os.listdir(cache_dir), ["current.pyz", "old3.pyz", "old2.pyz"])
+
+    @pdbexc
+    def test_acpexec(self):
+        """Test copying and running a file on several hosts at once with acpexec
+
+        Put fake ssh and scp commands in the PATH that run commands and copy files locally.
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            bindir = pathlib.Path(tmpdir) / "bin"
+            bindir.mkdir()
+            _write_executable(bindir / "ssh", _FAKE_SSH)
+            _write_executable(bindir / "scp", _FAKE_SCP)
+            payload = pathlib.Path(tmpdir) / "payload.sh"
+            payload.write_text('echo "hello $1"\n')
+            cache_dir = os.path.join(tmpdir, "cache")
+
+            async def run_all():
+                # Exercise each way of uploading: scp, stdin, and each of those with a remote cache
+                operations = [
+                    remotebrute.acpexec(
+                        f"host{idx}",
+                        str(payload),
+                        args=[str(idx)],
+                        interpreter=["sh"],
+                        ssh_tty=False,
+                        upload="stdin" if idx % 2 else "scp",
+                        cache_dir=cache_dir if idx >= 2 else None,
+                        output_prefix=f"[host{idx}] ",
+                    )
+                    for idx in range(4)
+                ]
+                return await asyncio.gather(*operations)
+
+            with mock.patch.dict(os.environ, {"PATH": f"{bindir}{os.pathsep}{os.environ['PATH']}"}):
+                results = asyncio.run(run_all())
+
+            for idx, result in enumerate(results):
+                self.assertEqual(result.stdout.read(), f"hello {idx}\n")
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+    @pdbexc
+    def test_cpexec(self):
+        """Test copying and running a file with cpexec, with the same fake ssh and scp commands as test_acpexec"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            bindir = pathlib.Path(tmpdir) / "bin"
+            bindir.mkdir()
+            _write_executable(bindir / "ssh", _FAKE_SSH)
+            _write_executable(bindir / "scp", _FAKE_SCP)
+            payload = pathlib.Path(tmpdir) / "payload.sh"
+            payload.write_text('echo "hello $1"\n')
+            cache_dir = os.path.join(tmpdir, "cache")
+            dest = os.path.join(tmpdir, "kept.sh")
+
+            with mock.patch.dict(os.environ, {"PATH": f"{bindir}{os.pathsep}{os.environ['PATH']}"}):
+                # Each way of uploading, then a cache miss and a cache hit for each way of uploading
+                cases = [
+                    ("scp", None),
+                    ("stdin", None),
+                    ("stdin", cache_dir),
+                    ("stdin", cache_dir),
+                    ("scp", os.path.join(tmpdir, "cache2")),
+                    ("scp", os.path.join(tmpdir, "cache2")),
+                ]
+                for idx, (upload, case_cache_dir) in enumerate(cases):
+                    result = remotebrute.cpexec(
+                        f"host{idx}",
+                        str(payload),
+                        args=[str(idx)],
+                        interpreter=["sh"],
+                        ssh_tty=False,
+                        upload=upload,
+                        cache_dir=case_cache_dir,
+                    )
+                    self.assertEqual(result.stdout.read(), f"hello {idx}\n")
+                self.assertEqual(len(os.listdir(cache_dir)), 1)
+                self.assertEqual(len(os.listdir(os.path.join(tmpdir, "cache2"))), 1)
+
+                # An untrusted cache directory is not used, but the file still runs
+                untrusted_dir = os.path.join(tmpdir, "untrusted")
+                os.mkdir(untrusted_dir)
+                os.chmod(untrusted_dir, 0o777)
+                for upload in ["scp", "stdin"]:
+                    result = remotebrute.cpexec(
+                        "host",
+                        str(payload),
+                        args=[upload],
+                        interpreter=["sh"],
+                        ssh_tty=False,
+                        upload=upload,
+                        cache_dir=untrusted_dir,
+                    )
+                    self.assertEqual(result.stdout.read(), f"hello {upload}\n")
+                self.assertEqual(os.listdir(untrusted_dir), [])
+
+                remotebrute.cpexec(
+                    "host", str(payload), dest=dest, interpreter=["sh"], ssh_tty=False, keep_remote_file=True
+                )
+                self.assertTrue(os.path.exists(dest))
+
+
+class TestSshMultiplexer(PdbTestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.tmppath = pathlib.Path(tmpdir.name)
+        bindir = self.tmppath / "bin"
+        bindir.mkdir()
+        self.logfile = self.tmppath / "log"
+        _write_executable(bindir / "ssh", _logging(_FAKE_SSH_MULTIPLEXED, self.logfile))
+        _write_executable(bindir / "scp", _logging(_FAKE_SCP, self.logfile))
+        path_patcher = mock.patch.dict(os.environ, {"PATH": f"{bindir}{os.pathsep}{os.environ['PATH']}"})
+        path_patcher.start()
+        self.addCleanup(path_patcher.stop)
+
+    def logged(self) -> list:
+        if not self.logfile.exists():
+            return []
+        return [line.strip() for line in self.logfile.read_text().splitlines()]
+
+    @pdbexc
+    def test_master_reused_and_closed(self):
+        """Test that one master is started per host, commands reuse its ControlPath, and close() stops it"""
+        payload = self.tmppath / "payload.sh"
+        payload.write_text('echo "hello $1"\n')
+
+        with remotebrute.SshMultiplexer(master_timeout=10) as multiplexer:
+            sockpath = multiplexer.socket_path("host1")
+            expected_opts = ["-o", f"ControlPath={sockpath}", "-o", "ControlMaster=no"]
+            self.assertEqual(multiplexer.options("host1"), expected_opts)
+            self.assertTrue(os.path.exists(sockpath))
+            master = multiplexer._masters["host1"]
+            self.assertIsNone(master.poll())
+
+            for upload in ["scp", "stdin"]:
+                result = remotebrute.cpexec(
+                    "host1",
+                    str(payload),
+                    args=[upload],
+                    interpreter=["sh"],
+                    ssh_tty=False,
+                    upload=upload,
+                    multiplexer=multiplexer,
+                )
+                self.assertEqual(result.stdout.read(), f"hello {upload}\n")
+            socket_dir = multiplexer.socket_dir
+
+        masters = [line for line in self.logged() if " -M " in line]
+        self.assertEqual(len(masters), 1)
+        commands = [line for line in self.logged() if " -M " not in line and " -O " not in line]
+        self.assertGreater(len(commands), 2)
+        for line in commands:
+            self.assertIn(f"-o ControlPath={sockpath} -o ControlMaster=no", line)
+
+        self.assertIn(f"ssh -o ControlPath={sockpath} -O exit host1", self.logged())
+        self.assertIsNotNone(master.poll())
+        self.assertFalse(os.path.exists(socket_dir))
+        self.assertIsNone(multiplexer.socket_dir)
+
+    @pdbexc
+    def test_master_fails(self):
+        """Test that commands connect normally when the master exits, and the master is not retried"""
+        payload = self.tmppath / "payload.sh"
+        payload.write_text("exit 0\n")
+        with mock.patch.dict(os.environ, {"FAKE_SSH_MASTER": "fail"}):
+            with remotebrute.SshMultiplexer(master_timeout=10) as multiplexer:
+                self.assertEqual(multiplexer.options("host1"), [])
+                self.assertEqual(multiplexer.options("host1"), [])
+                result = remotebrute.cpexec(
+                    "host1",
+                    str(payload),
+                    interpreter=["sh"],
+                    ssh_tty=False,
+                    upload="stdin",
+                    multiplexer=multiplexer,
+                )
+                self.assertEqual(result.returncode, 0)
+        self.assertEqual(len([line for line in self.logged() if " -M " in line]), 1)
+        self.assertFalse([line for line in self.logged() if "ControlMaster=no" in line])
+        self.assertFalse([line for line in self.logged() if " -O exit " in line])
+
+    @pdbexc
+    def test_master_times_out(self):
+        """Test that a master whose control socket never appears is given up on and terminated"""
+        with mock.patch.dict(os.environ, {"FAKE_SSH_MASTER": "hang"}):
+            with remotebrute.SshMultiplexer(master_timeout=0.5) as multiplexer:
+                self.assertEqual(multiplexer.options("host1"), [])
+                master = multiplexer._masters["host1"]
+                self.assertEqual(multiplexer.options("host1"), [])
+        self.assertIsNotNone(master.poll())
+        self.assertEqual(len([line for line in self.logged() if " -M " in line]), 1)
+
+
+class TestDeployApplyParallel(PdbTestCase):
+    @pdbexc
+    def test_parallel_deploy(self):
+        """Test deploying to several nodes at once with the fake ssh and scp commands
+
+        Each node's output is prefixed with its name and stays in order,
+        and a node that fails is reported at the end without stopping the others.
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            bindir = pathlib.Path(tmpdir) / "bin"
+            bindir.mkdir()
+            _write_executable(bindir / "ssh", _FAKE_SSH)
+            _write_executable(bindir / "scp", _FAKE_SCP)
+            # Stands in for the zipapp; deploy runs it as "<python> -u <pyz> apply <nodename>"
+            payload = pathlib.Path(tmpdir) / "progfiguration.pyz"
+            payload.write_text('echo "$2 one"\nsleep 0.2\necho "$2 two"\nif test "$2" = bad; then exit 3; fi\n')
+
+            nodenames = ["node1", "bad", "node2"]
+            nodes = {
+                n: InventoryNode(address=f"{n}.example.com", ssh_host_fingerprint="", roles={}, python="sh")
+                for n in nodenames
+            }
+            hoststore = mock.Mock()
+            hoststore.node.side_effect = lambda nodename: mock.Mock(node=nodes[nodename])
+
+            @contextlib.contextmanager
+            def fake_deploy_zipapps(nodes, *args, **kwargs):
+                yield {nodename: payload for nodename in nodes}
+
+            stdout = io.StringIO()
+            with (
+                mock.patch.dict(os.environ, {"PATH": f"{bindir}{os.pathsep}{os.environ['PATH']}"}),
+                mock.patch.object(progfiguration_site_cmd, "_deploy_zipapps", fake_deploy_zipapps),
+                contextlib.redirect_stdout(stdout),
+            ):
+                progfiguration_site_cmd._action_deploy_apply(
+                    hoststore,
+                    list(nodenames),
+                    [],
+                    [],
+                    remote_debug=False,
+                    force_apply=False,
+                    keep_remote_file=False,
+                    parallel=3,
+                    ssh_multiplex=False,
+                )
+
+            output, summary = stdout.getvalue().split("====================\n")
+            for nodename in nodenames:
+                lines = [line for line in output.splitlines() if nodename in line]
+                self.assertEqual(lines[:2], [f"[{nodename}] {nodename} one", f"[{nodename}] {nodename} two"])
+            for line in output.splitlines():
+                self.assertTrue(line.startswith(tuple(f"[{n}] " for n in nodenames)), line)
+            self.assertIn("[bad] Error running progfiguration on node bad:", output)
+
+            summary_lines = summary.splitlines()
+            self.assertEqual(summary_lines[0], "Errors running progfiguration on 1 of 3 node(s):")
+            self.assertEqual(len(summary_lines), 2)
+            self.assertTrue(summary_lines[1].startswith("  bad: Command failed with exit code 3"))
@@ -0,0 +1,85 @@
+import contextlib
+import io
+import threading
+from types import SimpleNamespace
+
+from progfiguration.inventory import roledag
+from progfiguration.inventory.roles import ProgfigurationRole, RoleCalculationReference
+
+from tests import PdbTestCase, pdbexc
+
+
+class Role(ProgfigurationRole):
+    def apply(self):
+        pass
+
+
+class AfterRole(Role):
+    after = ["packages", "notapplied"]
+
+
+class TestRoleDag(PdbTestCase):
+    @pdbexc
+    def test_node_role_dependencies(self):
+        """Test finding dependencies from calculation references and explicit ordering"""
+        hoststore = SimpleNamespace(
+            node_groups={"node1": ["universal"]},
+            node_rolename_list=lambda nodename: ["packages", "users", "service"],
+            node=lambda name: SimpleNamespace(
+                node=SimpleNamespace(roles={"service": {"home": RoleCalculationReference("users", "homedir")}})
+            ),
+            group=lambda name: SimpleNamespace(
+                group={"roles": {"service": {"user": RoleCalculationReference("other", "username")}}}
+            ),
+            role_module=lambda name: SimpleNamespace(Role=AfterRole if name == "service" else Role),
+        )
+        dependencies = roledag.node_role_dependencies(hoststore, "node1")
+        self.assertEqual(dependencies, {"packages": [], "users": [], "service": ["packages", "users"]})
+
+    @pdbexc
+    def test_role_order(self):
+        """Test that roles come after their dependencies and otherwise keep their order"""
+        order = roledag.role_order(["a", "b", "c", "d"], {"a": ["c"], "b": [], "c": [], "d": ["a"]})
+        self.assertEqual(order, ["b", "c", "a", "d"])
+        self.assertEqual(roledag.role_order(["a", "b"], {}), ["a", "b"])
+
+        with self.assertRaisesRegex(roledag.RoleCycleError, "b -> c -> b"):
+            roledag.role_order(["a", "b", "c"], {"a": ["b"], "b": ["c"], "c": ["b"]})
+
+    @pdbexc
+    def test_apply_parallel(self):
+        """Test that independent roles run at once, and their output is in the same order as a serial run"""
+        # a and b can only finish if they run at the same time
+        barrier = threading.Barrier(2, timeout=10)
+        events = []
+
+        def apply(rolename: str):
+            print(f"{rolename} start")
+            if rolename in ["a", "b"]:
+                barrier.wait()
+            events.append(rolename)
+            print(f"{rolename} end")
+
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            roledag.apply_roles(["b", "c", "a"], {"c": ["a"]}, apply, parallel=4)
+
+        self.assertEqual(stdout.getvalue(), "b start\nb end\na start\na end\nc start\nc end\n")
+        self.assertLess(events.index("a"), events.index("c"))
+
+    @pdbexc
+    def test_apply_failure(self):
+        """Test that roles depending on a failed role don't run, and the failure is raised"""
+        applied = []
+
+        def apply(rolename: str):
+            if rolename == "a":
+                raise ValueError("role a failed")
+            applied.append(rolename)
+
+        for parallel in [1, 2]:
+            with self.subTest(parallel=parallel):
+                applied.clear()
+                with self.assertRaisesRegex(ValueError, "role a failed"):
+                    roledag.apply_roles(["a", "b"], {"b": ["a"]}, apply, parallel=parallel)
+                self.assertEqual(applied, [])
@@ -0,0 +1,121 @@
+import importlib
+import json
+import pathlib
+import sys
+import tempfile
+import textwrap
+import types
+from unittest import mock
+
+from progfiguration.cli import progfiguration_site_cmd
+from progfiguration.inventory import rolefingerprint
+
+from tests import PdbTestCase, pdbexc
+
+
+class TestRoleFingerprint(PdbTestCase):
+    @pdbexc
+    def test_fingerprint_and_state(self):
+        """Test that fingerprints change with role files and arguments, and are saved without secrets"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmppath = pathlib.Path(tmpdir)
+            rolepath = tmppath / "fingerprint_test_role"
+            rolepath.mkdir()
+            (rolepath / "__init__.py").write_text(textwrap.dedent("""\
+                    from dataclasses import dataclass
+                    from progfiguration.inventory.roles import ProgfigurationRole
+
+                    @dataclass(kw_only=True)
+                    class Role(ProgfigurationRole):
+                        password: str
+                        paths: list
+
+                        def apply(self):
+                            pass
+                    """))
+            (rolepath / "template.conf").write_text("setting = 1\n")
+            sys.path.insert(0, tmpdir)
+            self.addCleanup(sys.path.remove, tmpdir)
+            self.addCleanup(sys.modules.pop, "fingerprint_test_role", None)
+            importlib.invalidate_caches()
+            module = importlib.import_module("fingerprint_test_role")
+
+            def fingerprint(password: str, version: str = "1.0"):
+                role = module.Role(
+                    name="testrole",
+                    localhost=None,
+                    hoststore=None,
+                    rolepkg="fingerprint_test_role",
+                    password=password,
+                    paths=[pathlib.Path("/etc/test")],
+                )
+                return rolefingerprint.role_fingerprint(role, module, version)
+
+            original = fingerprint("hunter2")
+            self.assertEqual(fingerprint("hunter2"), original)
+            self.assertNotEqual(fingerprint("hunter3"), original)
+            self.assertNotEqual(fingerprint("hunter2", "2.0"), original)
+            (rolepath / "template.conf").write_text("setting = 2\n")
+            self.assertNotEqual(fingerprint("hunter2"), original)
+            # Bytecode doesn't count
+            (rolepath / "__pycache__").mkdir(exist_ok=True)
+            (rolepath / "__pycache__" / "extra.pyc").write_bytes(b"bytecode")
+            changed = fingerprint("hunter2")
+            (rolepath / "__pycache__" / "extra.pyc").write_bytes(b"different bytecode")
+            self.assertEqual(fingerprint("hunter2"), changed)
+
+            statepath = tmppath / "state" / "roles.json"
+            state = rolefingerprint.RoleStateFile(statepath, "node1")
+            self.assertFalse(state.unchanged("testrole", changed))
+            state.record("testrole", changed)
+            state.record("failedrole", "abc")
+            state.forget("failedrole")
+            state.save()
+
+            self.assertNotIn("hunter2", statepath.read_text())
+            self.assertEqual(json.loads(statepath.read_text()), {"node": "node1", "roles": {"testrole": changed}})
+            self.assertTrue(rolefingerprint.RoleStateFile(statepath, "node1").unchanged("testrole", changed))
+            # State for another node is ignored
+            self.assertFalse(rolefingerprint.RoleStateFile(statepath, "node2").unchanged("testrole", changed))
+
+    @pdbexc
+    def test_single_file_role(self):
+        """Test fingerprinting a role defined in a single module, like the roles in the test sites"""
+        from tests.data.simple.example_site.roles import settz
+
+        role = settz.Role(name="settz", localhost=None, hoststore=None, rolepkg=settz.__package__, timezone="UTC")
+        fingerprint = rolefingerprint.role_fingerprint(role, settz, "1.0")
+        self.assertEqual(len(fingerprint), 64)
+
+    @pdbexc
+    def test_module_without_file(self):
+        """Test fingerprinting modules with no file or loader, like frozen or dynamically created modules"""
+        module = types.ModuleType("dynamic_role")
+        self.assertEqual(rolefingerprint.role_code_digest(module), rolefingerprint.role_code_digest(module))
+
+    @pdbexc
+    def test_apply_state_file_save_fails(self):
+        """Test that failing to save the state file doesn't hide the error from a failed role"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # The state file can't be saved, because its parent directory would be inside a regular file
+            notadir = pathlib.Path(tmpdir) / "notadir"
+            notadir.write_text("")
+            state_file = notadir / "state" / "roles.json"
+
+            role = mock.Mock()
+            role.name = "failing"
+            role.apply.side_effect = RuntimeError("role failed")
+            hoststore = mock.Mock()
+            hoststore.node.return_value.node.TESTING_DO_NOT_APPLY = False
+            hoststore.node_rolename_list.return_value = ["failing"]
+            hoststore.node_role_list.return_value = [role]
+
+            with (
+                mock.patch.object(progfiguration_site_cmd.roledag, "node_role_dependencies", return_value={}),
+                mock.patch.object(rolefingerprint, "core_version", return_value="1.0"),
+                mock.patch.object(rolefingerprint, "role_fingerprint", return_value="fingerprint"),
+                self.assertLogs(level="ERROR") as logs,
+                self.assertRaisesRegex(RuntimeError, "role failed"),
+            ):
+                progfiguration_site_cmd._action_apply(hoststore, None, "node1", state_file=state_file)
+            self.assertTrue(any(f"Could not save role state file {state_file}" in line for line in logs.output))
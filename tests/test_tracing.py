@@ -0,0 +1,54 @@
+import asyncio
+import json
+import pathlib
+import tempfile
+
+from progfiguration import cmd, tracing
+
+from tests import PdbTestCase, pdbexc
+
+
+class TestTracing(PdbTestCase):
+    @pdbexc
+    def test_trace_commands(self):
+        """Test that commands and other spans are saved in Chrome trace event format"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tracefile = pathlib.Path(tmpdir) / "trace.json"
+            tracing.start_trace(tracefile, "test")
+            try:
+                with tracing.span("outer", "role", node="node1"):
+                    cmd.magicrun(["sh", "-c", "printf hello; printf error >&2"], print_output=False)
+                    cmd.magicrun("exit 3", print_output=False, check=False)
+                    asyncio.run(cmd.amagicrun(["echo", "async"], print_output=False))
+            finally:
+                tracing.stop_trace()
+            self.assertFalse(tracing.tracing())
+
+            with tracefile.open() as fp:
+                trace = json.load(fp)
+
+        events = trace["traceEvents"]
+        self.assertEqual(events[0]["ph"], "M")
+        self.assertEqual(events[0]["args"]["name"], "test")
+
+        spans = [event for event in events if event["ph"] == "X"]
+        self.assertEqual([span["name"] for span in spans], ["sh", "exit", "echo", "outer"])
+        first, failed, asynchronous, outer = spans
+        self.assertEqual(first["cat"], "cmd")
+        self.assertEqual(first["args"]["returncode"], 0)
+        self.assertEqual(first["args"]["stdout_bytes"], 5)
+        self.assertEqual(first["args"]["stderr_bytes"], 5)
+        self.assertIsInstance(first["args"]["pid"], int)
+        self.assertEqual(failed["args"]["returncode"], 3)
+        self.assertEqual(asynchronous["tid"], asynchronous["args"]["pid"])
+        self.assertEqual(outer["args"], {"node": "node1"})
+        self.assertLessEqual(outer["ts"], first["ts"])
+        self.assertGreaterEqual(outer["ts"] + outer["dur"], asynchronous["ts"] + asynchronous["dur"])
+
+    @pdbexc
+    def test_span_without_trace(self):
+        """Test that spans work when tracing is off"""
+        self.assertFalse(tracing.tracing())
+        with tracing.span("name", "category", key="value") as tracespan:
+            tracespan.args["result"] = 1
+        self.assertEqual(tracespan.args, {"key": "value", "result": 1})